@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark the compiled kernels against their pure-Python versions.
+
+Build the kernels first:
+
+    python setup.py build_ext --inplace
+    python benchmarks/bench_kernels.py
+"""
+import argparse
+import os
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metaSNV.bam_preprocessing import BAMReference  # noqa: E402
+from metaSNV.kernels import python  # noqa: E402
+
+try:
+    from metaSNV.kernels import _compiled
+except ImportError:
+    sys.exit("The compiled kernels are not built: run 'python setup.py build_ext --inplace'")
+
+
+def snv_lines(rng, n_lines, n_samples):
+    lines = []
+    for pos in range(n_lines):
+        cov = rng.integers(0, 60, n_samples)
+        alleles = []
+        for alt in 'CG'[:rng.integers(1, 3)]:
+            counts = rng.binomial(cov, 0.3)
+            alleles.append('{}|{}|.|{}'.format(counts.sum(), alt, '|'.join(map(str, counts))))
+        lines.append('ref1\t-\t{}\tA\t{}\t{}\n'.format(pos + 1, '|'.join(map(str, cov)), ','.join(alleles)))
+    return lines
+
+
+def bench_parse(kernels, lines, sample_indices):
+    for line in lines:
+        site_coverage, alleles = kernels.parse_snv_line(line)
+        if kernels.count_covered(site_coverage, sample_indices, 5.0):
+            for _, _, counts in alleles:
+                kernels.allele_frequencies(counts, site_coverage, sample_indices, 5.0)
+
+
+def bench_depth(kernels, text, ref_lengths):
+    references = {ref: BAMReference('s', ref, length) for ref, length in ref_lengths.items()}
+    kernels.accumulate_depth(text, references)
+
+
+def frequencies(rng, shape, dtype):
+    values = rng.random(shape).astype(dtype)
+    values[rng.random(shape) < 0.2] = np.nan
+    return values
+
+
+def bench_diversity(kernels, values, runs):
+    for j in range(len(values)):
+        for i in range(j + 1):
+            kernels.pair_diversity(values[i], values[j], runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the compiled kernels against the pure-Python ones')
+    parser.add_argument('--repeat', type=int, default=3, help='best of REPEAT runs')
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    lines = snv_lines(rng, 20000, 50)
+    depth = ''.join('ref{}\t{}\t{}\n'.format(r, pos, (pos * 7) % 50)
+                    for r in range(3) for pos in range(1, 200001))
+    dist_values = frequencies(rng, (20, 20000), np.float64)
+    runs = rng.choice([1] * 19 + [2], size=5000).astype(np.intp)
+    div_values = frequencies(rng, (10, runs.sum()), np.float64)
+
+    cases = [
+        ('parse_snv_line + allele_frequencies (20k lines, 50 samples)',
+         lambda k: bench_parse(k, lines, list(range(0, 50, 2)))),
+        ('accumulate_depth (600k positions)',
+         lambda k: bench_depth(k, depth, {'ref0': 200000, 'ref1': 200000, 'ref2': 200000})),
+        ('pairwise_distances (20 samples, 20k positions)',
+         lambda k: k.pairwise_distances(dist_values)),
+        ('pairwise_distances float32',
+         lambda k: k.pairwise_distances(dist_values.astype(np.float32))),
+        ('pair_diversity (10 samples, 5k positions, 5% multi-allelic)',
+         lambda k: bench_diversity(k, div_values, runs)),
+    ]
+
+    print('{:<62} {:>10} {:>10} {:>8}'.format('kernel', 'python [s]', 'cython [s]', 'speedup'))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, fn in cases:
+            t_py = min(timeit.repeat(lambda: fn(python), number=1, repeat=args.repeat))
+            t_c = min(timeit.repeat(lambda: fn(_compiled), number=1, repeat=args.repeat))
+            print('{:<62} {:>10.4f} {:>10.4f} {:>7.1f}x'.format(name, t_py, t_c, t_py / t_c))
+
+
+if __name__ == '__main__':
+    main()
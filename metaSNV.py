@@ -8,11 +8,35 @@ from glob import glob
 import os
 import sys
 import shutil
+import tempfile
+import shlex
 import subprocess
 import multiprocessing
+import mmap
+
+from contextlib import contextmanager
 
 from metaSNV.utils import create_output_folder
-from metaSNV.bam_preprocessing import BAMInfo, write_legacy
+from metaSNV.bam_preprocessing import BAMInfo, depth_tasks, region_depth, write_legacy, write_sample_list, \
+    write_bed_header, legacy_values, read_legacy, write_legacy_columns, write_reference_lengths
+from metaSNV.splits import (plan_splits, write_splits, planned_splits, split_filepath,
+                            split_outputs, mark_done, merge_splits)
+from metaSNV.fileio import (COMPRESSION_SUFFIXES, CompressingFifo, compression_of, find_file, open_file,
+                            with_compression)
+from metaSNV.pruning import samples_of_interest, read_regions, calling_groups, write_regions, pad_calls
+from metaSNV.coverage_store import CoverageStoreWriter
+from metaSNV.profiling import profiled, summarize
+from metaSNV.pileup_coverage import PileupCoverage, relay_pileup_thread
+from metaSNV.read_groups import (MPILEUP_READ_GROUP_ARGS, parse_sample_entry, pileup_inputs, read_group_samples,
+                                 sample_entry, split_pileup_thread, uses_read_groups)
+from metaSNV.reference_cache import ALIGNMENT_SUFFIXES, is_cram, prepare as prepare_reference_cache
+from metaSNV.reference_index import index_path, is_current as is_current_index, write_index
+from metaSNV.scratch import Scratch, alignment_indexes, staged_output
+from metaSNV.service import SOCKET_FILENAME, Service, request, run_script
+from metaSNV.estimate import (bam_size, region_size, calling_size, calibrate, calibrated_stages, system_memory,
+                              write_report, estimate as estimate_stages)
+from functools import partial
+from itertools import chain
 from multiprocessing import Pool
 
 
@@ -38,34 +62,218 @@ def run_sample(sample, command):
     return sample, command, ret
 
 
-def execute_snp_call(args, snpCaller, ifile, ofile, bam_filepaths):
+def package_env():
+    '''Environment of subprocesses, with the metaSNV package importable (python -m metaSNV...)'''
+    pythonpath = os.environ.get('PYTHONPATH')
+    return dict(os.environ, PYTHONPATH=basedir + (os.pathsep + pythonpath if pythonpath else ''))
+
+
+def start_calling(samtools_cmd, snpcaller_cmd, stdout, read_groups=None, coverage=None):
+    '''Start samtools mpileup | snpCall, with the pileup split into the samples of their read groups on a
+    background thread if ``read_groups`` (files and number of samples, see pileup_inputs), and its depths
+    added to ``coverage`` (PileupCoverage) on the way'''
+    samtools_call = subprocess.Popen(samtools_cmd, stdout=subprocess.PIPE, env=package_env())
+    if read_groups is None and coverage is None:
+        snpcaller_call = subprocess.Popen(snpcaller_cmd, stdin=samtools_call.stdout, stdout=stdout)
+        samtools_call.stdout.close()
+        return snpcaller_call, None
+    snpcaller_call = subprocess.Popen(snpcaller_cmd, stdin=subprocess.PIPE, stdout=stdout)
+    if coverage is not None:
+        return snpcaller_call, relay_pileup_thread(samtools_call.stdout, snpcaller_call.stdin, coverage, read_groups)
+    return snpcaller_call, split_pileup_thread(samtools_call.stdout, snpcaller_call.stdin, *read_groups)
+
+
+def execute_snp_call(args, snpCaller, ifile, ofile, bam_filepaths, regions=None, coverage=None):
     db_ann_args = []
     if args.db_ann != '':
         db_ann_args = ['-g', args.db_ann]
+        # memory map the index of "metaSNV.py index" instead of reading both files in every snpCall
+        if is_current_index(args.ref_db, args.db_ann):
+            db_ann_args = ['-x', index_path(args.ref_db)]
+    region_args = []
+    if regions is not None:
+        region_args = ['-l', regions]
+    # lines of 'all_samples': samples of read groups are piled up per BAM file and split by read group
+    sample_entries = bam_filepaths
+    read_groups = None
+    read_group_args = []
+    if uses_read_groups(sample_entries):
+        bam_filepaths, files = pileup_inputs(sample_entries)
+        read_groups = (files, len(sample_entries))
+        read_group_args = MPILEUP_READ_GROUP_ARGS
     samtools_cmd = ['samtools',
                     'mpileup',
-                    '-f', args.ref_db, '-B', *bam_filepaths]
-    snpcaller_cmd = [
-        snpCaller, '-f', args.ref_db] + db_ann_args + [
+                    '-f', args.ref_db, '-B', *region_args, *read_group_args, *bam_filepaths]
+    if args.batch_size and len(bam_filepaths) > args.batch_size:
+        # one samtools process per batch of BAM files, merged (and split by read group) into one pileup
+        samtools_cmd = [sys.executable, '-m', 'metaSNV.batched_pileup', '--batch_size', str(args.batch_size),
+                        '-f', args.ref_db, *region_args, *sample_entries]
+        read_groups = None
+
+    def snpcaller_cmd(ifile):
+        return [snpCaller, '-f', args.ref_db] + db_ann_args + [
             '-i', ifile, '-c', str(args.min_pos_cov), '-t', str(args.min_pos_snvs)]
+
     if args.print_commands:
-        print(" ".join(samtools_cmd + ['|'] + snpcaller_cmd + ['>', ofile]))
-    else:
+        split_cmd = []
+        if read_groups is not None:
+            split_cmd = ['|', 'python', '-m', 'metaSNV.read_groups'] + [shlex.quote(entry) for entry in sample_entries]
+        print(" ".join([shlex.quote(arg) for arg in samtools_cmd] + split_cmd + ['|'] + snpcaller_cmd(ifile) +
+                       ['>', ofile]))
+    elif compression_of(ofile) == 'none' and compression_of(ifile) == 'none':
         with open(ofile, 'wt') as ofile:
-            samtools_call = subprocess.Popen(samtools_cmd, stdout=subprocess.PIPE)
-            snpcaller_call = subprocess.Popen(snpcaller_cmd, stdin=samtools_call.stdout, stdout=ofile)
-            samtools_call.stdout.close()
-            return snpcaller_call.wait()
+            snpcaller_call, splitter = start_calling(samtools_cmd, snpcaller_cmd(ifile), ofile, read_groups,
+                                                     coverage)
+            ret = snpcaller_call.wait()
+    else:
+        # snpCall writes plain text, compress both of its outputs on background threads
+        with CompressingFifo(ifile) as ififo, open_file(ofile, 'wb') as ofile:
+            snpcaller_call, splitter = start_calling(samtools_cmd, snpcaller_cmd(ififo.path), subprocess.PIPE,
+                                                     read_groups, coverage)
+            shutil.copyfileobj(snpcaller_call.stdout, ofile, 1024 * 1024)
+            ret = snpcaller_call.wait()
+    if args.print_commands:
+        return None
+    if splitter is not None:
+        splitter.join()
+    return ret
+
+
+def execute_pruned_snp_call(args, snpCaller, ifile, ofile, bam_filepaths, regions):
+    '''Call only the taxa and samples that pass the -b/-d/-m thresholds of metaSNV_Filtering.py.
+    References are called in groups that share the same qualifying samples, and the
+    calls are padded back to all samples (count 0) so that the output keeps its layout.'''
+    project_name = path.basename(args.project_dir)
+    cov_file = "{}/{}.all_cov.tab".format(args.project_dir, project_name)
+    perc_file = "{}/{}.all_perc.tab".format(args.project_dir, project_name)
+    try:
+        soi, header = samples_of_interest(find_file(cov_file) or cov_file, find_file(perc_file) or perc_file,
+                                          args.b, args.d, args.m)
+    except ValueError as e:
+        stderr.write("ERROR:  {}\n".format(e))
+        exit(1)
+    all_regions = read_regions(regions)
+    groups = calling_groups(all_regions, soi)
+    stderr.write("Pre-filter: calling {} of {} references in {} sample groups\n".format(
+        sum(len(group_regions) for _, group_regions in groups), len(all_regions), len(groups)))
+
+    tmp_dir = tempfile.mkdtemp(prefix='.pruned_', dir=path.dirname(ofile))
+    tasks = []
+    for k, (samples, group_regions) in enumerate(groups):
+        regions_file = path.join(tmp_dir, 'regions_{}'.format(k))
+        write_regions(regions_file, group_regions)
+        group_bams = [bam_filepaths[header.index(sample)] for sample in samples]
+        tasks.append((args, snpCaller, path.join(tmp_dir, 'indiv_{}'.format(k)),
+                      path.join(tmp_dir, 'called_{}'.format(k)), group_bams, regions_file))
+
+    if args.print_commands:
+        # the region files are kept for the printed commands
+        for task in tasks:
+            execute_snp_call(*task)
+        return None
+
+    try:
+        with Pool(args.threads, init_worker) as p:
+            rets = p.starmap(profiled(execute_snp_call, args.profile, args.profile_memory, calling_size), tasks)
+        if any(rets):
+            return max(rets)
+        with open_file(ofile, 'wt') as called_out, open_file(ifile, 'wt') as indiv_out:
+            for (samples, _), task in zip(groups, tasks):
+                columns = [header.index(sample) for sample in samples]
+                pad_calls(task[3], called_out, columns, len(header))
+                pad_calls(task[2], indiv_out, columns, len(header))
+        return 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def use_reference_cache(args, entries):
+    '''Decode the CRAM files among BAM files (or lines of all_samples) with the reference cache of ref_db'''
+    filepaths = [filepath for entry in entries for filepath in parse_sample_entry(entry)[0]]
+    if not any(is_cram(filepath) for filepath in filepaths):
+        return
+    if not args.ref_db:
+        stderr.write("ERROR:  CRAM files need the reference database they were encoded with (--ref_db)\n")
+        exit(1)
+    try:
+        prepare_reference_cache(filepaths, args.ref_db, args.ref_cache)
+    except ValueError as e:
+        stderr.write("ERROR:  {}\n".format(e))
+        exit(1)
 
 
-def snp_call(args, bam_filepaths):
+@contextmanager
+def scratch_staging(args):
+    '''Stage the BAM files and SNV calls of the block on --scratch (args.staging, None without --scratch)'''
+    if not args.scratch or getattr(args, 'print_commands', False):
+        args.staging = None
+        yield None
+        return
+    limit = int(args.scratch_limit * 2 ** 30) if args.scratch_limit is not None else None
+    # the files read by the workers and as many copied ahead
+    with Scratch(args.scratch, limit, lookahead=2 * args.threads) as scratch:
+        args.staging = scratch
+        try:
+            yield scratch
+        finally:
+            args.staging = None
+
+
+def staged_inputs(args, bam_filepaths, release=False):
+    '''Paths to read BAM files from, staged on --scratch ahead of use (lazily, see Scratch.fetched). With
+    ``release``, every file is passed to release_input once read, and its copy is removed when space is needed.'''
+    if getattr(args, 'staging', None) is None:
+        return iter(bam_filepaths)
+    args.staging.prefetch(bam_filepaths, alignment_indexes, release=release)
+    return args.staging.fetched(bam_filepaths)
+
+
+def release_input(args, filepath):
+    '''Let --scratch remove the copy of a BAM file (by its local path) that has been read'''
+    if getattr(args, 'staging', None) is not None:
+        args.staging.release(args.staging.original(filepath))
+
+
+def staged_entries(args, entries):
+    '''Lines of all_samples with the paths of their BAM files staged on --scratch'''
+    if getattr(args, 'staging', None) is None:
+        return entries
+    parsed = [parse_sample_entry(entry) for entry in entries]
+    local = staged_inputs(args, [filepath for filepaths, _ in parsed for filepath in filepaths])
+    return [sample_entry([next(local) for _ in filepaths], sample) for filepaths, sample in parsed]
+
+
+def original_paths(args, results):
+    '''Point BAMInfo of staged BAM files back to the files of INPUT_DIR'''
+    if getattr(args, 'staging', None) is None:
+        return results
+    for bam_info in results:
+        bam_info.filepath = args.staging.original(bam_info.filepath)
+        if bam_info.read_group_files is not None:
+            bam_info.read_group_files = [args.staging.original(filepath) for filepath in bam_info.read_group_files]
+    return results
+
+
+def scratch_output(args, filepath):
+    '''Path to write an output to, on --scratch and moved to ``filepath`` at the end of the block'''
+    return staged_output(filepath, args.staging.directory if getattr(args, 'staging', None) else None)
+
+
+def snp_call(args, bam_filepaths, split=None, coverage=None):
+    use_reference_cache(args, bam_filepaths)
+    bam_filepaths = staged_entries(args, bam_filepaths)
     out_dir = path.join(args.project_dir, 'snpCaller')
     os.makedirs(out_dir, exist_ok=True)
 
     snpCaller = basedir + "/metaSNV/snpCaller/snpCall"
 
-    indiv_out = path.join(out_dir, "indiv_called")
-    called_SNP = path.join(out_dir, "called_SNPs")
+    if split is None:
+        indiv_out = with_compression(path.join(out_dir, "indiv_called"), args.compression)
+        called_SNP = with_compression(path.join(out_dir, "called_SNPs"), args.compression)
+        regions = None
+    else:
+        called_SNP, indiv_out = split_outputs(args.project_dir, split, args.compression)
+        regions = split_filepath(args.project_dir, split)
 
 
 # # ACTUAL COMMANDLINE
@@ -73,40 +281,590 @@ def snp_call(args, bam_filepaths):
 #       Note: Different phred score scales might be disregarded.
 #       Note: If samtools > v0.1.18 is used -Q 20 filtering is highly recommended.
 
-    v = execute_snp_call(args, snpCaller, indiv_out, called_SNP, bam_filepaths)
+    with scratch_output(args, indiv_out) as local_indiv, scratch_output(args, called_SNP) as local_called:
+        if args.prefilter:
+            v = execute_pruned_snp_call(args, snpCaller, local_indiv, local_called, bam_filepaths,
+                                        regions or path.join(args.project_dir, 'bed_header'))
+        else:
+            v = profiled(execute_snp_call, args.profile, args.profile_memory, calling_size)(
+                args, snpCaller, local_indiv, local_called, bam_filepaths, regions, coverage=coverage)
     if v is not None:
         if v > 0:
             stderr.write("SNV calling failed")
             exit(1)
+        if split is not None:
+            mark_done(args.project_dir, split)
+
+
+def coverage_by_region(pool, bam_filepaths, n_partitions, store, args):
+    '''Coverage of every BAM file computed in partitions of its references on all workers of ``pool``
+    (``bam_filepaths`` is read as the workers need new tasks)'''
+    file_tasks = []
+
+    def tasks():
+        for filepath in bam_filepaths:
+            filepath_tasks = depth_tasks(filepath, n_partitions)
+            file_tasks.append((filepath, len(filepath_tasks)))
+            yield from filepath_tasks
+
+    depths = pool.imap(profiled(region_depth, args.profile, args.profile_memory, region_size), tasks())
+    results = []
+    for first in depths:
+        # the tasks of the file of the first result have been queued
+        filepath, n_tasks = file_tasks[len(results)]
+        # partial results are combined while the workers compute the next ones
+        bam_info = BAMInfo.from_depth(filepath, chain([first], (next(depths) for _ in range(n_tasks - 1))))
+        release_input(args, filepath)
+        if store is not None:
+            store.write_sample(bam_info.sample, bam_info.references)
+        results.append(bam_info)
+    return results
+
+
+def list_bam_files(input_folder):
+    files = sorted([f for f in os.listdir(input_folder) if f.endswith(ALIGNMENT_SUFFIXES)])
+    return [os.path.join(input_folder, f) for f in files]
+
+
+def merge_samples(infos):
+    '''BAMInfo of every read group sample, merged over its BAM files'''
+    samples = {}
+    for info in infos:
+        samples.setdefault(info.sample, []).append(info)
+    return [BAMInfo.merge(sample_infos) for sample_infos in samples.values()]
+
+
+def read_group_files(bam_filepaths, args):
+    '''BAM files with read groups, covered and called per read group sample with --read_groups'''
+    return [filepath for filepath in bam_filepaths if read_group_samples(filepath)] if args.read_groups else []
+
+
+def check_samples(results):
+    samples = [bam_info.sample for bam_info in results]
+    duplicates = sorted({sample for sample in samples if samples.count(sample) > 1})
+    if duplicates:
+        stderr.write("ERROR:  Several BAM files or read groups of the same sample: {}\n".format(', '.join(duplicates)))
+        exit(1)
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Compute SNV profiles')
+def read_group_coverage(pool, bam_filepaths, store, args):
+    '''Coverage of the samples of the read groups of BAM files, merged over the files of every sample'''
+    queued = []
+
+    def tasks():
+        for filepath in bam_filepaths:
+            queued.append(filepath)
+            yield filepath
+
+    infos = []
+    for file_infos in pool.imap(profiled(BAMInfo.from_read_groups, args.profile, args.profile_memory, bam_size),
+                                tasks()):
+        release_input(args, queued[len(infos)])
+        infos.append(file_infos)
+    results = merge_samples(info for file_infos in infos for info in file_infos)
+    if store is not None:
+        for bam_info in results:
+            store.write_sample(bam_info.sample, bam_info.references)
+    return results
+
+
+def bam_coverage(bam_filepaths, store, args):
+    '''Coverage of BAM files on --threads workers, per sample of their read groups with --read_groups'''
+    use_reference_cache(args, bam_filepaths)
+    grouped = read_group_files(bam_filepaths, args)
+    bam_filepaths = [filepath for filepath in bam_filepaths if filepath not in grouped]
+    # with fewer BAM files than threads, indexed BAM files are split by reference regions
+    n_partitions = -(-args.threads // len(bam_filepaths)) if bam_filepaths else 1
+    # with --scratch, BAM files are copied to scratch ahead of the workers reading them, and removed once read
+    local_filepaths = staged_inputs(args, bam_filepaths + grouped, release=True)
+    local_ungrouped = (next(local_filepaths) for _ in bam_filepaths)
+    with Pool(args.threads) as p:
+        if n_partitions > 1:
+            results = coverage_by_region(p, local_ungrouped, n_partitions, store, args)
+        else:
+            results = []
+            for bam_info in p.imap(profiled(partial(BAMInfo.from_bam, store=store), args.profile,
+                                            args.profile_memory, bam_size), local_ungrouped):
+                release_input(args, bam_info.filepath)
+                results.append(bam_info)
+        if grouped:
+            results += read_group_coverage(p, local_filepaths, store, args)
+    results = original_paths(args, results)
+    check_samples(results)
+    return results
+
+
+def sample_headers(bam_filepaths, args):
+    '''Samples of BAM files as by bam_coverage, with the lengths of their references but without coverage'''
+    grouped = read_group_files(bam_filepaths, args)
+    results = [BAMInfo.from_header(filepath) for filepath in bam_filepaths if filepath not in grouped]
+    results += merge_samples(info for filepath in grouped for info in BAMInfo.read_group_headers(filepath))
+    check_samples(results)
+    return results
+
+
+def compute_coverage(args):
+    '''Compute the coverage of all BAM files and write the coverage tables,
+    the sample list and the reference lengths of the project'''
+    bam_filepaths = list_bam_files(args.input_folder)
+    store = CoverageStoreWriter(path.join(args.project_dir, 'coverage_store')) if args.coverage_store else None
+    results = bam_coverage(bam_filepaths, store, args)
+
+    results_dict = {bam_info.sample : bam_info for bam_info in results}
+    # sort by key
+    results_dict = {k: results_dict[k] for k in sorted(results_dict)}
+
+    depth_table, breadth_table = coverage_tables(args.project_dir)
+    write_legacy(results_dict, with_compression(depth_table, args.compression), "depth")
+    write_legacy(results_dict, with_compression(breadth_table, args.compression), "breadth")
+    write_sample_list(results_dict, path.join(args.project_dir, 'all_samples'))
+    write_bed_header(results_dict, path.join(args.project_dir, 'bed_header'))
+    if store is not None:
+        store.write_index(list(results_dict),
+                          {ref: bam_ref.length for bam_info in results_dict.values()
+                           for ref, bam_ref in bam_info.references.items()})
+
+    return results_dict
+
+
+def single_pass(args):
+    '''Call SNVs and compute the coverage tables from the same pileup, reading the BAM files once'''
+    bam_filepaths = list_bam_files(args.input_folder)
+    use_reference_cache(args, bam_filepaths)
+    results = sample_headers(bam_filepaths, args)
+    results_dict = {bam_info.sample: bam_info for bam_info in sorted(results, key=lambda bam_info: bam_info.sample)}
+
+    coverage = PileupCoverage(len(results_dict))
+    snp_call(args, [bam_info.entry for bam_info in results_dict.values()], coverage=coverage)
+
+    lengths = {ref: bam_ref.length for bam_info in results_dict.values()
+               for ref, bam_ref in bam_info.references.items()}
+    for mode, table in zip(['depth', 'breadth'], coverage_tables(args.project_dir)):
+        write_legacy_columns({sample: coverage.legacy_values(column, lengths, mode)
+                              for column, sample in enumerate(results_dict)},
+                             with_compression(table, args.compression), mode)
+    write_sample_list(results_dict, path.join(args.project_dir, 'all_samples'))
+    write_bed_header(results_dict, path.join(args.project_dir, 'bed_header'))
+    return results_dict
+
+
+def read_sample_list(project_dir):
+    with open(path.join(project_dir, 'all_samples')) as f:
+        return f.read().splitlines()
+
+
+def coverage_tables(project_dir):
+    project_name = path.basename(project_dir)
+    return ("{}/{}.all_cov.tab".format(project_dir, project_name),
+            "{}/{}.all_perc.tab".format(project_dir, project_name))
+
+
+def sample_name(entry):
+    '''Sample of a line of all_samples'''
+    filepaths, sample = parse_sample_entry(entry)
+    return sample or BAMInfo(filepaths[0]).sample
+
+
+def load_project(args):
+    '''Coverage tables, samples and reference lengths of a project, empty for a new project'''
+    depth_table, breadth_table = (find_file(table) for table in coverage_tables(args.project_dir))
+    bed_header = path.join(args.project_dir, 'bed_header')
+    samples = read_sample_list(args.project_dir) if path.isfile(path.join(args.project_dir, 'all_samples')) else []
+    return {'depth': read_legacy(depth_table) if depth_table else {},
+            'breadth': read_legacy(breadth_table) if breadth_table else {},
+            'samples': {sample_name(entry): entry for entry in samples},
+            'lengths': dict(read_regions(bed_header)) if path.isfile(bed_header) else {}}
+
+
+def add_samples(args, project, bam_filepaths):
+    '''Compute the coverage of BAM files and add it to the coverage tables, the sample list and the
+    reference lengths of a project (see load_project), replacing samples of the same name'''
+    store = CoverageStoreWriter(path.join(args.project_dir, 'coverage_store')) if args.coverage_store else None
+    results = bam_coverage(bam_filepaths, store, args)
+
+    entries = dict(project['samples'])
+    lengths = dict(project['lengths'])
+    columns = {'depth': dict(project['depth']), 'breadth': dict(project['breadth'])}
+    for bam_info in results:
+        entries[bam_info.sample] = bam_info.entry
+        lengths.update({ref: bam_ref.length for ref, bam_ref in bam_info.references.items()})
+        for mode in columns:
+            columns[mode][bam_info.sample] = legacy_values(bam_info, mode)
+    # same tables as for computing the coverage of all samples at once
+    samples = sorted(entries)
+    for mode, table in zip(['depth', 'breadth'], coverage_tables(args.project_dir)):
+        previous = find_file(table)
+        table = with_compression(table, args.compression)
+        write_legacy_columns({sample: columns[mode][sample] for sample in samples}, table, mode)
+        if previous is not None and previous != table:
+            os.remove(previous)
+    with open(path.join(args.project_dir, 'all_samples'), 'w') as f:
+        for sample in samples:
+            f.write(entries[sample] + '\n')
+    write_reference_lengths(lengths, path.join(args.project_dir, 'bed_header'))
+    if store is not None:
+        store.write_index(samples, lengths)
+
+
+def add_read_groups_argument(parser):
+    '''--read_groups, shared by the commands computing coverage'''
+    parser.add_argument('--read_groups', default=False, action='store_true',
+                        help=('Treat every sample (SM tag) of the read groups of a BAM file as a sample of its own, '
+                              'instead of the whole file. BAM files without read groups are still one sample each; '
+                              'a sample can span several BAM files. Needs samtools >= 1.13.'))
+
+
+def add_reference_cache_argument(parser):
+    '''--ref_cache, shared by the commands reading CRAM files'''
+    parser.add_argument('--ref_cache', metavar='DIR', default=None,
+                        help=('Cache of the sequences of the reference database for decoding CRAM input files, '
+                              'shared by all workers and runs (default: ref_cache/ next to the reference database).'))
+
+
+def add_scratch_arguments(parser):
+    '''--scratch and --scratch_limit, shared by the commands reading BAM files'''
+    parser.add_argument('--scratch', metavar='DIR', default=None,
+                        help=('Node-local directory (e.g. $TMPDIR) to copy the BAM files and their indexes to ahead '
+                              'of use, while earlier files are processed, and to write the SNV calls to before '
+                              'moving them into DIR atomically. Coverage copies at most 2 x --threads files ahead '
+                              'and removes copies once read and their space is needed.'))
+    parser.add_argument('--scratch_limit', metavar='GB', default=None, type=float,
+                        help=('Most space the BAM files copied to --scratch may use (default: 80%% of the free '
+                              'space of --scratch). SNV calling reads all BAM files at once, so the files that do '
+                              'not fit together are read in place.'))
+
+
+def add_calling_arguments(parser):
+    '''Options of coverage and SNV calling, shared by metaSNV.py and metaSNV.py serve'''
+    parser.add_argument('--db_ann', metavar='DB_ANN_FILE', default='',
+                        help='Database gene annotation.')
+    parser.add_argument('--threads', metavar='INT', default=1, type=int,
+                        help=('Number of jobs to run simmultaneously. '
+                              'Will create same number of splits, unless n_splits set differently.'))
+    parser.add_argument('--min_pos_cov', metavar='INT', default=4, type=int,
+                        help='minimum coverage (mapped reads) per position for snpCall.')
+    parser.add_argument('--min_pos_snvs', metavar='INT', default=4, type=int,
+                        help='minimum number of non-reference nucleotides per position for snpCall.')
+    parser.add_argument('--compression', choices=list(COMPRESSION_SUFFIXES), default='none',
+                        help=('Compression of the coverage tables and SNV calls. '
+                              'Compressed files are written on background threads.'))
+    parser.add_argument('--coverage_store', default=False, action='store_true',
+                        help=('Also keep the per-position depth of every sample in DIR/coverage_store/, '
+                              'chunked and compressed (read with metaSNV.coverage_store.CoverageStore).'))
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help=('Profile every worker task (cProfile) into DIR and summarise the whole run '
+                              'in DIR/summary.txt.'))
+    parser.add_argument('--profile_memory', default=False, action='store_true',
+                        help='With --profile, also record tracemalloc snapshots of every worker task.')
+    parser.add_argument('--prefilter', default=False, action='store_true',
+                        help=('Only call the taxa and samples that pass the coverage thresholds -b, -d and -m '
+                              '(as in metaSNV_Filtering.py). Positions are called from the reads of the qualifying '
+                              'samples only, so positions that reach --min_pos_cov or --min_pos_snvs only with the '
+                              'reads of other samples are not called. Other samples get a count of 0.'))
+    add_read_groups_argument(parser)
+    add_reference_cache_argument(parser)
+    add_scratch_arguments(parser)
+    parser.add_argument('--batch_size', metavar='INT', default=0, type=int,
+                        help=('Pile up at most INT BAM files per samtools process and merge their pileups, to bound '
+                              'the open files and memory per process for large cohorts (0: all files at once).'))
+    parser.add_argument('-b', metavar='FLOAT', type=float, default=40.0,
+                        help='Pre-filter: minimal horizontal genome coverage percentage per sample per species')
+    parser.add_argument('-d', metavar='FLOAT', type=float, default=5.0,
+                        help='Pre-filter: minimal average vertical genome coverage per sample per species')
+    parser.add_argument('-m', metavar='INT', type=int, default=2,
+                        help='Pre-filter: minimum number of samples per species')
+
+
+def plan(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py plan',
+                                     description=('Compute coverage and split the references into '
+                                                  'bestsplits/ for calling with "metaSNV.py --split"'))
     parser.add_argument('project_dir', metavar='DIR',
                         help='The output directory that metaSNV will create e.g. "outputs". Can be a path.')
     parser.add_argument('input_folder', metavar='INPUT_DIR',
                         help='File with an input list of bam files, one file per line')
+    parser.add_argument('--threads', metavar='INT', default=1, type=int,
+                        help='Number of BAM files to process simmultaneously.')
+    parser.add_argument('--n_splits', metavar='INT', default=1, type=int,
+                        help='Number of bins to split ref into')
+    parser.add_argument('--compression', choices=list(COMPRESSION_SUFFIXES), default='none',
+                        help='Compression of the coverage tables.')
+    parser.add_argument('--coverage_store', default=False, action='store_true',
+                        help=('Also keep the per-position depth of every sample in DIR/coverage_store/, '
+                              'chunked and compressed (read with metaSNV.coverage_store.CoverageStore).'))
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help=('Profile every worker task (cProfile) into DIR and summarise the whole run '
+                              'in DIR/summary.txt.'))
+    parser.add_argument('--profile_memory', default=False, action='store_true',
+                        help='With --profile, also record tracemalloc snapshots of every worker task.')
+    add_read_groups_argument(parser)
+    parser.add_argument('--ref_db', metavar='REF_DB_FILE', default=None,
+                        help='Reference database the CRAM files of INPUT_DIR were encoded with.')
+    add_reference_cache_argument(parser)
+    add_scratch_arguments(parser)
+    args = parser.parse_args(argv)
+    args.project_dir = args.project_dir.rstrip('/')
+
+    create_output_folder(args.project_dir)
+    with scratch_staging(args):
+        results_dict = compute_coverage(args)
+    splits = plan_splits(results_dict, args.n_splits)
+    write_splits(args.project_dir, splits)
+    for i in range(len(splits)):
+        print(split_filepath(args.project_dir, i))
+    if args.profile:
+        print("Profile summary: {}".format(summarize(args.profile)))
+
+
+def print_estimates(project_dir, input_folder, cores, memory, b, d, m, calibration):
+    calibration = [directory for directory in calibration if path.isdir(directory)]
+    try:
+        estimates, taxa = estimate_stages(project_dir, input_folder, cores, memory, b, d, m, calibrate(calibration))
+    except ValueError as e:
+        stderr.write("ERROR:  {}\n".format(e))
+        exit(1)
+    calibrated = calibrated_stages(calibration)
+    print("Estimates for {} cores and {:.1f} GB, {}\n".format(
+        cores, memory / 2 ** 30,
+        "calibrated on earlier runs for: {}".format(', '.join(calibrated)) if calibrated else "default rates"))
+    write_report(estimates, taxa, sys.stdout)
+
+
+def estimate(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py estimate',
+                                     description=('Predict the runtime and peak memory of every stage and recommend '
+                                                  'parallelism settings, without running anything'))
+    parser.add_argument('project_dir', metavar='DIR',
+                        help=('The metaSNV output directory. Coverage tables, SNV calls and filtered frequencies '
+                              'of stages that already ran are used when present.'))
+    parser.add_argument('input_folder', metavar='INPUT_DIR',
+                        help='Directory with the BAM files')
+    parser.add_argument('--cores', metavar='INT', default=os.cpu_count(), type=int,
+                        help='Number of cores available to the jobs.')
+    parser.add_argument('--memory', metavar='GB', default=system_memory() / 2 ** 30, type=float,
+                        help='Memory available to the jobs.')
+    parser.add_argument('--calibrate', metavar='DIR', default=[], action='append',
+                        help=('--profile directory of an earlier run to calibrate the rates of its stages on. '
+                              'Can be repeated.'))
+    parser.add_argument('-b', metavar='FLOAT', type=float, default=40.0,
+                        help='Filtering: minimal horizontal genome coverage percentage per sample per species')
+    parser.add_argument('-d', metavar='FLOAT', type=float, default=5.0,
+                        help='Filtering: minimal average vertical genome coverage per sample per species')
+    parser.add_argument('-m', metavar='INT', type=int, default=2,
+                        help='Filtering: minimum number of samples per species')
+    args = parser.parse_args(argv)
+    print_estimates(args.project_dir.rstrip('/'), args.input_folder, args.cores, args.memory * 2 ** 30,
+                    args.b, args.d, args.m, args.calibrate)
+
+
+def hold_index(args):
+    '''Write the snpCall index of the reference database and annotation (as "metaSNV.py index") unless it is
+    current, and map it into memory'''
+    for filepath in [args.ref_db, args.db_ann]:
+        if not path.isfile(filepath):
+            stderr.write("ERROR:  '{}' is not a file.\n".format(filepath))
+            exit(1)
+    if not is_current_index(args.ref_db, args.db_ann):
+        print("Wrote {}".format(write_index(args.ref_db, args.db_ann)))
+    with open(index_path(args.ref_db), 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_WILLNEED'):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    return mapped
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py serve',
+                                     description=('Run jobs submitted with "metaSNV.py submit" on a project, with the '
+                                                  'pipeline and the coverage of the project loaded once'))
+    parser.add_argument('project_dir', metavar='DIR',
+                        help='The output directory of the project, created if needed.')
     parser.add_argument("ref_db", metavar='REF_DB_FILE',
                         help='reference multi-sequence FASTA file used for the alignments.')
-    parser.add_argument('--db_ann', metavar='DB_ANN_FILE', default='',
+    parser.add_argument('--socket', metavar='PATH', default=None,
+                        help='Unix socket to listen on (default: DIR/{}).'.format(SOCKET_FILENAME))
+    add_calling_arguments(parser)
+    args = parser.parse_args(argv)
+    args.project_dir = args.project_dir.rstrip('/')
+    args.input_folder = None
+    args.print_commands = False
+    create_output_folder(args.project_dir)
+
+    # imported once for all jobs
+    import metaSNV_Filtering
+    import metaSNV_DistDiv
+
+    # the index snpCall memory maps in every call job, mapped here too so that its pages stay cached
+    reference_index = hold_index(args) if args.db_ann else None
+    project = {}
+
+    def refresh():
+        project.update(load_project(args))
+
+    def coverage(job_argv):
+        bam_filepaths = []
+        for filepath in job_argv:
+            bam_filepaths.extend(list_bam_files(filepath) if path.isdir(filepath) else [filepath])
+        with scratch_staging(args):
+            add_samples(args, project, bam_filepaths)
+
+    def call(job_argv):
+        if job_argv:
+            exit("ERROR:  'call' takes no arguments, it calls all samples of the project")
+        with scratch_staging(args):
+            snp_call(args, read_sample_list(args.project_dir))
+
+    def filter_species(job_argv):
+        run_script(metaSNV_Filtering.__file__)(job_argv + [args.project_dir])
+
+    def distdiv(job_argv):
+        if '--filt' not in job_argv:
+            job_argv = ['--filt', path.join(args.project_dir, 'filtered', 'pop')] + job_argv
+        run_script(metaSNV_DistDiv.__file__)(job_argv)
+
+    service = Service(args.project_dir,
+                      {'coverage': coverage,
+                       'call': call,
+                       'filter': filter_species,
+                       'distdiv': distdiv},
+                      socket_path=args.socket, refresh=refresh, refresh_after=['coverage'])
+    print("Serving {} on {}".format(args.project_dir, service.socket_path))
+    service.serve_forever()
+    if reference_index is not None:
+        reference_index.close()
+
+
+def submit(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py submit',
+                                     usage='%(prog)s [-h] [--socket PATH] [--wait] [--jobs] [--shutdown] DIR [JOB ...]',
+                                     description='Submit a job to "metaSNV.py serve"',
+                                     epilog=('Jobs: "coverage BAM|DIR..." adds (or replaces) samples to the coverage '
+                                             'tables of the project, "call" calls SNVs of all samples, "filter '
+                                             '[OPTIONS]" runs metaSNV_Filtering.py and "distdiv [OPTIONS]" runs '
+                                             'metaSNV_DistDiv.py (--filt defaults to DIR/filtered/pop) on the '
+                                             'project.'))
+    parser.add_argument('project_dir', metavar='DIR',
+                        help='The output directory of the served project.')
+    parser.add_argument('--socket', metavar='PATH', default=None,
+                        help='Unix socket of the service (default: DIR/{}).'.format(SOCKET_FILENAME))
+    parser.add_argument('--wait', default=False, action='store_true',
+                        help='Wait for the job to finish, print its output and exit with its status.')
+    parser.add_argument('--jobs', default=False, action='store_true',
+                        help='List the jobs of the service.')
+    parser.add_argument('--shutdown', default=False, action='store_true',
+                        help='Stop the service once the queued jobs are finished.')
+    parser.add_argument('job', nargs=argparse.REMAINDER,
+                        help='Job and its arguments (after DIR, so options of submit go before DIR).')
+    args = parser.parse_args(argv)
+    socket_path = args.socket or path.join(args.project_dir.rstrip('/'), SOCKET_FILENAME)
+
+    try:
+        if args.job:
+            job = request(socket_path, {'submit': args.job[0], 'argv': args.job[1:]})
+            if 'error' in job:
+                stderr.write("ERROR:  {}\n".format(job['error']))
+                exit(1)
+            print("Job {} queued, output in {}".format(job['id'], job['log']))
+            if args.wait:
+                job = request(socket_path, {'wait': job['id']})
+                with open(job['log']) as f:
+                    sys.stdout.write(f.read())
+                if job['returncode'] != 0:
+                    exit(job['returncode'] if job['returncode'] > 0 else 1)
+        if args.jobs:
+            for job in request(socket_path, {'jobs': None})['jobs']:
+                print("{}\t{}\t{}\t{}".format(job['id'], job['state'], job['returncode'],
+                                               ' '.join([job['kind']] + job['argv'])))
+        if args.shutdown:
+            request(socket_path, {'shutdown': None})
+    except (ConnectionError, FileNotFoundError):
+        stderr.write("ERROR:  No service listening on '{}'\n\nSOLUTION: run \"metaSNV.py serve\" first\n\n".format(
+            socket_path))
+        exit(1)
+
+
+def merge(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py merge',
+                                     description='Check that all splits completed and merge their SNV calls')
+    parser.add_argument('project_dir', metavar='DIR',
+                        help='The metaSNV output directory.')
+    args = parser.parse_args(argv)
+
+    try:
+        splits = merge_splits(args.project_dir.rstrip('/'))
+    except ValueError as e:
+        stderr.write("ERROR:  {}\n".format(e))
+        exit(1)
+    print("Merged {} splits".format(len(splits)))
+
+
+def index(argv):
+    parser = argparse.ArgumentParser(prog='metaSNV.py index',
+                                     description=('Index the reference database and its gene annotation once for '
+                                                  'snpCall, which memory maps the index instead of reading both '
+                                                  'files on every run and split'))
+    parser.add_argument("ref_db", metavar='REF_DB_FILE',
+                        help='reference multi-sequence FASTA file used for the alignments.')
+    parser.add_argument('db_ann', metavar='DB_ANN_FILE',
                         help='Database gene annotation.')
+    args = parser.parse_args(argv)
+
+    for filepath in [args.ref_db, args.db_ann]:
+        if not path.isfile(filepath):
+            stderr.write("ERROR:  '{}' is not a file.\n".format(filepath))
+            exit(1)
+    print("Wrote {}".format(write_index(args.ref_db, args.db_ann)))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'plan':
+        return plan(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        return merge(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'index':
+        return index(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'estimate':
+        return estimate(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return serve(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'submit':
+        return submit(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Compute SNV profiles',
+                                     epilog=('To run the splits as independent jobs: "metaSNV.py plan DIR INPUT_DIR '
+                                             '--n_splits N", then "metaSNV.py DIR INPUT_DIR REF_DB --split i" for '
+                                             'every split, then "metaSNV.py merge DIR".'))
+    parser.add_argument('project_dir', metavar='DIR',
+                        help='The output directory that metaSNV will create e.g. "outputs". Can be a path.')
+    parser.add_argument('input_folder', metavar='INPUT_DIR',
+                        help='File with an input list of bam files, one file per line')
+    parser.add_argument("ref_db", metavar='REF_DB_FILE',
+                        help='reference multi-sequence FASTA file used for the alignments.')
     parser.add_argument('--print-commands', default=False, action='store_true',
                         help='Instead of executing the commands, simply print them out')
-    parser.add_argument('--threads', metavar='INT', default=1, type=int,
-                        help=('Number of jobs to run simmultaneously. '
-                              'Will create same number of splits, unless n_splits set differently.'))
+    parser.add_argument('--dry-run', default=False, action='store_true',
+                        help=('Instead of running, predict the runtime and memory of every stage and recommend '
+                              'parallelism settings (see "metaSNV.py estimate"), calibrated on --profile DIR '
+                              'of earlier runs if it exists.'))
     parser.add_argument('--n_splits', metavar='INT', default=1, type=int,
                         help='Number of bins to split ref into')
     parser.add_argument('--use_prev_cov', default=False, action="store_true",
                         help=('Use "cov/" and "outputs.all_cov.tab" and "outputs.all_perc.tab" '
                               'data produced by previous metaSNV run'))
-    parser.add_argument('--min_pos_cov', metavar='INT', default=4, type=int,
-                        help='minimum coverage (mapped reads) per position for snpCall.')
-    parser.add_argument('--min_pos_snvs', metavar='INT', default=4, type=int,
-                        help='minimum number of non-reference nucleotides per position for snpCall.')
-
+    parser.add_argument('--split', metavar='INT', default=None, type=int,
+                        help=('Only call SNVs in split INT written by "metaSNV.py plan" '
+                              '(coverage is not recomputed).'))
+    parser.add_argument('--single_pass', default=False, action='store_true',
+                        help=('Compute the coverage tables from the pileup of the SNV calling, reading the BAM files '
+                              'once instead of twice. Depths are counted as samtools mpileup counts them (with its '
+                              'quality filters and depth cap), so they can differ slightly from samtools depth.'))
+
+    add_calling_arguments(parser)
     args = parser.parse_args()
     args.project_dir = args.project_dir.rstrip('/')
+    if args.dry_run:
+        return print_estimates(args.project_dir, args.input_folder, os.cpu_count(), system_memory(),
+                               args.b, args.d, args.m, [args.profile] if args.profile else [])
     if not path.isfile(args.ref_db):
         stderr.write('''
 ERROR:	No reference database or annotation file found!"
@@ -131,9 +889,31 @@ ERROR:  Samtools is not installed or couldn't be found.
 SOLUTION: Install samtools or add it to $PATH\n\n''')
         exit(1)
 
+    if args.single_pass:
+        conflicts = [option for option, value in [('--split', args.split is not None), ('--prefilter', args.prefilter),
+                                                  ('--coverage_store', args.coverage_store),
+                                                  ('--print-commands', args.print_commands)] if value]
+        if conflicts:
+            stderr.write("ERROR:  --single_pass cannot be combined with {}\n".format(', '.join(conflicts)))
+            exit(1)
+
     if args.threads > 1 and args.n_splits == 1:
         args.n_splits = args.threads
 
+    if args.split is not None:
+        if args.split not in planned_splits(args.project_dir):
+            stderr.write('''
+ERROR:  Split {} not found in '{}'
+
+SOLUTION: run "metaSNV.py plan" first\n\n'''.format(args.split, path.join(args.project_dir, 'bestsplits')))
+            exit(1)
+        # same sample order as the coverage tables written by the plan
+        with scratch_staging(args):
+            snp_call(args, read_sample_list(args.project_dir), split=args.split)
+        if args.profile:
+            print("Profile summary: {}".format(summarize(args.profile)))
+        return
+
     create_output_folder(args.project_dir)
 
     # if not args.use_prev_cov:
@@ -143,20 +923,17 @@ SOLUTION: Install samtools or add it to $PATH\n\n''')
     # get_header(args)
 
     # alternative
-    files = sorted([f for f in os.listdir(args.input_folder) if f.endswith('.bam')])
-    bam_filepaths = [os.path.join(args.input_folder, f) for f in files]
-    with Pool(args.threads) as p:
-        results = p.map(BAMInfo.from_bam, bam_filepaths)
-
-    results_dict = {bam_info.sample : bam_info for bam_info in results}
-    # sort by key
-    results_dict = {k: results_dict[k] for k in sorted(results_dict)}
-
-    project_name = path.basename(args.project_dir)
-    write_legacy(results_dict, "{}/{}.all_cov.tab".format(args.project_dir, project_name), "depth")
-    write_legacy(results_dict, "{}/{}.all_perc.tab".format(args.project_dir, project_name), "breadth")
-
-    snp_call(args, bam_filepaths)
+    with scratch_staging(args):
+        if args.single_pass:
+            single_pass(args)
+        else:
+            results_dict = compute_coverage(args)
+            # call in the sample order of the coverage tables
+            bam_filepaths = [bam_info.entry for bam_info in results_dict.values()]
+
+            snp_call(args, bam_filepaths)
+    if args.profile:
+        print("Profile summary: {}".format(summarize(args.profile)))
 
 
 if __name__ == '__main__':
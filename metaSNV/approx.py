@@ -0,0 +1,127 @@
+import warnings
+
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+# number of blocks the first subset is split into
+INITIAL_BLOCKS = 25
+# adjacent blocks are merged beyond this, so that the bootstrap stays cheap
+MAX_BLOCKS = 200
+
+
+class Approximation(NamedTuple):
+    """Settings of the position subsampling of metaSNV_DistDiv.py --approx."""
+    width: float = 0.1
+    n_bootstrap: int = 200
+    initial: int = 10000
+    level: float = 0.95
+    seed: int = 0
+
+
+def strata_of(labels: Sequence[str]) -> List[str]:
+    """Contig and gene ('contig:gene') of 'contig:gene:pos[:...]' position labels."""
+    return [':'.join(label.split(':', 2)[:2]) for label in labels]
+
+
+def stratified_order(strata: Sequence[str], rng: np.random.Generator) -> np.ndarray:
+    """
+    Random order of the units such that every prefix contains each stratum
+    in proportion to its size (up to one unit).
+
+    Units are shuffled within their stratum, and the k-th unit of a stratum
+    of size n is placed at (k + u) / n, u ~ U(0, 1).
+    """
+    n = len(strata)
+    if not n:
+        return np.zeros(0, dtype=np.intp)
+    _, codes, counts = np.unique(np.asarray(strata, dtype=object), return_inverse=True, return_counts=True)
+    shuffled = rng.permutation(n)
+    by_stratum = shuffled[np.argsort(codes[shuffled], kind='stable')]
+    rank = np.empty(n)
+    rank[by_stratum] = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.argsort((rank + rng.random(n)) / counts[codes], kind='stable')
+
+
+def run_rows(runs: np.ndarray, units: np.ndarray) -> np.ndarray:
+    """Rows of the positions ``units``, given the number of rows of every position."""
+    starts = np.cumsum(runs) - runs
+    lengths = runs[units]
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts[units], lengths) + offsets
+
+
+def block_bootstrap(blocks: np.ndarray, estimator: Callable[[np.ndarray], np.ndarray], n_bootstrap: int,
+                    level: float, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Estimate and percentile bootstrap confidence interval of a statistic of
+    additive per-block values.
+
+    Args:
+        blocks (np.ndarray): per-block values, blocks along the first axis.
+        estimator (callable): maps summed block values (with any leading axes) to the statistic.
+        n_bootstrap (int): number of bootstrap replicates.
+        level (float): confidence level of the interval.
+
+    Returns:
+        tuple: estimate, lower and upper bounds.
+    """
+    n_blocks = len(blocks)
+    weights = rng.multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks), size=n_bootstrap).astype(blocks.dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimate = estimator(blocks.sum(axis=0))
+        replicates = estimator(np.tensordot(weights, blocks, axes=1))
+    with warnings.catch_warnings():
+        # pairs without any valid position
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanpercentile(replicates, [50 * (1 - level), 50 * (1 + level)], axis=0)
+    return estimate, lower, upper
+
+
+def converged(estimate: np.ndarray, lower: np.ndarray, upper: np.ndarray, width: float) -> bool:
+    """True if every finite interval is at most ``width`` times its estimate wide."""
+    finite = np.isfinite(estimate) & np.isfinite(lower) & np.isfinite(upper)
+    return bool(np.all(upper[finite] - lower[finite] <= width * np.abs(estimate[finite])))
+
+
+def subsample(strata: Sequence[str], block_stats: Callable[[np.ndarray], np.ndarray],
+              estimator: Callable[[np.ndarray, float], np.ndarray], settings: Approximation,
+              rng: np.random.Generator,
+              checked: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Estimate a statistic on a growing stratified random subset of units.
+
+    Starting with ``settings.initial`` units, the subset is doubled until the
+    bootstrap confidence intervals are narrow enough (see `converged`) or all
+    units are used. Only the units added at each step are processed.
+
+    Args:
+        strata (list): stratum of every unit.
+        block_stats (callable): additive statistics of the given (sorted) units.
+        estimator (callable): maps summed statistics and the fraction of units they
+            cover to the statistic, whose first axis enumerates its outputs.
+        checked (int): number of leading outputs the stopping rule applies to (default: all).
+
+    Returns:
+        tuple: estimate, lower and upper bounds, and the number of units used.
+    """
+    n_units = len(strata)
+    order = stratified_order(strata, rng)
+    block_size = max(1, -(-min(settings.initial, n_units) // INITIAL_BLOCKS))
+    blocks = []
+    used = 0
+    target = min(settings.initial, n_units)
+    while True:
+        for start in range(used, target, block_size):
+            blocks.append(block_stats(np.sort(order[start:min(start + block_size, target)])))
+        used = target
+        if not blocks:
+            blocks.append(block_stats(order[:0]))
+        while len(blocks) > MAX_BLOCKS:
+            blocks = [sum(blocks[k:k + 2]) for k in range(0, len(blocks), 2)]
+        fraction = used / n_units if n_units else 1.
+        estimate, lower, upper = block_bootstrap(np.stack(blocks), lambda stats: estimator(stats, fraction),
+                                                 settings.n_bootstrap, settings.level, rng)
+        if used == n_units or converged(estimate[:checked], lower[:checked], upper[:checked], settings.width):
+            return estimate, lower, upper, used
+        target = min(n_units, 2 * used)
@@ -1,13 +1,32 @@
 import os
+import tempfile
+
+import numpy as np
 import pysam
 from pysam.libcalignmentfile import AlignmentFile
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+
+from metaSNV.fileio import open_file
+from metaSNV.kernels import accumulate_depth
+from metaSNV.read_groups import read_group_samples, sample_entry
+
+# regions of a partition are queried one by one through the BAM index up to
+# this many, larger partitions are read with a BED file (which scans the BAM)
+MAX_REGION_QUERIES = 32
+# reads not counted by 'samtools depth': unmapped, secondary, QC fail, duplicate
+DEPTH_EXCLUDED_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
 
 def mean(lst):
+    # references without mapped reads have no coverage
+    if not lst:
+        return 0.0
     return sum(lst) / len(lst)
 
 def median(lst):
+    if not lst:
+        return 0.0
     lst = sorted(lst)
     if len(lst) % 2 == 0:
         return (lst[len(lst) // 2] + lst[len(lst) // 2 - 1]) / 2
@@ -57,10 +76,19 @@ class BAMReference:
 
 class BAMInfo:
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, sample: Optional[str] = None):
         self.filepath = filepath
-        self.sample = os.path.basename(filepath).rsplit('.', 1)[0]
+        self.sample = sample or os.path.basename(filepath).rsplit('.', 1)[0]
         self.references = {}
+        # BAM files of a sample of read groups (see from_read_groups), None for a whole BAM file
+        self.read_group_files = None
+
+    @property
+    def entry(self) -> str:
+        """Line of the sample in 'all_samples'."""
+        if self.read_group_files is None:
+            return sample_entry([self.filepath])
+        return sample_entry(self.read_group_files, self.sample)
 
     def __repr__(self):
         return f"BAMInfo('sample={self.sample}')"
@@ -72,24 +100,135 @@ class BAMInfo:
         return self.references[ref]
 
     @classmethod
-    def from_bam(cls, filepath: str):
+    def from_header(cls, filepath: str):
+        """BAMInfo with the references of a BAM file, without coverage."""
         # silence pysam warning
         save = pysam.set_verbosity(0)
         # read file
-        bam = AlignmentFile(filepath, 'rb')
+        bam = AlignmentFile(filepath, 'r')
         pysam.set_verbosity(save)
 
         info = cls(filepath)
         for ref, length in zip(bam.references, bam.lengths):
             info.references[ref] = BAMReference(info.sample, ref, length)
         bam.close()
+        return info
+
+    @classmethod
+    def from_bam(cls, filepath: str, store=None):
+        """
+        Read the reference lengths and per-position depth of a BAM file.
+
+        Args:
+            filepath (str): path to the BAM file.
+            store (CoverageStoreWriter): if given, the depth is also written to this coverage store.
+        """
+        info = cls.from_header(filepath)
+        accumulate_depth(pysam.depth("-a", filepath), info.references)
+        if store is not None:
+            store.write_sample(info.sample, info.references)
 
+        return info
+
+    @classmethod
+    def read_group_headers(cls, filepath: str) -> List['BAMInfo']:
+        """BAMInfo of every sample (SM tag) of the read groups of a BAM file, without coverage."""
+        infos = []
+        for sample in sorted(set(read_group_samples(filepath).values())):
+            info = cls.from_header(filepath)
+            info.sample = sample
+            info.read_group_files = [filepath]
+            for reference in info.references.values():
+                reference.sample = sample
+            infos.append(info)
+        return infos
+
+    @classmethod
+    def from_read_groups(cls, filepath: str) -> List['BAMInfo']:
+        """
+        Per-position depth of every sample (SM tag) of the read groups of a
+        BAM file, reading the file once. Positions are counted like
+        'samtools depth -a' counts them for the reads of the sample alone
+        (reads flagged unmapped, secondary, QC fail or duplicate are left out,
+        deletions and skipped bases are not covered).
+        """
+        infos = cls.read_group_headers(filepath)
+        samples = [info.sample for info in infos]
+        rows = {group: samples.index(sample) for group, sample in read_group_samples(filepath).items()}
+
+        save = pysam.set_verbosity(0)
+        bam = AlignmentFile(filepath, 'r')
+        pysam.set_verbosity(save)
+        done = set()
+        ref_id = -1
+        starts, ends = [[] for _ in samples], [[] for _ in samples]
+
+        def flush():
+            if ref_id < 0:
+                return
+            ref, length = bam.references[ref_id], bam.lengths[ref_id]
+            for row, info in enumerate(infos):
+                if not starts[row]:
+                    continue
+                diff = np.zeros(length + 1, dtype=np.int64)
+                np.add.at(diff, starts[row], 1)
+                np.add.at(diff, ends[row], -1)
+                depth = np.cumsum(diff[:-1])
+                if depth.any():
+                    info.references[ref].pos2cov = dict(zip(range(1, length + 1), depth.tolist()))
+                starts[row].clear()
+                ends[row].clear()
+
+        for read in bam.fetch(until_eof=True):
+            if read.flag & DEPTH_EXCLUDED_FLAGS or not read.has_tag('RG'):
+                continue
+            row = rows.get(read.get_tag('RG'))
+            if row is None:
+                continue
+            if read.reference_id != ref_id:
+                flush()
+                if read.reference_id in done:
+                    raise ValueError(f"{filepath} is not sorted by coordinate")
+                done.add(read.reference_id)
+                ref_id = read.reference_id
+            for start, end in read.get_blocks():
+                starts[row].append(start)
+                ends[row].append(end)
+        flush()
+        bam.close()
+        return infos
 
-        for line in pysam.depth("-a", filepath).split('\n'):
-            if line:
-                ref, pos, cov = line.split('\t')
-                info.references[ref].add_coverage(int(pos), int(cov))
+    @classmethod
+    def merge(cls, infos: List['BAMInfo']) -> 'BAMInfo':
+        """Coverage of a read group sample over several BAM files (see `from_read_groups`)."""
+        merged = cls(infos[0].filepath, infos[0].sample)
+        merged.read_group_files = [filepath for info in infos for filepath in info.read_group_files]
+        for ref, reference in infos[0].references.items():
+            merged.references[ref] = BAMReference(merged.sample, ref, reference.length)
+            merged.references[ref].pos2cov = dict(reference.pos2cov)
+        for info in infos[1:]:
+            for ref, reference in info.references.items():
+                pos2cov = merged.references[ref].pos2cov
+                if not pos2cov:
+                    merged.references[ref].pos2cov = dict(reference.pos2cov)
+                elif reference.pos2cov:
+                    merged.references[ref].pos2cov = {pos: cov + reference.pos2cov[pos]
+                                                      for pos, cov in pos2cov.items()}
+        return merged
 
+    @classmethod
+    def from_depth(cls, filepath: str, depths):
+        """
+        BAMInfo of a BAM file from the `region_depth` outputs of the
+        partitions of its references (see `depth_tasks`), in order.
+        """
+        info = cls.from_header(filepath)
+        for depth in depths:
+            accumulate_depth(depth, info.references)
+        for reference in info.references.values():
+            # like 'samtools depth -a' on the whole file: references without coverage have no positions
+            if not any(reference.pos2cov.values()):
+                reference.pos2cov = {}
         return info
 
     def get_reference_names(self):
@@ -98,6 +237,90 @@ class BAMInfo:
 
 
 
+def partition_references(lengths: List[Tuple[str, int]], n_partitions: int) -> List[List[Tuple[str, int, int]]]:
+    """
+    Split references into ``n_partitions`` partitions of (nearly) the same
+    number of bases, in order. Long references are split across partitions.
+
+    Args:
+        lengths (list): (reference, length) tuples, in the order of the BAM header.
+
+    Returns:
+        list: per partition, (reference, start, end) regions (0-based, half-open).
+    """
+    size = max(1, -(-sum(length for _, length in lengths) // n_partitions))
+    partitions = [[]]
+    filled = 0
+    for ref, length in lengths:
+        start = 0
+        while start < length:
+            if filled == size:
+                partitions.append([])
+                filled = 0
+            end = min(length, start + size - filled)
+            partitions[-1].append((ref, start, end))
+            filled += end - start
+            start = end
+    return partitions
+
+
+def depth_tasks(filepath: str, n_partitions: int) -> List[Tuple[str, Optional[List[Tuple[str, int, int]]]]]:
+    """
+    `region_depth` tasks computing the depth of a BAM file in
+    ``n_partitions`` parts, or in a single task if the BAM is not indexed.
+    """
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    indexed = bam.has_index()
+    lengths = list(zip(bam.references, bam.lengths))
+    bam.close()
+    if n_partitions <= 1 or not indexed:
+        return [(filepath, None)]
+    return [(filepath, regions) for regions in partition_references(lengths, n_partitions)]
+
+
+def region_string(ref: str, start: int, end: int) -> str:
+    # samtools needs braces around names containing ':'
+    if ':' in ref:
+        ref = '{' + ref + '}'
+    return f"{ref}:{start + 1}-{end}"
+
+
+def region_depth(task: Tuple[str, Optional[List[Tuple[str, int, int]]]]) -> str:
+    """
+    'samtools depth -a' output of a BAM file restricted to regions (all of
+    the file if regions is None), for a task of `depth_tasks`.
+    """
+    filepath, regions = task
+    if regions is None:
+        return pysam.depth("-a", filepath)
+    if len(regions) <= MAX_REGION_QUERIES:
+        return ''.join(pysam.depth("-a", "-r", region_string(*region), filepath) for region in regions)
+    with tempfile.NamedTemporaryFile('w', suffix='.bed') as bed:
+        for ref, start, end in regions:
+            bed.write(f"{ref}\t{start}\t{end}\n")
+        bed.flush()
+        return pysam.depth("-a", "-b", bed.name, filepath)
+
+
+def legacy_values(bam_info: BAMInfo, mode: str = "depth") -> Dict[str, str]:
+    """
+    Values of a sample in a legacy coverage table, by reference.
+
+    Args:
+        bam_info (BAMInfo): coverage of the sample.
+        mode (str): 'depth' (average depth) or 'breadth' (percentage of positions covered at least once).
+    """
+    if mode == "depth":
+        return {ref: str(reference.coverage_depth('mean')) for ref, reference in bam_info.references.items()}
+    elif mode == "breadth":
+        # percentage, as expected by metaSNV_Filtering.py (-b) and metaSNV_DistDiv.py
+        return {ref: str(reference.coverage_breadth(depth=1) * 100)
+                for ref, reference in bam_info.references.items()}
+    raise ValueError(f"'{mode}' not supported")
+
+
 def write_legacy(data: Dict[str, BAMInfo], output_filepath: str, mode = "depth"):
     """
     Write legacy coverage files for backwards compatibility.
@@ -106,42 +329,37 @@ def write_legacy(data: Dict[str, BAMInfo], output_filepath: str, mode = "depth")
         data (dict): dictionary of BAMInfo objects.
         output_dir (str): path to output directory.
     """
+    write_legacy_columns({sample: legacy_values(bam_info, mode) for sample, bam_info in data.items()},
+                         output_filepath, mode)
 
-    ## DATA WRANGLING
 
-    # get all filenames
-    filenames = list(data.keys())
+def write_legacy_columns(columns: Dict[str, Dict[str, str]], output_filepath: str, mode = "depth"):
+    """
+    Write a legacy coverage table from the values of its samples (see `legacy_values`).
+
+    Args:
+        columns (dict): sample to values by reference, in the column order of the table.
+        output_filepath (str): path to the table.
+        mode (str): 'depth' or 'breadth'.
+    """
+    filenames = list(columns.keys())
     # references - extract all possible references
     references = set()
-    for bam_file_info in data.values():
-        references.update(bam_file_info.references)
-
-    # sort references
-    all_references = sorted(list(references))
+    for values in columns.values():
+        references.update(values)
 
     # create rows of data with reference as first column
     rows = []
-    # for each reference
-    # get average coverage from each sample
-    # and write it to file
-    for ref in all_references:
+    for ref in sorted(references):
         row = [ref]
-        for sample_reference in data.values():
-            if ref in all_references:
-                # extract value for the reference
-                if mode == "depth":
-                    value = str(sample_reference[ref].coverage_depth('mean'))
-                elif mode == "breadth":
-                    value = str(sample_reference[ref].coverage_breadth(depth=1))
-                # add it to the row
-                row.append(value)
-            else:
-                raise ValueError(f"Reference '{ref}' not found in {bam_file_info.sample}\n"
+        for sample, values in columns.items():
+            if ref not in values:
+                raise ValueError(f"Reference '{ref}' not found in {sample}\n"
                                  "Are all BAM files aligned to the same reference?")
+            row.append(values[ref])
         rows.append(row)
 
-
-    with open(output_filepath, 'w') as f:
+    with open_file(output_filepath, 'wt') as f:
         f.write('\t')
         f.write('\t'.join(filenames) + '\n')
 
@@ -152,4 +370,58 @@ def write_legacy(data: Dict[str, BAMInfo], output_filepath: str, mode = "depth")
         f.write('\t'.join(header) + '\n')
 
         for row in rows:
-            f.write('\t'.join(row) + '\n')
\ No newline at end of file
+            f.write('\t'.join(row) + '\n')
+
+
+def read_legacy(filepath: str) -> Dict[str, Dict[str, str]]:
+    """
+    Values of the samples of a legacy coverage table, as written by `write_legacy_columns`.
+
+    Returns:
+        dict: sample to values (unparsed) by reference, in the column order of the table.
+    """
+    with open_file(filepath, 'rt') as f:
+        samples = [sample for sample in f.readline().rstrip('\n').split('\t')[1:] if sample]
+        f.readline()
+        columns = {sample: {} for sample in samples}
+        for line in f:
+            ref, *values = line.rstrip('\n').split('\t')
+            for sample, value in zip(samples, values):
+                columns[sample][ref] = value
+    return columns
+
+
+def write_sample_list(data: Dict[str, BAMInfo], output_filepath: str):
+    """
+    Write the list of BAM files ('all_samples'), in the column order of
+    the coverage tables and SNV calls (see `BAMInfo.entry`).
+
+    Args:
+        data (dict): dictionary of BAMInfo objects.
+        output_filepath (str): path to output file.
+    """
+    with open(output_filepath, 'w') as f:
+        for bam_file_info in data.values():
+            f.write(bam_file_info.entry + '\n')
+
+
+def write_bed_header(data: Dict[str, BAMInfo], output_filepath: str):
+    """
+    Write the reference lengths ('bed_header') as BED regions.
+
+    Args:
+        data (dict): dictionary of BAMInfo objects.
+        output_filepath (str): path to output file.
+    """
+    lengths = {}
+    for bam_file_info in data.values():
+        for ref, bam_ref in bam_file_info.references.items():
+            lengths[ref] = bam_ref.length
+    write_reference_lengths(lengths, output_filepath)
+
+
+def write_reference_lengths(lengths: Dict[str, int], output_filepath: str):
+    """Write reference lengths as BED regions, sorted by reference."""
+    with open(output_filepath, 'w') as f:
+        for ref in sorted(lengths):
+            f.write(f"{ref}\t0\t{lengths[ref]}\n")
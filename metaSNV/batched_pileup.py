@@ -0,0 +1,110 @@
+import argparse
+import heapq
+import itertools
+import subprocess
+import sys
+
+from typing import Dict, IO, Iterator, List, Sequence, Tuple, Union
+
+import pysam
+from pysam.libcalignmentfile import AlignmentFile
+
+from metaSNV.kernels import merge_pileup_lines
+from metaSNV.read_groups import COMPACT_PILEUP_ARGS, parse_sample_entry, pileup_inputs, uses_read_groups
+
+Batch = Tuple[List[str], List[Union[int, Dict[str, int]]]]
+
+
+def pileup_batches(filepaths: Sequence[str], files: Sequence[Union[int, Dict[str, int]]],
+                   batch_size: int) -> List[Batch]:
+    """
+    Batches of at most ``batch_size`` input files of a pileup, with the
+    sample columns of their files (see `metaSNV.read_groups.pileup_inputs`).
+    """
+    return [(list(filepaths[k:k + batch_size]), list(files[k:k + batch_size]))
+            for k in range(0, len(filepaths), batch_size)]
+
+
+def reference_order(filepath: str) -> Dict[str, int]:
+    """Index of every reference in the header of a BAM file, the order of its pileup."""
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    order = {ref: k for k, ref in enumerate(bam.references)}
+    bam.close()
+    return order
+
+
+def _keyed(src: IO[bytes], batch: int, order: Dict[str, int]) -> Iterator[Tuple[Tuple[int, int], int, str]]:
+    for line in src:
+        line = line.decode()
+        ref, pos, _ = line.split('\t', 2)
+        yield (order[ref], int(pos)), batch, line
+
+
+def merge_pileups(sources: List[IO[bytes]], batches: List[Batch], dst: IO[bytes], n_samples: int, n_fields: int,
+                  order: Dict[str, int]):
+    """
+    Merge the pileups of ``batches`` (one source each, with one base per read
+    and ``n_fields`` fields per file) into a pileup with one column per
+    sample, written to ``dst``. Closes all files.
+    """
+    try:
+        columns = [files for _, files in batches]
+        merged = heapq.merge(*(_keyed(src, batch, order) for batch, src in enumerate(sources)))
+        for _, position in itertools.groupby(merged, key=lambda item: item[0]):
+            lines = [None] * len(sources)
+            for _, batch, line in position:
+                lines[batch] = line
+            dst.write(merge_pileup_lines(lines, columns, n_samples, n_fields).encode())
+    finally:
+        for src in sources:
+            src.close()
+        dst.close()
+
+
+def batched_pileup(samtools_cmd: List[str], entries: Sequence[str], batch_size: int, dst: IO[bytes]) -> int:
+    """
+    Pile up the samples of 'all_samples' lines in batches of at most
+    ``batch_size`` BAM files, one ``samtools_cmd`` process per batch, and
+    merge the batches into ``dst``. Open files and the memory of every
+    samtools process are bounded by the batch size.
+
+    Returns:
+        int: the largest exit code of the samtools processes.
+    """
+    if uses_read_groups(entries):
+        filepaths, files = pileup_inputs(entries)
+        extra_args = ['--output-extra', 'RG']
+    else:
+        filepaths = [parse_sample_entry(entry)[0][0] for entry in entries]
+        files = list(range(len(filepaths)))
+        extra_args = []
+    batches = pileup_batches(filepaths, files, batch_size)
+    calls = [subprocess.Popen(samtools_cmd + COMPACT_PILEUP_ARGS + extra_args + batch_filepaths,
+                              stdout=subprocess.PIPE)
+             for batch_filepaths, _ in batches]
+    merge_pileups([call.stdout for call in calls], batches, dst, len(entries), 4 if extra_args else 3,
+                  reference_order(filepaths[0]))
+    return max(call.wait() for call in calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m metaSNV.batched_pileup',
+                                     description=('samtools mpileup of samples in batches of BAM files, merged into '
+                                                  'one pileup with a column per sample'))
+    parser.add_argument('--batch_size', metavar='INT', type=int, required=True,
+                        help='Number of BAM files per samtools process.')
+    parser.add_argument('-f', dest='ref_db', metavar='REF_DB_FILE', required=True,
+                        help='Reference of the BAM files.')
+    parser.add_argument('-l', dest='regions', metavar='BED_FILE', default=None,
+                        help='Only pile up these regions.')
+    parser.add_argument('entries', metavar='SAMPLE', nargs='+',
+                        help="Lines of 'all_samples': BAM files, or BAM files and a read group sample.")
+    args = parser.parse_args()
+    samtools_cmd = ['samtools', 'mpileup', '-f', args.ref_db, '-B'] + (['-l', args.regions] if args.regions else [])
+    sys.exit(batched_pileup(samtools_cmd, args.entries, args.batch_size, sys.stdout.buffer))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import os
+import zlib
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+INDEX_FILENAME = 'index.tsv'
+# positions per chunk
+CHUNK_SIZE = 65536
+DEPTH_DTYPE = np.dtype('<u4')
+CHUNK_COMPRESSIONS = ('zlib', 'none')
+
+
+def data_filepath(directory: str, sample: str) -> str:
+    return os.path.join(directory, sample + '.depth')
+
+
+def chunks_filepath(directory: str, sample: str) -> str:
+    return os.path.join(directory, sample + '.depth.idx')
+
+
+class CoverageStoreWriter:
+    """
+    Write the per-position depth of samples to a coverage store.
+
+    A store is a directory with, per sample, a data file ``<sample>.depth``
+    of fixed-size chunks of positions (little-endian uint32 depths, zlib
+    compressed or raw) and the list of its chunks ``<sample>.depth.idx``
+    (reference, chunk, offset, size). Chunks without coverage are not
+    stored. ``index.tsv`` holds the chunk size, chunk compression, samples
+    and reference lengths. See `CoverageStore` to read it.
+
+    Samples are written independently, so worker processes can write
+    different samples of the same store.
+    """
+
+    def __init__(self, directory: str, chunk_size: int = CHUNK_SIZE, compression: str = 'zlib'):
+        if compression not in CHUNK_COMPRESSIONS:
+            raise ValueError(f"Unknown chunk compression '{compression}'")
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+
+    def write_sample(self, sample: str, references: Dict):
+        """
+        Write the depth of a sample.
+
+        Args:
+            sample (str): sample name.
+            references (dict): reference name to `BAMReference` (1-based positions in ``pos2cov``).
+        """
+        with open(data_filepath(self.directory, sample), 'wb') as data, \
+                open(chunks_filepath(self.directory, sample), 'w') as chunks:
+            for ref, reference in references.items():
+                depth = np.zeros(reference.length, dtype=DEPTH_DTYPE)
+                if reference.pos2cov:
+                    positions = np.fromiter(reference.pos2cov.keys(), dtype=np.int64, count=len(reference.pos2cov))
+                    depth[positions - 1] = np.fromiter(reference.pos2cov.values(), dtype=np.int64,
+                                                       count=len(reference.pos2cov))
+                for k, start in enumerate(range(0, reference.length, self.chunk_size)):
+                    chunk = depth[start:start + self.chunk_size]
+                    if not chunk.any():
+                        continue
+                    payload = chunk.tobytes()
+                    if self.compression == 'zlib':
+                        payload = zlib.compress(payload, 1)
+                    chunks.write(f"{ref}\t{k}\t{data.tell()}\t{len(payload)}\n")
+                    data.write(payload)
+
+    def write_index(self, samples: Sequence[str], lengths: Dict[str, int]):
+        """Write ``index.tsv``, once all samples are written."""
+        with open(os.path.join(self.directory, INDEX_FILENAME), 'w') as f:
+            f.write(f"chunk_size\t{self.chunk_size}\n")
+            f.write(f"compression\t{self.compression}\n")
+            for sample in samples:
+                f.write(f"sample\t{sample}\n")
+            for ref in sorted(lengths):
+                f.write(f"reference\t{ref}\t{lengths[ref]}\n")
+
+
+class CoverageStore:
+    """
+    Read a coverage store written by `CoverageStoreWriter`.
+
+    The data files are memory-mapped and only the chunks overlapping the
+    requested region are read. Regions are 0-based and half-open, like the
+    BED files of metaSNV: position ``p`` of ``samtools depth`` is at index
+    ``p - 1``.
+
+    Example:
+        >>> store = CoverageStore('outputs/coverage_store')
+        >>> store.region('refGenome1clus', 1000, 2000).shape
+        (3, 1000)
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.samples = []
+        self.references = {}
+        with open(os.path.join(directory, INDEX_FILENAME)) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'chunk_size':
+                    self.chunk_size = int(fields[1])
+                elif fields[0] == 'compression':
+                    self.compression = fields[1]
+                elif fields[0] == 'sample':
+                    self.samples.append(fields[1])
+                elif fields[0] == 'reference':
+                    self.references[fields[1]] = int(fields[2])
+        self._chunks = {}
+        self._data = {}
+
+    def __repr__(self):
+        return f"CoverageStore('{self.directory}')"
+
+    def _load(self, sample: str):
+        if sample not in self._chunks:
+            if sample not in self.samples:
+                raise KeyError(f"Sample '{sample}' not found in {self}")
+            chunks = {}
+            with open(chunks_filepath(self.directory, sample)) as f:
+                for line in f:
+                    ref, k, offset, size = line.rstrip('\n').split('\t')
+                    chunks[ref, int(k)] = (int(offset), int(size))
+            filepath = data_filepath(self.directory, sample)
+            # an empty file cannot be mapped
+            if os.path.getsize(filepath):
+                self._data[sample] = np.memmap(filepath, dtype=np.uint8, mode='r')
+            else:
+                self._data[sample] = np.zeros(0, dtype=np.uint8)
+            self._chunks[sample] = chunks
+        return self._chunks[sample], self._data[sample]
+
+    def _chunk(self, data: np.ndarray, offset: int, size: int) -> np.ndarray:
+        payload = data[offset:offset + size]
+        if self.compression == 'zlib':
+            return np.frombuffer(zlib.decompress(payload), dtype=DEPTH_DTYPE)
+        return payload.view(DEPTH_DTYPE)
+
+    def depth(self, sample: str, reference: str, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """Depth of a sample at positions [start, end) of a reference (whole reference by default)."""
+        length = self.references[reference]
+        end = length if end is None else end
+        if not 0 <= start <= end <= length:
+            raise ValueError(f"Region {start}-{end} is outside of '{reference}' (length {length})")
+        chunks, data = self._load(sample)
+        depth = np.zeros(end - start, dtype=DEPTH_DTYPE)
+        for k in range(start // self.chunk_size, -(-end // self.chunk_size)):
+            if (reference, k) not in chunks:
+                continue
+            chunk = self._chunk(data, *chunks[reference, k])
+            chunk_start = k * self.chunk_size
+            lo = max(start, chunk_start)
+            hi = min(end, chunk_start + len(chunk))
+            depth[lo - start:hi - start] = chunk[lo - chunk_start:hi - chunk_start]
+        return depth
+
+    def region(self, reference: str, start: int = 0, end: Optional[int] = None,
+               samples: Optional[List[str]] = None) -> np.ndarray:
+        """Depth of several samples (all by default) at [start, end) of a reference, one row per sample."""
+        samples = self.samples if samples is None else samples
+        end = self.references[reference] if end is None else end
+        region = np.zeros((len(samples), end - start), dtype=DEPTH_DTYPE)
+        for row, sample in enumerate(samples):
+            region[row] = self.depth(sample, reference, start, end)
+        return region
+
+    def breadth(self, reference: str, min_depth: int = 1, samples: Optional[List[str]] = None) -> np.ndarray:
+        """Fraction of the positions of a reference covered at least ``min_depth`` times, per sample."""
+        samples = self.samples if samples is None else samples
+        length = self.references[reference]
+        covered = np.zeros(len(samples), dtype=np.int64)
+        for row, sample in enumerate(samples):
+            for start in range(0, length, self.chunk_size):
+                covered[row] += np.count_nonzero(self.depth(sample, reference, start,
+                                                            min(length, start + self.chunk_size)) >= min_depth)
+        return covered / length if length else covered.astype(np.float64)
@@ -0,0 +1,423 @@
+import heapq
+import os
+
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pysam
+from pysam.libcalignmentfile import AlignmentFile
+
+from metaSNV.bam_preprocessing import depth_tasks
+from metaSNV.fileio import compression_of, find_file, glob_compressed, open_file
+from metaSNV.positions import positions_path
+from metaSNV.profiling import read_tasks
+from metaSNV.read_groups import parse_sample_entry
+from metaSNV.reference_cache import ALIGNMENT_SUFFIXES
+from metaSNV.pruning import read_regions, samples_of_interest
+
+# memory of a worker process before it allocates anything (interpreter, numpy, pandas)
+WORKER_MEMORY = 150 * 2 ** 20
+# SNV lines per reference base and bytes per SNV line and sample, to predict calls that do not exist yet
+SNVS_PER_BASE = 0.01
+SNV_LINE_BYTES = 60
+SNV_SAMPLE_BYTES = 12
+# fraction of the SNV lines of a taxon kept by the filtering step, and alleles per kept line
+FILTERED_FRACTION = 0.5
+ALLELES_PER_SNV = 1.1
+# size of the decompressed SNV calls relative to compressed ones
+COMPRESSION_RATIO = 4
+# memory of a calling split outside of Python: samtools mpileup buffers every BAM file (BGZF blocks, index, reads
+# overlapping the position), snpCall keeps the reference database
+MPILEUP_FILE_MEMORY = 8 * 2 ** 20
+REFERENCE_BYTES_PER_BASE = 1.
+# bytes per second the BAM files are read at, shared by all concurrent calling splits
+READ_BANDWIDTH = 200 * 2 ** 20
+# a calling split more must shorten the predicted runtime by this fraction to be recommended
+SPLIT_GAIN = 0.05
+# memory of filter_two per byte of the SNV calls of its taxon: the encoded position of every kept allele (about 20
+# bytes while filtering, 50 at the peak when the positions are written), for SNV lines of about 150 bytes
+FILTERING_BYTES = 50 * FILTERED_FRACTION * ALLELES_PER_SNV / 150
+
+
+class StageModel(NamedTuple):
+    """
+    Runtime and memory of the tasks of a stage, proportional to their size.
+
+    ``work`` and ``footprint`` compute the units of runtime and memory of a
+    task from its size (the ``key=value`` fields `metaSNV.profiling`
+    records with ``measure``). ``seconds`` and ``bytes`` are the default
+    rates, replaced by the rates of earlier profiled runs (see `calibrate`).
+    The memory rate is only calibrated if the memory of the tasks is
+    ``traced`` by tracemalloc, i.e. allocated by Python.
+    """
+    command: str
+    tasks: Tuple[str, ...]
+    work: Callable[[Dict[str, float]], float]
+    footprint: Callable[[Dict[str, float]], float]
+    seconds: float
+    bytes: float
+    traced: bool = True
+
+
+STAGES = {
+    # samtools depth output parsed into a dict per position
+    'coverage': StageModel('metaSNV.py', ('from_bam', 'region_depth'), lambda size: size['bases'],
+                           lambda size: size['bases'], 5e-6, 150.),
+    # samtools mpileup | snpCall, memory is outside of Python
+    'calling': StageModel('metaSNV.py', ('execute_snp_call',), lambda size: size['bytes'],
+                          lambda size: (size.get('files', 1) * MPILEUP_FILE_MEMORY
+                                        + size.get('genome', size['bases']) * REFERENCE_BYTES_PER_BASE),
+                          1e-7, 1., traced=False),
+    # every taxon scans all SNV calls and keeps the labels of its filtered rows
+    'filtering': StageModel('metaSNV_Filtering.py', ('filter_two',), lambda size: size['bytes'],
+                            lambda size: size.get('taxon_bytes', size['bytes']), 7e-7, FILTERING_BYTES),
+    # pairwise kernels over all rows
+    'distances': StageModel('metaSNV_DistDiv.py --dist', ('computeDist',),
+                            lambda size: size['rows'] * size['samples'] ** 2,
+                            lambda size: size['rows'] * size['samples'], 3e-8, 24.),
+    'diversity': StageModel('metaSNV_DistDiv.py --div/--divNS', ('computeDiv', 'computeDivNS'),
+                            lambda size: size['rows'] * size['samples'] ** 2,
+                            lambda size: size['rows'] * size['samples'], 1e-7, 24.),
+}
+
+
+############################################################
+# Task sizes, recorded by the stages when profiling (``measure``)
+
+def bam_size(filepath: str, *args, **kwargs) -> Dict[str, float]:
+    """Reference bases and file size of a BAM file."""
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    bases = sum(bam.lengths)
+    bam.close()
+    return {'bases': bases, 'bytes': os.path.getsize(filepath)}
+
+
+def is_indexed(filepath: str) -> bool:
+    """Whether a BAM or CRAM file has an index, so that reads of regions only read their part of the file."""
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    indexed = bam.has_index()
+    bam.close()
+    return indexed
+
+
+def region_size(task, *args, **kwargs) -> Dict[str, float]:
+    """Size of a `metaSNV.bam_preprocessing.region_depth` task, the part of the BAM file in its regions."""
+    filepath, regions = task
+    size = bam_size(filepath)
+    if regions is None:
+        return size
+    bases = sum(end - start for _, start, end in regions)
+    return {'bases': bases, 'bytes': size['bytes'] * bases / max(1, size['bases'])}
+
+
+def calling_size(args, snpCaller, ifile, ofile, bam_filepaths, regions=None, **kwargs) -> Dict[str, float]:
+    """Size of a SNV calling task, the part of the BAM files in its regions."""
+    # lines of 'all_samples', several samples of read groups can share a BAM file
+    bam_filepaths = list(dict.fromkeys(filepath for entry in bam_filepaths
+                                       for filepath in parse_sample_entry(entry)[0]))
+    genome = bam_size(bam_filepaths[0])['bases'] if bam_filepaths else 0
+    bases = sum(length for _, length in read_regions(regions)) if regions is not None else genome
+    total = sum(os.path.getsize(filepath) for filepath in bam_filepaths)
+    return {'bases': bases, 'bytes': total * bases / max(1, genome), 'files': len(bam_filepaths), 'genome': genome}
+
+
+def snv_size(snp_files: Sequence[str], species: Optional[str] = None, shares: Optional[Dict[str, float]] = None,
+             *args, **kwargs) -> Dict[str, float]:
+    """
+    Size of a filtering task: every taxon reads all SNV calls, and keeps
+    the labels of its own rows (about its ``shares`` of the calls, see
+    `taxon_shares`; all calls if unknown).
+    """
+    total = sum(os.path.getsize(filepath) * (COMPRESSION_RATIO if compression_of(filepath) != 'none' else 1)
+                for filepath in snp_files)
+    share = shares.get(species, 1.) if shares is not None and species is not None else 1.
+    return {'bytes': total, 'taxon_bytes': total * share}
+
+
+def freq_size(filt_file: str, *args, **kwargs) -> Dict[str, float]:
+    """Rows and samples of a filtered frequency table."""
+    with open_file(filt_file) as f:
+        samples = len(f.readline().rstrip('\n').split('\t')) - 1
+        if os.path.isfile(positions_path(filt_file)):
+            with np.load(positions_path(filt_file)) as positions:
+                rows = len(positions['position'])
+        else:
+            rows = sum(1 for _ in f)
+    return {'rows': rows, 'samples': samples}
+
+
+############################################################
+# Calibration
+
+def calibrate(directories: Sequence[str]) -> Dict[str, Tuple[float, float]]:
+    """
+    Rates (seconds per unit of work, bytes per unit of footprint) of the
+    stages profiled into ``directories`` (--profile of earlier runs) with
+    task sizes, default rates for the other stages. Memory rates need
+    --profile_memory and are taken from the task using most memory per unit.
+    """
+    tasks = [task for directory in directories for task in read_tasks(directory)]
+    rates = {}
+    for stage, model in STAGES.items():
+        walls, works, per_byte = 0., 0., []
+        for name, wall, peak, size in tasks:
+            if name not in model.tasks or not size:
+                continue
+            walls += wall
+            works += model.work(size)
+            if model.traced and peak > 0 and model.footprint(size) > 0:
+                per_byte.append(peak / model.footprint(size))
+        rates[stage] = (walls / works if works > 0 else model.seconds, max(per_byte, default=model.bytes))
+    return rates
+
+
+def task_memory(stage: str, size: Dict[str, float], rates: Optional[Dict[str, Tuple[float, float]]] = None) -> float:
+    """Predicted peak memory of a worker process running a task of ``stage`` of the given size."""
+    model = STAGES[stage]
+    per_byte = rates[stage][1] if rates and stage in rates else model.bytes
+    return model.footprint(size) * per_byte + WORKER_MEMORY
+
+
+def calibrated_stages(directories: Sequence[str]) -> List[str]:
+    """Stages with profiled tasks in ``directories``."""
+    names = {name for directory in directories for name, _, _, size in read_tasks(directory) if size}
+    return [stage for stage, model in STAGES.items() if names.intersection(model.tasks)]
+
+
+############################################################
+# Scheduling
+
+def makespan(durations: Sequence[float], workers: int) -> float:
+    """Runtime of tasks on ``workers`` processes, every task starting on the first free process in order."""
+    loads = [0.] * max(1, workers)
+    for duration in durations:
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
+
+
+def peak_memory(footprints: Sequence[float], workers: int) -> float:
+    """Peak memory of ``workers`` processes running the largest tasks at the same time."""
+    workers = min(max(1, workers), max(1, len(footprints)))
+    return sum(sorted(footprints, reverse=True)[:workers]) + workers * WORKER_MEMORY
+
+
+def recommend_workers(footprints: Sequence[float], cores: int, memory: float) -> int:
+    """Most workers (at most ``cores`` and one per task) whose peak memory fits into ``memory``, at least 1."""
+    workers = max(1, min(cores, len(footprints)))
+    while workers > 1 and peak_memory(footprints, workers) > memory:
+        workers -= 1
+    return workers
+
+
+############################################################
+# Project inputs
+
+class StageEstimate(NamedTuple):
+    stage: str
+    tasks: int
+    workers: int
+    runtime: float
+    memory: float
+    option: str
+    note: str = ''
+
+
+def taxon(reference: str) -> str:
+    """Taxon of a reference, like metaSNV_Filtering.py groups references."""
+    return reference.split('.')[0]
+
+
+def taxon_shares(lengths: Dict[str, int]) -> Dict[str, float]:
+    """Share of every taxon in the bases of references of the given ``lengths``."""
+    bases = defaultdict(int)
+    for ref, length in lengths.items():
+        bases[taxon(ref)] += length
+    genome = sum(bases.values())
+    return {name: count / max(1, genome) for name, count in bases.items()}
+
+
+def project_shares(project_dir: str) -> Optional[Dict[str, float]]:
+    """`taxon_shares` of the references of a project (its bed_header), None before the coverage ran."""
+    bed_header = os.path.join(project_dir, 'bed_header')
+    return taxon_shares(dict(read_regions(bed_header))) if os.path.isfile(bed_header) else None
+
+
+def project_tables(project_dir: str) -> Tuple[Optional[str], Optional[str]]:
+    name = os.path.basename(project_dir.rstrip('/'))
+    return (find_file(os.path.join(project_dir, name + '.all_cov.tab')),
+            find_file(os.path.join(project_dir, name + '.all_perc.tab')))
+
+
+def estimate(project_dir: str, input_folder: str, cores: int, memory: float, min_breadth: float = 40.0,
+             min_depth: float = 5.0, min_samples: int = 2,
+             rates: Optional[Dict[str, Tuple[float, float]]] = None) -> Tuple[List[StageEstimate], List[Tuple]]:
+    """
+    Predict the runtime and peak memory of every stage of a project from
+    its BAM files and the outputs of the stages that already ran.
+
+    Returns:
+        tuple: estimates of the stages, and per taxon (taxon, samples, rows,
+        runtime and memory of the distances, runtime and memory of a diversity).
+    """
+    rates = rates or {stage: (model.seconds, model.bytes) for stage, model in STAGES.items()}
+    bams = sorted(os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.endswith(ALIGNMENT_SUFFIXES))
+    if not bams:
+        raise ValueError("no BAM or CRAM files in '{}'".format(input_folder))
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(bams[0], 'r')
+    pysam.set_verbosity(save)
+    lengths = dict(zip(bam.references, bam.lengths))
+    bam.close()
+    taxon_bases = defaultdict(int)
+    for ref, length in lengths.items():
+        taxon_bases[taxon(ref)] += length
+
+    def predict(stage, sizes, workers):
+        seconds, per_byte = rates[stage]
+        model = STAGES[stage]
+        durations = [model.work(size) * seconds for size in sizes]
+        footprints = [model.footprint(size) * per_byte for size in sizes]
+        return durations, footprints, makespan(durations, workers)
+
+    estimates = []
+
+    # coverage: the tasks of metaSNV.py --threads (indexed BAM files are split if there are more threads than
+    # BAM files), the parent keeps the depth of all of them
+    bam_sizes = [bam_size(filepath) for filepath in bams]
+
+    def coverage(workers):
+        n_partitions = -(-workers // len(bams))
+        sizes = [region_size(task) for filepath in bams for task in depth_tasks(filepath, n_partitions)]
+        durations, footprints, runtime = predict('coverage', sizes, workers)
+        return len(sizes), runtime, sum(footprints) + peak_memory(footprints, workers)
+
+    workers = max(1, cores)
+    while workers > 1 and coverage(workers)[2] > memory:
+        workers -= 1
+    # unindexed BAM files are not split, more threads than tasks would be idle
+    workers = min(workers, coverage(workers)[0])
+    n_tasks, runtime, peak = coverage(workers)
+    estimates.append(StageEstimate('coverage', n_tasks, workers, runtime, peak, '--threads {}'.format(workers),
+                                   'indexed BAM files are split across the threads' if n_tasks > len(bams) else ''))
+
+    # calling: splits planned with "metaSNV.py plan --n_splits", one job per split, all running at the same time.
+    # Every split pipes its own samtools mpileup over all BAM files into its own snpCall, and the splits read the
+    # BAM files from the same storage: the parts of their references if the files are indexed, else all of them.
+    genome = sum(lengths.values())
+    total_bytes = sum(size['bytes'] for size in bam_sizes)
+    indexed = [is_indexed(filepath) for filepath in bams]
+
+    def calling(splits):
+        sizes = [{'bytes': total_bytes / splits, 'bases': genome / splits, 'files': len(bams), 'genome': genome}]
+        _, footprints, runtime = predict('calling', sizes * splits, splits)
+        read = sum(size['bytes'] * (1 if index else splits) for size, index in zip(bam_sizes, indexed))
+        return footprints, max(runtime, read / READ_BANDWIDTH)
+
+    most = recommend_workers(calling(max(1, cores))[0], cores, memory)
+    runtimes = {splits: calling(splits)[1] for splits in range(1, most + 1)}
+    # the fewest splits within SPLIT_GAIN of the fastest, more splits only add reads of the BAM files
+    splits = min(splits for splits, runtime in runtimes.items() if runtime <= min(runtimes.values()) * (1 + SPLIT_GAIN))
+    footprints, runtime = calling(splits)
+    notes = []
+    if splits > 1:
+        notes.append('run "metaSNV.py --split i" for every split at the same time')
+    if most < max(1, cores):
+        notes.append('{} splits fit into memory'.format(most))
+    if splits < most:
+        notes.append('more splits are limited by reading the BAM files')
+    estimates.append(StageEstimate('calling', splits, splits, runtime, peak_memory(footprints, splits),
+                                   'plan --n_splits {}'.format(splits), '; '.join(notes)))
+
+    # filtering: taxa and samples passing the coverage thresholds
+    cov_file, perc_file = project_tables(project_dir)
+    notes = []
+    if cov_file and perc_file:
+        soi, _ = samples_of_interest(cov_file, perc_file, min_breadth, min_depth, min_samples)
+    else:
+        soi = {name: [os.path.basename(f).rsplit('.', 1)[0] for f in bams] for name in taxon_bases}
+        notes.append('no coverage tables yet, assuming every taxon passes with all samples')
+    snp_files = glob_compressed(os.path.join(project_dir, 'snpCaller', 'called*'))
+    if snp_files:
+        snv_bytes = snv_size(snp_files)['bytes']
+    else:
+        snv_bytes = genome * SNVS_PER_BASE * (SNV_LINE_BYTES + SNV_SAMPLE_BYTES * len(bams))
+        notes.append('no SNV calls yet, assuming {:g} SNVs per base'.format(SNVS_PER_BASE))
+    shares = taxon_shares(lengths)
+    sizes = [{'bytes': snv_bytes, 'taxon_bytes': snv_bytes * shares.get(name, 0.)} for name in sorted(soi)]
+    _, footprints, _ = predict('filtering', sizes, 1)
+    workers = recommend_workers(footprints, cores, memory)
+    _, footprints, runtime = predict('filtering', sizes, workers)
+    estimates.append(StageEstimate('filtering', len(soi), workers, runtime, peak_memory(footprints, workers),
+                                   '--n_threads {}'.format(workers), '; '.join(notes)))
+
+    # distances and diversities: one task per taxon
+    filt_dir = os.path.join(project_dir, 'filtered', 'pop')
+    sizes = []
+    for name, samples in sorted(soi.items()):
+        filt_file = find_file(os.path.join(filt_dir, '{}.filtered.freq'.format(name)))
+        if filt_file:
+            sizes.append(freq_size(filt_file))
+        else:
+            lines = snv_bytes / (SNV_LINE_BYTES + SNV_SAMPLE_BYTES * len(bams)) \
+                * taxon_bases.get(name, 0) / max(1, genome)
+            sizes.append({'rows': round(lines * FILTERED_FRACTION * ALLELES_PER_SNV), 'samples': len(samples)})
+    per_taxon = {}
+    for stage in ['distances', 'diversity']:
+        _, footprints, _ = predict(stage, sizes, 1)
+        workers = recommend_workers(footprints, cores, memory)
+        durations, footprints, runtime = predict(stage, sizes, workers)
+        note = ''
+        if footprints and max(footprints) + WORKER_MEMORY > memory:
+            note = 'the largest taxon does not fit into memory, try --precision float32 or --approx'
+        estimates.append(StageEstimate(stage, len(sizes), workers, runtime, peak_memory(footprints, workers),
+                                       '--n_threads {}'.format(workers), note))
+        per_taxon[stage] = list(zip(durations, footprints))
+
+    taxa = [(name, size['samples'], size['rows'], *per_taxon['distances'][k], *per_taxon['diversity'][k])
+            for k, (name, size) in enumerate(zip(sorted(soi), sizes))]
+    return estimates, taxa
+
+
+def system_memory() -> float:
+    """Physical memory of the machine in bytes."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def format_memory(size: float) -> str:
+    if size < 2 ** 30:
+        return '{:.0f} MB'.format(size / 2 ** 20)
+    return '{:.1f} GB'.format(size / 2 ** 30)
+
+
+def write_report(estimates: List[StageEstimate], taxa: List[Tuple], out, top: int = 20):
+    """Print the estimates as tables."""
+    out.write('{:<10} {:<34} {:>6} {:>8} {:>10} {:>12}  {}\n'.format(
+        'stage', 'command', 'tasks', 'workers', 'runtime', 'peak memory', 'recommended'))
+    for e in estimates:
+        out.write('{:<10} {:<34} {:>6} {:>8} {:>10} {:>12}  {}\n'.format(
+            e.stage, STAGES[e.stage].command, e.tasks, e.workers, format_duration(e.runtime),
+            format_memory(e.memory), e.option))
+    notes = [(e.stage, e.note) for e in estimates if e.note]
+    if notes:
+        out.write('\n')
+        for stage, note in notes:
+            out.write('{}: {}\n'.format(stage, note))
+    if taxa:
+        out.write('\nLargest taxa (distances, and each of --div/--divNS)\n\n')
+        out.write('{:<30} {:>8} {:>12} {:>10} {:>12} {:>10} {:>12}\n'.format(
+            'taxon', 'samples', 'rows', 'dist time', 'dist memory', 'div time', 'div memory'))
+        for name, samples, rows, dist_time, dist_memory, div_time, div_memory in sorted(
+                taxa, key=lambda t: -(t[4] + t[6]))[:top]:
+            out.write('{:<30} {:>8} {:>12} {:>10} {:>12} {:>10} {:>12}\n'.format(
+                name, samples, rows, format_duration(dist_time), format_memory(dist_memory),
+                format_duration(div_time), format_memory(div_memory)))
@@ -0,0 +1,264 @@
+import io
+import os
+import glob
+import gzip
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import List, Optional
+
+try:
+    import zstandard
+except ImportError as err:
+    zstandard = err
+
+COMPRESSION_SUFFIXES = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# uncompressed bytes per independently compressed gzip member
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compression_of(filepath: str) -> str:
+    """Compression of a file, from its extension."""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and filepath.endswith(suffix):
+            return compression
+    return 'none'
+
+
+def with_compression(filepath: str, compression: str) -> str:
+    """Path of ``filepath`` with the extension of ``compression`` appended."""
+    return filepath + COMPRESSION_SUFFIXES[compression]
+
+
+def strip_compression(filepath: str) -> str:
+    """Path of ``filepath`` without its compression extension."""
+    suffix = COMPRESSION_SUFFIXES[compression_of(filepath)]
+    return filepath[:-len(suffix)] if suffix else filepath
+
+
+def find_file(filepath: str) -> Optional[str]:
+    """The existing (plain or compressed) variant of ``filepath``, or None."""
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if os.path.isfile(filepath + suffix):
+            return filepath + suffix
+    return None
+
+
+def glob_compressed(pattern: str) -> List[str]:
+    """Like glob.glob, also matching compressed variants of the files (sorted)."""
+    return sorted({f for suffix in COMPRESSION_SUFFIXES.values() for f in glob.glob(pattern + suffix)})
+
+
+def _require_zstandard():
+    if isinstance(zstandard, ImportError):
+        raise RuntimeError("The 'zstandard' package is necessary for .zst files") from zstandard
+
+
+class BlockGzipWriter(io.RawIOBase):
+    """
+    Write a gzip file by compressing blocks of data as independent gzip
+    members on background threads (like pigz). zlib releases the GIL, so
+    the caller keeps producing data while earlier blocks are compressed.
+    """
+
+    def __init__(self, fileobj, threads: int = 2, compresslevel: int = 6):
+        self._fileobj = fileobj
+        self._compresslevel = compresslevel
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._max_pending = 2 * threads
+        self._buffer = bytearray()
+        self._submitted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        if len(self._buffer) >= BLOCK_SIZE:
+            self._submit()
+        return len(b)
+
+    def _submit(self):
+        block = bytes(self._buffer)
+        self._buffer.clear()
+        self._submitted = True
+        self._pending.append(self._pool.submit(gzip.compress, block, self._compresslevel, mtime=0))
+        # bound memory: wait for the oldest block once enough are in flight
+        while len(self._pending) > self._max_pending or (self._pending and self._pending[0].done()):
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # an empty file is still a gzip member
+            if self._buffer or not self._submitted:
+                self._submit()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._fileobj.close()
+            super().close()
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Read (and decompress) a stream on a background thread, handing the
+    data over in chunks through a bounded queue.
+    """
+
+    def __init__(self, stream, chunk_size: int = 1024 * 1024, prefetch: int = 4):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._stream.read(self._chunk_size)
+                self._queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception as err:
+            self._queue.put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk:
+            if self._eof:
+                return 0
+            chunk = self._queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(chunk)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self._stop.set()
+        # unblock the reading thread if it waits on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._stream.close()
+        super().close()
+
+
+def open_file(filepath: str, mode: str = 'rt', threads: int = 2):
+    """
+    Open a plain, gzip (.gz) or zstd (.zst) file, depending on its extension.
+
+    Compressed files are compressed or decompressed on background threads.
+    Plain files are opened with the builtin open.
+
+    Args:
+        filepath (str): path to the file.
+        mode (str): one of 'r', 'rt', 'rb', 'w', 'wt', 'wb'.
+        threads (int): compression threads per file written.
+    """
+    compression = compression_of(filepath)
+    if compression == 'none':
+        return open(filepath, mode)
+
+    binary = 'b' in mode
+    if mode[0] == 'r':
+        if compression == 'gzip':
+            stream = gzip.open(filepath, 'rb')
+        else:
+            _require_zstandard()
+            stream = zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'),
+                                                                 read_across_frames=True,
+                                                                 closefd=True)
+        handle = io.BufferedReader(ThreadedReader(stream))
+    elif mode[0] == 'w':
+        if compression == 'gzip':
+            raw = BlockGzipWriter(open(filepath, 'wb'), threads=threads)
+            handle = io.BufferedWriter(raw, buffer_size=1024 * 1024)
+        else:
+            _require_zstandard()
+            handle = zstandard.ZstdCompressor(threads=threads).stream_writer(open(filepath, 'wb'),
+                                                                            closefd=True)
+    else:
+        raise ValueError(f"Mode '{mode}' not supported")
+
+    if binary:
+        return handle
+    return io.TextIOWrapper(handle, encoding='utf-8')
+
+
+class CompressingFifo:
+    """
+    Named pipe that a subprocess can write to like a regular file; what it
+    writes is stored in ``filepath`` (compressed according to its extension)
+    by a background thread.
+
+    Usage::
+
+        with CompressingFifo('indiv_called.gz') as fifo:
+            subprocess.call(['snpCall', '-i', fifo.path])
+
+    An error of the background thread (e.g. a full disk) is raised when the
+    block exits.
+    """
+
+    def __init__(self, filepath: str, threads: int = 2):
+        self.filepath = filepath
+        self.threads = threads
+        self.path = None
+        self._error = None
+
+    def _copy(self):
+        try:
+            with open(self.path, 'rb') as src, open_file(self.filepath, 'wb', threads=self.threads) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except BaseException as e:
+            self._error = e
+
+    def __enter__(self):
+        self._tmpdir = tempfile.mkdtemp(prefix='metaSNV_fifo_')
+        self.path = os.path.join(self._tmpdir, os.path.basename(self.filepath))
+        os.mkfifo(self.path)
+        self._thread = threading.Thread(target=self._copy, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # if the writer never opened the pipe, the copying thread still waits for it
+        self._thread.join(timeout=0.1)
+        while self._thread.is_alive():
+            try:
+                os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self._thread.join(timeout=0.1)
+        shutil.rmtree(self._tmpdir)
+        if self._error is not None and exc_type is None:
+            raise self._error
+        return False
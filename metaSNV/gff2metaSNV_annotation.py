@@ -1,72 +1,195 @@
-# This script transforms an annotation file of the .gff format into 
-# an annotation file that fulfils the requirements for metaSNV.py.
+#!/usr/bin/env python
+# This script transforms one or more annotation files of the .gff format into
+# an annotation file that fulfils the requirements for metaSNV.py (--db_ann).
+import argparse
+import gzip
+import sys
+from itertools import islice
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
-import sys
+from pandas.api.types import union_categoricals
+
+from typing import Dict, List, Optional
+
+GFF_COLUMNS = ["seqid", "source", "type", "start", "end",
+               "score", "strand", "phase", "attributes"]
+
+# GFF records per DataFrame chunk of read_gff, and columns with few distinct values kept as categories
+CHUNK_RECORDS = 100000
+CATEGORY_COLUMNS = ["seqid", "source", "type", "score", "strand", "phase"]
+
+ANNOTATION_COLUMNS = ["gene_id", "external_id", "sequence_id",
+                      "type", "gene_info", "length", "start", "end",
+                      "strand", "start_codon", "stop_codon", "gc"]
+
+
+def open_text(filepath: str, mode: str = 'rt'):
+    """Open a plain or gzip-compressed text file."""
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, mode)
+    return open(filepath, mode)
+
+
+def iter_features(handle, feature_type: Optional[str] = "CDS"):
+    """
+    Stream feature records from a GFF file.
+
+    Comment and directive lines are skipped and reading stops at the
+    ``##FASTA`` section. Only records of ``feature_type`` are yielded
+    (all records if ``feature_type`` is None).
+    """
+    for line in handle:
+        if line.startswith('#'):
+            if line.startswith('##FASTA'):
+                break
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 9:
+            continue
+        if feature_type is not None and fields[2] != feature_type:
+            continue
+        yield fields
+
+
+def read_gff(filepath: str, feature_type: Optional[str] = "CDS",
+             chunk_records: int = CHUNK_RECORDS) -> pd.DataFrame:
+    """
+    Read the features of a (optionally gzipped) GFF file into a DataFrame.
+
+    Records are converted to DataFrame chunks of ``chunk_records`` while
+    streaming, so only one chunk is held as Python lists at a time, and
+    columns with few distinct values are stored as categories.
+
+    Args:
+        filepath (str): path to the GFF file.
+        feature_type (str): feature type to keep, None keeps all.
+        chunk_records (int): records per chunk.
+    """
+    chunks = []
+    with open_text(filepath) as gff:
+        records = iter_features(gff, feature_type)
+        while True:
+            fields = list(islice(records, chunk_records))
+            # column by column, so that no block of all fields outlives the chunk
+            columns = list(zip(*fields)) if fields else [()] * len(GFF_COLUMNS)
+            del fields
+            chunk = pd.DataFrame({column: pd.Categorical(values) if column in CATEGORY_COLUMNS
+                                  else np.array(values, dtype='int64') if column in ("start", "end") else values
+                                  for column, values in zip(GFF_COLUMNS, columns)})
+            del columns
+            if len(chunk) or not chunks:
+                chunks.append(chunk)
+            if len(chunk) < chunk_records:
+                break
+    if len(chunks) == 1:
+        return chunks[0]
+    # chunks have categories of their own
+    return pd.DataFrame({column: union_categoricals([chunk[column] for chunk in chunks])
+                         if column in CATEGORY_COLUMNS else pd.concat([chunk[column] for chunk in chunks],
+                                                                     ignore_index=True)
+                         for column in GFF_COLUMNS})
+
 
-# these paths need to to be adjusted
-input_gff            = r"path\annotations.gff"
-output_folder        = r"path\folder\\"
-
-# optional, set rename_contigs = True if renaming contigs is necessary
-rename_contigs       = False
-contig_keys_path     = r"path\ids_key.txt"
-
-
-# read in the .gff annotation file and create the intermediate file
-check = 0
-with open(input_gff,"r") as gff:
-    with open(output_folder + "intermediate.txt","w+") as out:
-        for line in gff:
-            if check == 0:
-                if line.startswith("##") == False:
-                    out.write(line)
-                    check = 1
-                else: pass
-            elif check == 1:
-                if line.startswith("##") == False:
-                    out.write(line)
-                else: break
-                    
-# read out the relevant annotation data from the intermediate file
-gff_data = pd.read_csv(output_folder + r"\intermediate.txt", header = None, sep="\t")
-
-# use the contig keys file to rename the contigs
-if rename_contigs:
-    contig_keys = pd.read_csv(contig_keys_path, header = None, sep="\t")
-    contig_keys.rename(columns ={0:"contig_name",1:"prokka_id"}, inplace=True)
-    merged = pd.merge(gff_data, contig_keys, left_on=0, right_on="prokka_id", how="left")
-    if len(merged) != len(gff_data): sys.exit("Unique merge is necessary.")
-
-# create a dataframe for the metaSNV annotation format
-metaSNV = pd.DataFrame(columns = ["gene_id","external_id","sequence_id",
-                                  "type","gene_info","length","start","end",
-                                 "strand","start_codon","stop_codon","gc"])
-# transform the .gff data to fit the metaSNV annotation format
-count_seqid = {}
-for i in range(0,len(gff_data)):
-    metaSNV.loc[i,"sequence_id"]  = gff_data.loc[i,0]
-    if rename_contigs:
-        metaSNV.loc[i,"sequence_id"]  = merged.loc[i,"contig_name"]
-    metaSNV.loc[i,"type"]         = gff_data.loc[i,2]
-    metaSNV.loc[i,"gene_info"]    = "<annotation {}>".format(gff_data.loc[i,8])
-    metaSNV.loc[i,"start"]        = gff_data.loc[i,3]
-    metaSNV.loc[i,"end"]          = gff_data.loc[i,4]
-    metaSNV.loc[i,"length"]       = (metaSNV.loc[i,"end"] - metaSNV.loc[i,"start"]) + 1
-    metaSNV.loc[i,"strand"]       = gff_data.loc[i,6]
-    metaSNV.loc[i,"start_codon"]  = ""
-    metaSNV.loc[i,"stop_codon"]   = ""
-    metaSNV.loc[i,"gc"]           = ""
-    
-metaSNV = metaSNV[metaSNV.type == "CDS"] #remove non-CDS entries
-metaSNV.reset_index(drop=True, inplace= True)
-for i in range(0,len(metaSNV)):
-    if metaSNV.loc[i,"sequence_id"] in count_seqid:
-        count_seqid[metaSNV.loc[i,"sequence_id"]] += 1
+def load_contig_keys(filepath: str) -> Dict[str, str]:
+    """
+    Read a two-column (contig name, GFF sequence id) mapping file.
+    """
+    keys = pd.read_csv(filepath, header=None, sep="\t", dtype=str,
+                       names=["contig_name", "gff_id"])
+    if keys["gff_id"].duplicated().any():
+        raise ValueError(f"Duplicated sequence ids in '{filepath}'. Unique merge is necessary.")
+    return dict(zip(keys["gff_id"], keys["contig_name"]))
+
+
+def gff_to_annotation(gff_data: pd.DataFrame,
+                      contig_keys: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """
+    Build a metaSNV annotation table from GFF features.
+
+    Genes are numbered consecutively (``gene_id``) and per contig
+    (``external_id`` = ``<contig>.<n>``). snpCall expects all genes of a
+    contig to be adjacent, so contigs are kept together in order of first
+    appearance.
+    """
+    sequence_id = gff_data["seqid"]
+    if contig_keys is not None:
+        sequence_id = sequence_id.map(contig_keys)
+        missing = gff_data.loc[sequence_id.isna(), "seqid"].unique()
+        if len(missing):
+            raise ValueError(f"No contig name found for sequence ids: {', '.join(missing[:5])}")
+
+    annotation = pd.DataFrame({
+        "sequence_id": sequence_id.values,
+        "type": gff_data["type"].values,
+        "gene_info": ("<annotation " + gff_data["attributes"] + ">").values,
+        "length": (gff_data["end"] - gff_data["start"] + 1).values,
+        "start": gff_data["start"].values,
+        "end": gff_data["end"].values,
+        "strand": gff_data["strand"].values,
+        "start_codon": "",
+        "stop_codon": "",
+        "gc": "",
+    })
+
+    # group contigs together, keeping order of first appearance
+    contig_order = annotation["sequence_id"].drop_duplicates().tolist()
+    annotation["sequence_id"] = pd.Categorical(annotation["sequence_id"], categories=contig_order)
+    annotation = annotation.sort_values("sequence_id", kind="stable").reset_index(drop=True)
+    annotation["sequence_id"] = annotation["sequence_id"].astype(str)
+
+    gene_number = annotation.groupby("sequence_id", sort=False).cumcount() + 1
+    annotation["external_id"] = annotation["sequence_id"] + "." + gene_number.astype(str)
+    annotation["gene_id"] = range(1, len(annotation) + 1)
+
+    return annotation[ANNOTATION_COLUMNS]
+
+
+def convert(gff_filepaths: List[str], output_filepath: str,
+            contig_keys_filepath: Optional[str] = None, threads: int = 1):
+    """
+    Convert GFF files into a single metaSNV annotation file.
+
+    Args:
+        gff_filepaths (list): paths to GFF files (plain or gzipped).
+        output_filepath (str): path to the annotation file to write.
+        contig_keys_filepath (str): optional contig renaming table.
+        threads (int): number of GFF files to parse simultaneously.
+    """
+    if threads > 1 and len(gff_filepaths) > 1:
+        with Pool(min(threads, len(gff_filepaths))) as p:
+            tables = p.map(read_gff, gff_filepaths)
     else:
-        count_seqid[metaSNV.loc[i,"sequence_id"]] = 1
-    metaSNV.loc[i,"external_id"]  = "{}.{}".format(metaSNV.loc[i,"sequence_id"], count_seqid[metaSNV.loc[i,"sequence_id"]])
-    metaSNV.loc[i,"gene_id"]      = i+1
+        tables = [read_gff(f) for f in gff_filepaths]
+
+    gff_data = pd.concat(tables, ignore_index=True)
+    contig_keys = None
+    if contig_keys_filepath:
+        contig_keys = load_contig_keys(contig_keys_filepath)
+
+    annotation = gff_to_annotation(gff_data, contig_keys)
+    annotation.to_csv(output_filepath, sep="\t", index=False)
+    return annotation
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert GFF annotations into the metaSNV gene annotation format (--db_ann)')
+    parser.add_argument('gff', metavar='GFF_FILE', nargs='+',
+                        help='GFF annotation file(s), optionally gzipped.')
+    parser.add_argument('-o', '--output', metavar='FILE', required=True,
+                        help='Output annotation file.')
+    parser.add_argument('--contig_keys', metavar='FILE', default=None,
+                        help=('Tab-separated file with the contig name and the GFF sequence id per line, '
+                              'used to rename the contigs.'))
+    parser.add_argument('--threads', metavar='INT', default=1, type=int,
+                        help='Number of GFF files to parse simultaneously.')
+    args = parser.parse_args()
+
+    annotation = convert(args.gff, args.output, args.contig_keys, args.threads)
+    sys.stderr.write("Wrote {} CDS to {}\n".format(len(annotation), args.output))
+
 
-#output the transformed .gff data into a metaSNV annotation file 
-metaSNV.to_csv(output_folder + r"\metaSNV_anntotations.txt", mode="w+", sep="\t", index = False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
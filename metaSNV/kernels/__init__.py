@@ -0,0 +1,17 @@
+"""
+Hot loops of the pipeline.
+
+The Cython versions (`metaSNV.kernels._compiled`, built by setup.py) are
+used when available, otherwise the pure-Python versions of
+`metaSNV.kernels.python`. Both give identical results.
+"""
+try:
+    from metaSNV.kernels._compiled import (parse_snv_line, count_covered, allele_frequencies, accumulate_depth,
+                                           accumulate_pileup, split_read_groups, merge_pileup_lines,
+                                           pairwise_distances, cross_distances, pair_diversity, position_diversity)
+    COMPILED = True
+except ImportError:
+    from metaSNV.kernels.python import (parse_snv_line, count_covered, allele_frequencies, accumulate_depth,
+                                        accumulate_pileup, split_read_groups, merge_pileup_lines,
+                                        pairwise_distances, cross_distances, pair_diversity, position_diversity)
+    COMPILED = False
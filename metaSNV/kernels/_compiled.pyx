@@ -0,0 +1,467 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False, cdivision=True
+"""
+Compiled versions of the kernels in `metaSNV.kernels.python`.
+
+The floating-point kernels reproduce the summation order of numpy
+(pairwise summation, casting reductions in buffers) and pandas (Kahan
+summation in group sums), so that their results are bit-identical to
+the pure-Python versions.
+"""
+from cython cimport floating
+from libc.math cimport fabs
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcmp
+
+import numpy as np
+
+cdef enum:
+    # blocksize of numpy's pairwise summation
+    PW_BLOCKSIZE = 128
+    # numpy's default ufunc buffer size, in elements
+    BUFSIZE = 8192
+
+
+cdef double _pairwise_sum(const double* a, Py_ssize_t n) noexcept nogil:
+    cdef double res
+    cdef double r[8]
+    cdef Py_ssize_t i, n2
+    if n < 8:
+        res = 0.
+        for i in range(n):
+            res += a[i]
+        return res
+    elif n <= PW_BLOCKSIZE:
+        for i in range(8):
+            r[i] = a[i]
+        i = 8
+        while i < n - n % 8:
+            r[0] += a[i]
+            r[1] += a[i + 1]
+            r[2] += a[i + 2]
+            r[3] += a[i + 3]
+            r[4] += a[i + 4]
+            r[5] += a[i + 5]
+            r[6] += a[i + 6]
+            r[7] += a[i + 7]
+            i += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res += a[i]
+            i += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return _pairwise_sum(a, n2) + _pairwise_sum(a + n2, n - n2)
+
+
+cdef double _sum(const double* a, Py_ssize_t n, bint buffered) noexcept nogil:
+    """np.sum(x, dtype=np.float64) of the values ``a``, cast from float32 if ``buffered``."""
+    cdef double acc = 0.
+    cdef Py_ssize_t start = 0
+    if not buffered:
+        return acc + _pairwise_sum(a, n)
+    while start < n:
+        acc += _pairwise_sum(a + start, min(<Py_ssize_t> BUFSIZE, n - start))
+        start += BUFSIZE
+    return acc
+
+
+# --- called_SNPs parsing -----------------------------------------------------
+
+cdef inline long _parse_int(const char** p) except? -1:
+    cdef const char* q = p[0]
+    cdef long value = 0
+    if not (c'0' <= q[0] <= c'9'):
+        raise ValueError("Malformed SNV line: expected a number")
+    while c'0' <= q[0] <= c'9':
+        value = value * 10 + (q[0] - c'0')
+        q += 1
+    p[0] = q
+    return value
+
+
+cdef inline const char* _skip_past(const char* p, char sep) except NULL:
+    while p[0] != sep:
+        if p[0] == 0:
+            raise ValueError("Malformed SNV line: missing field")
+        p += 1
+    return p + 1
+
+
+def parse_snv_line(str line):
+    cdef bytes data = line.encode('ascii')
+    cdef const char* start = data
+    cdef const char* p = start
+    cdef const char* field
+    cdef int i
+    cdef list site_coverage = []
+    cdef list alleles = []
+    cdef list counts
+
+    for i in range(4):
+        p = _skip_past(p, c'\t')
+    while True:
+        site_coverage.append(_parse_int(&p))
+        if p[0] != c'|':
+            break
+        p += 1
+    p = _skip_past(p, c'\t')
+
+    while True:
+        _parse_int(&p)
+        p = _skip_past(p, c'|')
+        field = p
+        p = _skip_past(p, c'|')
+        alt = line[field - start:p - start - 1]
+        field = p
+        p = _skip_past(p, c'|')
+        kind = line[field - start:p - start - 1]
+        counts = []
+        while True:
+            counts.append(_parse_int(&p))
+            if p[0] != c'|':
+                break
+            p += 1
+        alleles.append((alt, kind, counts))
+        if p[0] != c',':
+            break
+        p += 1
+    return site_coverage, alleles
+
+
+def count_covered(list site_coverage, list sample_indices, double min_cov):
+    cdef long n = 0
+    cdef long cov
+    for i in sample_indices:
+        cov = site_coverage[i]
+        if cov >= min_cov and cov != 0:
+            n += 1
+    return n
+
+
+def allele_frequencies(list counts, list site_coverage, list sample_indices, double min_cov):
+    cdef list freqs = []
+    cdef long cov
+    for i in sample_indices:
+        cov = site_coverage[i]
+        if cov >= min_cov and cov != 0:
+            freqs.append(<double> counts[i] / <double> cov)
+        else:
+            freqs.append(-1)
+    return freqs
+
+
+# --- BAM depth -----------------------------------------------------------------
+
+def accumulate_depth(str text, dict references):
+    cdef bytes data = text.encode()
+    cdef const char* p = data
+    cdef const char* end = p + len(data)
+    cdef const char* ref_start
+    cdef const char* last_ref = NULL
+    cdef Py_ssize_t ref_len, last_len = 0
+    cdef dict pos2cov = None
+    cdef long pos, cov
+
+    while p < end:
+        if p[0] == c'\n':
+            p += 1
+            continue
+        ref_start = p
+        p = _skip_past(p, c'\t')
+        ref_len = p - ref_start - 1
+        if last_ref == NULL or ref_len != last_len or memcmp(ref_start, last_ref, ref_len) != 0:
+            pos2cov = references[data[ref_start - <const char*> data:ref_start - <const char*> data + ref_len]
+                                 .decode()].pos2cov
+            last_ref = ref_start
+            last_len = ref_len
+        pos = _parse_int(&p)
+        p = _skip_past(p, c'\t')
+        cov = _parse_int(&p)
+        pos2cov[pos] = cov
+
+
+# --- read group and batched pileups -----------------------------------------------
+
+def split_read_groups(str line, list files, Py_ssize_t n_samples):
+    return merge_pileup_lines([line], [files], n_samples, 4)
+
+
+def merge_pileup_lines(list lines, list batches, Py_ssize_t n_samples, Py_ssize_t n_fields):
+    cdef list fields, files, head = None
+    cdef list bases = [[] for _ in range(n_samples)]
+    cdef list quals = [[] for _ in range(n_samples)]
+    cdef list groups, out
+    cdef dict columns
+    cdef str file_bases, file_quals
+    cdef Py_ssize_t b, k, i, offset
+    for b in range(len(lines)):
+        if lines[b] is None:
+            continue
+        fields = (<str> lines[b]).rstrip('\n').split('\t')
+        if head is None:
+            head = fields[:3]
+        files = <list> batches[b]
+        for k in range(len(files)):
+            offset = 3 + n_fields * k
+            if fields[offset] == '0':
+                continue
+            file_bases = fields[offset + 1]
+            file_quals = fields[offset + 2]
+            target = files[k]
+            if isinstance(target, int):
+                (<list> bases[target]).append(file_bases)
+                (<list> quals[target]).append(file_quals)
+                continue
+            columns = <dict> target
+            groups = (<str> fields[offset + 3]).split(',')
+            for i in range(min(len(file_bases), len(file_quals), len(groups))):
+                column = columns.get(groups[i])
+                if column is not None:
+                    (<list> bases[column]).append(file_bases[i])
+                    (<list> quals[column]).append(file_quals[i])
+    out = head
+    for k in range(n_samples):
+        file_bases = ''.join(bases[k])
+        out += [str(len(file_bases)), file_bases or '*', ''.join(quals[k]) or '*']
+    return '\t'.join(out) + '\n'
+
+
+# --- pileup coverage -------------------------------------------------------------
+
+def accumulate_pileup(str line, dict totals, Py_ssize_t n_samples):
+    cdef bytes data = line.encode()
+    cdef const char* start = data
+    cdef const char* p = start
+    cdef long long[:, ::1] total
+    cdef Py_ssize_t k
+    cdef long depth
+    p = _skip_past(p, c'\t')
+    ref = data[:p - start - 1].decode()
+    array = totals.get(ref)
+    if array is None:
+        array = totals[ref] = np.zeros((2, n_samples), dtype=np.int64)
+    total = array
+    p = _skip_past(_skip_past(p, c'\t'), c'\t')
+    for k in range(n_samples):
+        depth = _parse_int(&p)
+        total[0, k] += depth
+        if depth > 0:
+            total[1, k] += 1
+        if k + 1 < n_samples:
+            p = _skip_past(_skip_past(_skip_past(p, c'\t'), c'\t'), c'\t')
+
+
+# --- distances and diversity -----------------------------------------------------
+
+cdef inline void _distances(const floating[::1] x, const floating[::1] y, double threshold, bint buffered,
+                            double* buf, double* mann, double* allele) noexcept nogil:
+    cdef Py_ssize_t k, cnt = 0, over = 0
+    cdef Py_ssize_t length = x.shape[0]
+    cdef floating d
+    for k in range(length):
+        d = fabs(x[k] - y[k])
+        if d != d:
+            buf[k] = 0.
+        else:
+            buf[k] = d
+            cnt += 1
+        # difference taken in float64 so that float32 frequencies compare to the threshold like float64 ones
+        if fabs(<double> x[k] - <double> y[k]) > threshold:
+            over += 1
+    # 0 / 0 gives NaN, like np.nanmean and np.mean
+    mann[0] = _sum(buf, length, buffered) / <double> cnt
+    allele[0] = over / <double> length
+
+
+def pairwise_distances(const floating[:, ::1] values, double threshold=.6):
+    cdef Py_ssize_t n = values.shape[0]
+    cdef Py_ssize_t i, j
+    cdef bint buffered = floating is float
+    cdef double* buf
+    mann = np.empty((n, n))
+    allele = np.empty((n, n))
+    cdef double[:, ::1] mann_v = mann
+    cdef double[:, ::1] allele_v = allele
+
+    buf = <double*> malloc(max(values.shape[1], 1) * sizeof(double))
+    if buf == NULL:
+        raise MemoryError()
+    with nogil:
+        for j in range(n):
+            for i in range(j, n):
+                _distances(values[i], values[j], threshold, buffered, buf, &mann_v[j, i], &allele_v[j, i])
+                mann_v[i, j] = mann_v[j, i]
+                allele_v[i, j] = allele_v[j, i]
+    free(buf)
+    return mann, allele
+
+
+def cross_distances(const floating[:, ::1] rows, const floating[:, ::1] values, double threshold=.6):
+    cdef Py_ssize_t n_rows = rows.shape[0]
+    cdef Py_ssize_t n = values.shape[0]
+    cdef Py_ssize_t i, j
+    cdef bint buffered = floating is float
+    cdef double* buf
+    if rows.shape[1] != values.shape[1]:
+        raise ValueError("rows and values have different numbers of positions")
+    mann = np.empty((n_rows, n))
+    allele = np.empty((n_rows, n))
+    cdef double[:, ::1] mann_v = mann
+    cdef double[:, ::1] allele_v = allele
+
+    buf = <double*> malloc(max(values.shape[1], 1) * sizeof(double))
+    if buf == NULL:
+        raise MemoryError()
+    with nogil:
+        for j in range(n_rows):
+            for i in range(n):
+                _distances(values[i], rows[j], threshold, buffered, buf, &mann_v[j, i], &allele_v[j, i])
+    free(buf)
+    return mann, allele
+
+
+cdef inline double _group_diversity(const floating[::1] s1, const floating[::1] s2, Py_ssize_t pos, Py_ssize_t k,
+                                   floating* va, floating* vb, double* out, double* diag, bint buffered) noexcept nogil:
+    # every allele is repeated k - 1 times, followed by the remaining frequency
+    cdef Py_ssize_t m = k * (k - 1) + 1
+    cdef Py_ssize_t rep, i, j
+    cdef floating one = 1
+    cdef floating s, c, y, t
+    for rep in range(k - 1):
+        for i in range(k):
+            va[rep * k + i] = s1[pos + i]
+            vb[rep * k + i] = s2[pos + i]
+    # Kahan summation, skipping NaNs
+    s = 0
+    c = 0
+    for i in range(m - 1):
+        if va[i] == va[i]:
+            y = va[i] - c
+            t = s + y
+            c = t - s - y
+            s = t
+    va[m - 1] = one - s
+    s = 0
+    c = 0
+    for i in range(m - 1):
+        if vb[i] == vb[i]:
+            y = vb[i] - c
+            t = s + y
+            c = t - s - y
+            s = t
+    vb[m - 1] = one - s
+    for i in range(m):
+        for j in range(m):
+            t = va[i] * vb[j]
+            out[i * m + j] = t if t == t else 0.
+        diag[i] = out[i * m + i]
+    return _sum(out, m * m, buffered) - _sum(diag, m, buffered)
+
+
+cdef inline double _single_diversity(floating a, floating b) noexcept nogil:
+    cdef floating one = 1
+    return a * (one - b) + (one - a) * b
+
+
+def pair_diversity(const floating[::1] s1, const floating[::1] s2, const Py_ssize_t[::1] runs):
+    cdef Py_ssize_t n = s1.shape[0]
+    cdef Py_ssize_t n_runs = runs.shape[0]
+    cdef Py_ssize_t r, k, pos, max_m = 1, n_terms = 0, n_groups = 0
+    cdef bint buffered = floating is float
+    cdef floating a, b
+    cdef floating* va
+    cdef floating* vb
+    cdef double* terms
+    cdef double* groups
+    cdef double* out
+    cdef double* diag
+    cdef double dist_nd, dist_d
+
+    for r in range(n_runs):
+        if runs[r] > 1:
+            max_m = max(max_m, runs[r] * (runs[r] - 1) + 1)
+            n_groups += 1
+
+    terms = <double*> malloc(max(n, 1) * sizeof(double))
+    groups = <double*> malloc(max(n_groups, 1) * sizeof(double))
+    out = <double*> malloc(max_m * max_m * sizeof(double))
+    diag = <double*> malloc(max_m * sizeof(double))
+    va = <floating*> malloc(max_m * sizeof(floating))
+    vb = <floating*> malloc(max_m * sizeof(floating))
+    if not (terms and groups and out and diag and va and vb):
+        free(terms); free(groups); free(out); free(diag); free(va); free(vb)
+        raise MemoryError()
+
+    with nogil:
+        # positions with a single alternative allele
+        pos = 0
+        for r in range(n_runs):
+            if runs[r] == 1:
+                a = s1[pos]
+                b = s2[pos]
+                if a == a and b == b:
+                    # rounded to the precision of the frequencies, like numpy
+                    terms[n_terms] = <floating> _single_diversity(a, b)
+                    n_terms += 1
+            pos += runs[r]
+        dist_nd = _sum(terms, n_terms, buffered)
+
+        # positions with several alternative alleles
+        pos = 0
+        n_groups = 0
+        for r in range(n_runs):
+            k = runs[r]
+            if k > 1:
+                groups[n_groups] = _group_diversity(s1, s2, pos, k, va, vb, out, diag, buffered)
+                n_groups += 1
+            pos += k
+        dist_d = _pairwise_sum(groups, n_groups)
+
+    free(terms); free(groups); free(out); free(diag); free(va); free(vb)
+    # numpy scalar like the pure-Python version, so that it keeps float64 when divided by float32
+    if not n_groups:
+        return np.float64(dist_nd)
+    return np.float64(dist_d + dist_nd)
+
+
+def position_diversity(const floating[::1] s1, const floating[::1] s2, const Py_ssize_t[::1] runs):
+    cdef Py_ssize_t n_runs = runs.shape[0]
+    cdef Py_ssize_t r, k, pos, max_m = 1
+    cdef bint buffered = floating is float
+    cdef floating a, b
+    cdef floating* va
+    cdef floating* vb
+    cdef double* out
+    cdef double* diag
+
+    for r in range(n_runs):
+        if runs[r] > 1:
+            max_m = max(max_m, runs[r] * (runs[r] - 1) + 1)
+    contributions = np.zeros(n_runs)
+    cdef double[::1] contributions_v = contributions
+
+    out = <double*> malloc(max_m * max_m * sizeof(double))
+    diag = <double*> malloc(max_m * sizeof(double))
+    va = <floating*> malloc(max_m * sizeof(floating))
+    vb = <floating*> malloc(max_m * sizeof(floating))
+    if not (out and diag and va and vb):
+        free(out); free(diag); free(va); free(vb)
+        raise MemoryError()
+
+    with nogil:
+        pos = 0
+        for r in range(n_runs):
+            k = runs[r]
+            if k == 1:
+                a = s1[pos]
+                b = s2[pos]
+                if a == a and b == b:
+                    contributions_v[r] = <floating> _single_diversity(a, b)
+            else:
+                contributions_v[r] = _group_diversity(s1, s2, pos, k, va, vb, out, diag, buffered)
+            pos += k
+
+    free(out); free(diag); free(va); free(vb)
+    return contributions
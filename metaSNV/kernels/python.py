@@ -0,0 +1,216 @@
+"""
+Pure-Python reference implementations of the kernels, used when the
+compiled module is not built.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def parse_snv_line(line: str) -> Tuple[List[int], List[Tuple[str, str, List[int]]]]:
+    """
+    Parse the coverage and allele fields of a snpCall output line.
+
+    Returns:
+        tuple: per-sample site coverage and, per alternative allele, a
+        (base, type, per-sample counts) tuple.
+    """
+    fields = line.rstrip('\n').split('\t')
+    site_coverage = list(map(int, fields[4].split('|')))
+    alleles = []
+    for allele in fields[5].split(','):
+        parts = allele.split('|')
+        alleles.append((parts[1], parts[2], list(map(int, parts[3:]))))
+    return site_coverage, alleles
+
+
+def count_covered(site_coverage: List[int], sample_indices: List[int], min_cov: float) -> int:
+    """Number of samples in ``sample_indices`` with a (non-zero) coverage of at least ``min_cov``."""
+    return sum(1 for i in sample_indices if site_coverage[i] >= min_cov and site_coverage[i] != 0)
+
+
+def allele_frequencies(counts: List[int], site_coverage: List[int], sample_indices: List[int],
+                       min_cov: float) -> list:
+    """Allele frequency per sample in ``sample_indices``, -1 where the coverage is below ``min_cov``."""
+    return [counts[i] / site_coverage[i] if site_coverage[i] >= min_cov and site_coverage[i] != 0 else -1
+            for i in sample_indices]
+
+
+def accumulate_depth(text: str, references: Dict):
+    """Add the coverage of 'ref\\tpos\\tdepth' lines (samtools depth) to their BAMReference."""
+    for line in text.split('\n'):
+        if line:
+            ref, pos, cov = line.split('\t')
+            references[ref].pos2cov[int(pos)] = int(cov)
+
+
+def split_read_groups(line: str, files: List, n_samples: int) -> str:
+    """
+    Split a 'samtools mpileup --output-extra RG' line, with one base per
+    read (see `metaSNV.read_groups`), into the count, bases and qualities of
+    every sample. ``files`` gives per input file the sample column of all its
+    reads (int) or of each of its read groups (dict, other reads are left out).
+    """
+    return merge_pileup_lines([line], [files], n_samples, 4)
+
+
+def merge_pileup_lines(lines: List, batches: List[List], n_samples: int, n_fields: int) -> str:
+    """
+    Merge the lines of one position of the pileups of several batches of
+    input files (None for batches without the position), with one base per
+    read, into the count, bases and qualities of every sample. ``batches``
+    gives per batch the sample columns of its files as in `split_read_groups`,
+    ``n_fields`` the fields per file (3, or 4 with the read groups).
+    """
+    head = None
+    bases = [[] for _ in range(n_samples)]
+    quals = [[] for _ in range(n_samples)]
+    for line, files in zip(lines, batches):
+        if line is None:
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if head is None:
+            head = fields[:3]
+        for k, target in enumerate(files):
+            count, file_bases, file_quals = fields[3 + n_fields * k:6 + n_fields * k]
+            if count == '0':
+                continue
+            if isinstance(target, int):
+                bases[target].append(file_bases)
+                quals[target].append(file_quals)
+                continue
+            groups = fields[6 + n_fields * k]
+            for base, qual, group in zip(file_bases, file_quals, groups.split(',')):
+                column = target.get(group)
+                if column is not None:
+                    bases[column].append(base)
+                    quals[column].append(qual)
+    out = head
+    for sample_bases, sample_quals in zip(bases, quals):
+        sample_bases = ''.join(sample_bases)
+        out += [str(len(sample_bases)), sample_bases or '*', ''.join(sample_quals) or '*']
+    return '\t'.join(out) + '\n'
+
+
+def accumulate_pileup(line: str, totals: Dict[str, np.ndarray], n_samples: int):
+    """
+    Add the depth of every sample at a 'samtools mpileup' line (count,
+    bases and qualities per sample) to ``totals[ref]``: the sum of the
+    depths (row 0) and the number of covered positions (row 1) per sample.
+    """
+    fields = line.rstrip('\n').split('\t')
+    total = totals.get(fields[0])
+    if total is None:
+        total = totals[fields[0]] = np.zeros((2, n_samples), dtype=np.int64)
+    depths = np.array(fields[3:3 + 3 * n_samples:3], dtype=np.int64)
+    total[0] += depths
+    total[1] += depths > 0
+
+
+def l1nonans(d1: np.ndarray, d2: np.ndarray) -> float:
+    return np.nanmean(np.abs(d1 - d2), dtype=np.float64)
+
+
+def alleledist(d1: np.ndarray, d2: np.ndarray, threshold: float = .6) -> float:
+    # difference taken in float64 so that float32 frequencies compare to the threshold like float64 ones
+    return (np.abs(np.subtract(d1, d2, dtype=np.float64)) > threshold).mean()
+
+
+def pairwise_distances(values: np.ndarray, threshold: float = .6) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Manhattan (mean absolute difference, ignoring NaNs) and allele
+    (fraction of positions differing by more than ``threshold``) distances
+    between all rows of ``values``.
+    """
+    return cross_distances(values, values, threshold)
+
+
+def cross_distances(rows: np.ndarray, values: np.ndarray, threshold: float = .6) -> Tuple[np.ndarray, np.ndarray]:
+    """Distances (as in `pairwise_distances`) of every row of ``rows`` to every row of ``values``."""
+    mann = np.empty((len(rows), len(values)))
+    allele = np.empty((len(rows), len(values)))
+    for j in range(len(rows)):
+        for i in range(len(values)):
+            mann[j, i] = l1nonans(values[i], rows[j])
+            allele[j, i] = alleledist(values[i], rows[j], threshold)
+    return mann, allele
+
+
+def pair_diversity(s1: np.ndarray, s2: np.ndarray, runs: np.ndarray) -> float:
+    """
+    Pairwise nucleotide diversity of two samples.
+
+    Args:
+        s1, s2 (np.ndarray): allele frequencies of the two samples, sorted by position.
+        runs (np.ndarray): number of alleles (rows) of each position, in order.
+    """
+    index = np.repeat(np.arange(len(runs)), runs)
+    sample1 = pd.Series(s1, index=index)
+    sample2 = pd.Series(s2, index=index)
+
+    sample1nd = sample1.reset_index().drop_duplicates(subset='index', keep=False).set_index('index')
+    sample2nd = sample2.reset_index().drop_duplicates(subset='index', keep=False).set_index('index')
+    sample2nd = sample2nd.reindex(index=sample1nd.index)
+    s1 = sample1nd.values
+    s2 = sample2nd.values
+    valid = ~(np.isnan(s1) | np.isnan(s2))
+    s1 = s1[valid]
+    s2 = s2[valid]
+    s1 = np.vstack([s1, 1 - s1])
+    s2 = np.vstack([s2, 1 - s2])
+    dist_nd = (s1[0]*s2[1]+s1[1]*s2[0]).sum(dtype=np.float64)
+
+    def position_diversity(x):
+        out = np.outer(x.s1.values, x.s2.values)
+        return np.nansum(out, dtype=np.float64) - np.nansum(out.diagonal(), dtype=np.float64)
+
+    sample1d = sample1.loc[sample1.index[sample1.index.duplicated()]]
+    sample2d = sample2.loc[sample2.index[sample2.index.duplicated()]]
+
+    if not len(sample1d) or not len(sample2d):
+        # No duplicates
+        return dist_nd
+
+    both = pd.DataFrame({'s1': sample1d, 's2': sample2d})
+    both = both.reset_index()
+    both = pd.concat([both, (1. - both.groupby('index').sum()).reset_index()])
+    dist_d = both.groupby('index', group_keys=False).apply(position_diversity).sum()
+
+    return dist_d + dist_nd
+
+
+
+def position_diversity(s1: np.ndarray, s2: np.ndarray, runs: np.ndarray) -> np.ndarray:
+    """
+    Contribution of every position to the `pair_diversity` of two samples
+    (which sums them in a different order).
+    """
+    contributions = np.zeros(len(runs))
+    one = s1.dtype.type(1)
+    pos = 0
+    for r, k in enumerate(runs):
+        if k == 1:
+            a, b = s1[pos], s2[pos]
+            if not (np.isnan(a) or np.isnan(b)):
+                contributions[r] = a * (one - b) + (one - a) * b
+        else:
+            # every allele is repeated k - 1 times, followed by the remaining frequency
+            va = np.append(np.tile(s1[pos:pos + k], k - 1), one - _kahan_nansum(np.tile(s1[pos:pos + k], k - 1)))
+            vb = np.append(np.tile(s2[pos:pos + k], k - 1), one - _kahan_nansum(np.tile(s2[pos:pos + k], k - 1)))
+            out = np.nan_to_num(np.outer(va, vb), nan=0.).astype(np.float64)
+            contributions[r] = out.sum() - out.diagonal().sum()
+        pos += k
+    return contributions
+
+
+def _kahan_nansum(values: np.ndarray):
+    """Compensated sum skipping NaNs, in the precision of ``values`` (like pandas group sums)."""
+    s = c = values.dtype.type(0)
+    for v in values:
+        if not np.isnan(v):
+            y = v - c
+            t = s + y
+            c = t - s - y
+            s = t
+    return s
@@ -0,0 +1,67 @@
+import threading
+
+from typing import Dict, IO, List, Optional, Tuple, Union
+
+from metaSNV.kernels import accumulate_pileup, split_read_groups
+
+
+class PileupCoverage:
+    """
+    Depth and breadth of every sample per reference, accumulated from the
+    lines of the pileup of the SNV calling (one pass over the BAM files).
+
+    Positions are counted as 'samtools mpileup' counts them for calling:
+    with its read and base quality filters and depth cap, and deletions
+    covering a position count towards its depth (unlike 'samtools depth').
+    """
+
+    def __init__(self, n_samples: int):
+        self.n_samples = n_samples
+        # per reference: sum of the depths and number of covered positions per sample
+        self.totals = {}
+
+    def add(self, line: str):
+        accumulate_pileup(line, self.totals, self.n_samples)
+
+    def legacy_values(self, column: int, lengths: Dict[str, int], mode: str = "depth") -> Dict[str, str]:
+        """
+        Values of the sample of a pileup column in a legacy coverage table, by
+        reference (see `metaSNV.bam_preprocessing.legacy_values`).
+        """
+        row = {"depth": 0, "breadth": 1}.get(mode)
+        if row is None:
+            raise ValueError(f"'{mode}' not supported")
+        values = {}
+        for ref, length in lengths.items():
+            total = int(self.totals[ref][row, column]) if ref in self.totals else 0
+            values[ref] = str(total / length) if mode == "depth" else str(total / length * 100)
+        return values
+
+
+def relay_pileup(src: IO[bytes], dst: IO[bytes], coverage: PileupCoverage,
+                 read_groups: Optional[Tuple[List[Union[int, Dict[str, int]]], int]] = None):
+    """
+    Copy a pileup from ``src`` to ``dst`` and add its depths to
+    ``coverage``, split into the samples of their read groups first if
+    ``read_groups`` (files and number of samples, see
+    `metaSNV.read_groups.pileup_inputs`). Closes both files.
+    """
+    try:
+        for line in src:
+            line = line.decode()
+            if read_groups is not None:
+                line = split_read_groups(line, *read_groups)
+            coverage.add(line)
+            dst.write(line.encode())
+    finally:
+        src.close()
+        dst.close()
+
+
+def relay_pileup_thread(src: IO[bytes], dst: IO[bytes], coverage: PileupCoverage,
+                        read_groups: Optional[Tuple[List[Union[int, Dict[str, int]]], int]] = None
+                        ) -> threading.Thread:
+    """`relay_pileup` on a background thread (started)."""
+    thread = threading.Thread(target=relay_pileup, args=(src, dst, coverage, read_groups), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,198 @@
+import csv
+import hashlib
+import io
+import os
+
+from array import array
+from typing import Dict, NamedTuple, Sequence
+
+import numpy as np
+import pandas as pd
+
+from metaSNV.fileio import strip_compression
+
+
+class Positions(NamedTuple):
+    """
+    Rows of a filtered frequency table, labelled
+    'contig:gene:pos:ref>alt:type[codons]', as compact arrays.
+
+    Contig and gene names are stored once (``contigs``, ``genes``) and
+    referred to by codes. Names are ordered like the labels sort as strings,
+    so that sorting the codes sorts the rows like their labels. Bases and
+    synonymity ('N', 'S' or '.') are ASCII codes.
+    """
+    contigs: np.ndarray
+    genes: np.ndarray
+    contig: np.ndarray
+    gene: np.ndarray
+    position: np.ndarray
+    ref: np.ndarray
+    alt: np.ndarray
+    synonymity: np.ndarray
+
+    def take(self, rows) -> 'Positions':
+        """Positions of a subset of the rows (indices or boolean mask)."""
+        return self._replace(**{field: getattr(self, field)[rows] for field in self._fields[2:]})
+
+    def digest(self) -> str:
+        """Checksum identifying the rows, e.g. to detect changed positions between runs."""
+        h = hashlib.sha1('\n'.join(self.contigs).encode())
+        h.update('\n'.join(self.genes).encode())
+        for field in self._fields[2:]:
+            h.update(np.ascontiguousarray(getattr(self, field)).tobytes())
+        return h.hexdigest()
+
+
+def _categories(names: pd.Series):
+    """Codes of categorical names, and the names ordered as components of ':'-separated labels."""
+    return _ordered(np.asarray(names.cat.categories, dtype=str), names.cat.codes.to_numpy())
+
+
+def encode_positions(labels: Sequence[str]) -> Positions:
+    """Parse the row labels of a filtered frequency table."""
+    if not len(labels):
+        empty = np.zeros(0, dtype=np.uint8)
+        return Positions(np.zeros(0, dtype=str), np.zeros(0, dtype=str), np.zeros(0, dtype=np.int32),
+                         np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), empty, empty, empty)
+    # the C parser splits the labels much faster than str.split
+    parts = pd.read_csv(io.StringIO('\n'.join(labels)), sep=':', header=None, quoting=csv.QUOTE_NONE,
+                        na_filter=False, names=['contig', 'gene', 'position', 'alleles', 'type'],
+                        dtype={'contig': 'category', 'gene': 'category', 'position': np.int64, 'alleles': str,
+                               'type': str})
+    contigs, contig = _categories(parts['contig'])
+    genes, gene = _categories(parts['gene'])
+    return Positions(contigs=contigs, genes=genes, contig=contig, gene=gene,
+                     position=parts['position'].to_numpy(),
+                     ref=_character(parts['alleles'], 0),
+                     alt=_character(parts['alleles'], 2),
+                     synonymity=_character(parts['type'], 0))
+
+
+def _ordered(names: Sequence[str], codes: np.ndarray):
+    """Names ordered as components of ':'-separated labels, and the codes of the rows in that order."""
+    names = np.array(names, dtype=str)
+    # 'a1:...' sorts before 'a:...'
+    order = np.argsort(np.char.add(names, ':'), kind='stable')
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return names[order], rank[codes]
+
+
+class PositionsEncoder:
+    """
+    Encode the row labels of a filtered frequency table one at a time, as
+    the rows are written, into growing arrays of codes instead of keeping
+    the labels (same result as `encode_positions` of all labels).
+
+    Example:
+        >>> encoder = PositionsEncoder()
+        >>> encoder.add('contig1:gene1:10:A>C:.')
+        >>> encoder.write('filtered/pop/contig1.filtered.freq')  # doctest: +SKIP
+    """
+
+    def __init__(self):
+        self._contigs: Dict[str, int] = {}
+        self._genes: Dict[str, int] = {}
+        self._contig = array('i')
+        self._gene = array('i')
+        self._position = array('q')
+        self._bases = array('B')
+        self._digest = hashlib.sha1()
+
+    def __len__(self):
+        return len(self._position)
+
+    def add(self, label: str):
+        contig, gene, position, alleles, synonymity = label.split(':', 4)
+        self._digest.update(('\n' + label if len(self) else label).encode())
+        self._contig.append(self._contigs.setdefault(contig, len(self._contigs)))
+        self._gene.append(self._genes.setdefault(gene, len(self._genes)))
+        self._position.append(int(position))
+        self._bases.extend(ord(character) for character in (alleles[0], alleles[2], synonymity[0]))
+
+    def positions(self) -> Positions:
+        contigs, contig = _ordered(list(self._contigs), np.frombuffer(self._contig, dtype=np.int32))
+        genes, gene = _ordered(list(self._genes), np.frombuffer(self._gene, dtype=np.int32))
+        bases = np.frombuffer(self._bases, dtype=np.uint8).reshape(-1, 3)
+        return Positions(contigs=contigs, genes=genes, contig=contig, gene=gene,
+                         position=np.frombuffer(self._position, dtype=np.int64).copy(),
+                         ref=bases[:, 0].copy(), alt=bases[:, 1].copy(), synonymity=bases[:, 2].copy())
+
+    def write(self, freq_path: str):
+        """Write the encoded positions next to the filtered frequency table (see `write_positions`)."""
+        save_positions(freq_path, self.positions(), self._digest.hexdigest())
+
+
+def _character(strings: pd.Series, k: int) -> np.ndarray:
+    """ASCII code of the k-th character of every string."""
+    strings = strings.to_numpy(dtype=str)
+    return strings.view(np.uint32).reshape(len(strings), -1)[:, k].astype(np.uint8)
+
+
+def site_keys(positions: Positions) -> np.ndarray:
+    """
+    Number of the site (contig, gene and position) of every row. Rows of
+    the same site have the same number, and numbers are ordered like the
+    'contig:gene:pos' labels sort as strings.
+    """
+    if not len(positions.position):
+        return np.zeros(0, dtype=np.int64)
+    # positions are the last component of the label, so they sort as strings too
+    unique, inverse = np.unique(positions.position, return_inverse=True)
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.argsort(unique.astype(str), kind='stable')] = np.arange(len(unique))
+    order = np.lexsort((rank[inverse], positions.gene, positions.contig))
+    contig, gene, position = positions.contig[order], positions.gene[order], positions.position[order]
+    change = np.r_[True, (contig[1:] != contig[:-1]) | (gene[1:] != gene[:-1]) | (position[1:] != position[:-1])]
+    keys = np.empty(len(order), dtype=np.int64)
+    keys[order] = np.cumsum(change) - 1
+    return keys
+
+
+def gene_strata(positions: Positions) -> np.ndarray:
+    """
+    Stratum (contig and gene) of every row, numbered like 'contig:gene'
+    sorts as string (see `metaSNV.approx.strata_of`).
+    """
+    n_genes = max(1, len(positions.genes))
+    unique, inverse = np.unique(positions.contig.astype(np.int64) * n_genes + positions.gene, return_inverse=True)
+    names = np.char.add(np.char.add(positions.contigs[unique // n_genes], ':'), positions.genes[unique % n_genes])
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.argsort(names, kind='stable')] = np.arange(len(unique))
+    return rank[inverse]
+
+
+def positions_path(freq_path: str) -> str:
+    """Path of the encoded positions of a filtered frequency table (written by the filtering step)."""
+    path = strip_compression(freq_path)
+    if path.endswith('.freq'):
+        path = path[:-len('.freq')]
+    return path + '.pos.npz'
+
+
+def labels_digest(labels: Sequence[str]) -> str:
+    return hashlib.sha1('\n'.join(labels).encode()).hexdigest()
+
+
+def save_positions(freq_path: str, positions: Positions, digest: str):
+    np.savez(positions_path(freq_path), labels=np.array(digest), **positions._asdict())
+
+
+def write_positions(freq_path: str, labels: Sequence[str]):
+    """Encode the row labels of a filtered frequency table next to it."""
+    save_positions(freq_path, encode_positions(labels), labels_digest(labels))
+
+
+def read_positions(freq_path: str, labels: Sequence[str]) -> Positions:
+    """
+    Encoded positions of the rows of a filtered frequency table, from the
+    file written next to it by the filtering step if it matches ``labels``,
+    parsed from ``labels`` otherwise.
+    """
+    filepath = positions_path(freq_path)
+    if os.path.isfile(filepath):
+        with np.load(filepath) as stored:
+            if str(stored['labels']) == labels_digest(labels):
+                return Positions(**{field: stored[field] for field in Positions._fields})
+    return encode_positions(labels)
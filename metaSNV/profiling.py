@@ -0,0 +1,138 @@
+import cProfile
+import functools
+import glob
+import io
+import os
+import pstats
+import time
+import tracemalloc
+import uuid
+
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+SUMMARY_FILENAME = 'summary.txt'
+
+
+def task_name(func: Callable) -> str:
+    """Name of a worker function, looking through functools.partial and wrappers (``__wrapped__``)."""
+    while isinstance(func, functools.partial) or hasattr(func, '__wrapped__'):
+        func = func.func if isinstance(func, functools.partial) else func.__wrapped__
+    return getattr(func, '__name__', type(func).__name__)
+
+
+class Profiled:
+    """
+    Run a worker function under cProfile (and tracemalloc if ``memory``),
+    writing the profile of every call to ``directory``:
+
+    - ``<task>.<pid>.<id>.prof``: cProfile statistics (see pstats),
+    - ``<task>.<pid>.<id>.mem``: tracemalloc snapshot at the end of the call,
+    - ``<task>.<pid>.<id>.task``: wall time and peak traced memory, and the
+      size of the task as ``key=value`` fields if a ``measure`` is given.
+
+    ``measure`` is called with the arguments of the task and returns its size
+    (e.g. the number of bases or rows it processes), see `metaSNV.estimate`.
+
+    Instances can be pickled, so they can be passed to multiprocessing pools.
+    """
+
+    def __init__(self, func: Callable, directory: str, memory: bool = False, measure: Optional[Callable] = None):
+        self.func = func
+        self.directory = directory
+        self.memory = memory
+        self.measure = measure
+
+    def __call__(self, *args, **kwargs):
+        name = task_name(self.func)
+        prefix = os.path.join(self.directory, f"{name}.{os.getpid()}.{uuid.uuid4().hex[:8]}")
+        size = self.measure(*args, **kwargs) if self.measure is not None else {}
+        profiler = cProfile.Profile()
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(self.func, *args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start
+            peak = 0
+            if self.memory:
+                tracemalloc.take_snapshot().dump(prefix + '.mem')
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            profiler.dump_stats(prefix + '.prof')
+            with open(prefix + '.task', 'w') as f:
+                f.write('\t'.join([name, str(wall), str(peak)] + [f"{key}={value}" for key, value in size.items()])
+                        + '\n')
+
+
+def profiled(func: Callable, directory: Optional[str], memory: bool = False,
+             measure: Optional[Callable] = None) -> Callable:
+    """``func`` wrapped in `Profiled` if a profile ``directory`` is given, ``func`` itself otherwise."""
+    if not directory:
+        return func
+    os.makedirs(directory, exist_ok=True)
+    return Profiled(func, directory, memory, measure)
+
+
+def read_tasks(directory: str) -> List[Tuple[str, float, int, Dict[str, float]]]:
+    """(task, wall time, peak traced memory, size) of every task profiled into ``directory``."""
+    tasks = []
+    for filepath in sorted(glob.glob(os.path.join(directory, '*.task'))):
+        with open(filepath) as f:
+            name, wall, peak, *fields = f.readline().rstrip('\n').split('\t')
+        size = {key: float(value) for key, value in (field.split('=', 1) for field in fields)}
+        tasks.append((name, float(wall), int(peak), size))
+    return tasks
+
+
+def summarize(directory: str, top: int = 25) -> str:
+    """
+    Merge all profiles of ``directory`` (of every stage profiled into it)
+    and write the hottest functions and largest allocation sites to
+    ``summary.txt``.
+
+    Returns:
+        str: path to the summary.
+    """
+    tasks = defaultdict(list)
+    for name, wall, peak, _ in read_tasks(directory):
+        tasks[name].append((wall, peak))
+
+    out = io.StringIO()
+    out.write("Tasks\n\n")
+    out.write(f"{'task':<30} {'calls':>6} {'total [s]':>10} {'max [s]':>10} {'max peak [MB]':>14}\n")
+    for name, runs in sorted(tasks.items(), key=lambda item: -sum(wall for wall, _ in item[1])):
+        walls = [wall for wall, _ in runs]
+        peak = max(peak for _, peak in runs) / 2 ** 20
+        out.write(f"{name:<30} {len(runs):>6} {sum(walls):>10.2f} {max(walls):>10.2f} {peak:>14.1f}\n")
+
+    profiles = sorted(glob.glob(os.path.join(directory, '*.prof')))
+    if profiles:
+        stats = pstats.Stats(profiles[0], stream=out)
+        for filepath in profiles[1:]:
+            stats.add(filepath)
+        stats.strip_dirs()
+        # instead of listing every profile file
+        stats.files = []
+        for sort in ['tottime', 'cumulative']:
+            out.write(f"\nHottest functions by {sort} ({len(profiles)} tasks)\n")
+            stats.sort_stats(sort).print_stats(top)
+
+    snapshots = sorted(glob.glob(os.path.join(directory, '*.mem')))
+    if snapshots:
+        sites = defaultdict(lambda: [0, 0])
+        for filepath in snapshots:
+            for stat in tracemalloc.Snapshot.load(filepath).statistics('lineno'):
+                frame = stat.traceback[0]
+                sites[frame.filename, frame.lineno][0] += stat.size
+                sites[frame.filename, frame.lineno][1] += stat.count
+        out.write(f"\nLargest allocation sites still allocated at the end of the tasks ({len(snapshots)} tasks)\n\n")
+        out.write(f"{'size [MB]':>10} {'blocks':>10}  site\n")
+        for (filename, lineno), (size, count) in sorted(sites.items(), key=lambda item: -item[1][0])[:top]:
+            out.write(f"{size / 2 ** 20:>10.2f} {count:>10}  {filename}:{lineno}\n")
+
+    summary = os.path.join(directory, SUMMARY_FILENAME)
+    with open(summary, 'w') as f:
+        f.write(out.getvalue())
+    return summary
@@ -0,0 +1,128 @@
+import os
+
+from typing import Dict, List, Tuple
+
+from metaSNV.fileio import open_file
+from metaSNV.splits import genome_of
+
+
+def samples_of_interest(coverage_filepath: str, percentage_filepath: str,
+                        min_breadth: float, min_depth: float,
+                        min_samples: int) -> Tuple[Dict[str, List[str]], List[str]]:
+    """
+    Apply the taxon/sample thresholds of metaSNV_Filtering.py to the
+    coverage tables.
+
+    A sample qualifies for a taxon if its average depth is at least
+    ``min_depth`` and its breadth at least ``min_breadth`` percent. A taxon
+    qualifies if at least ``min_samples`` samples qualify.
+
+    Args:
+        coverage_filepath (str): path to the <project>.all_cov.tab file.
+        percentage_filepath (str): path to the <project>.all_perc.tab file.
+        min_breadth (float): minimal breadth (percentage) per sample.
+        min_depth (float): minimal average depth per sample.
+        min_samples (int): minimal number of qualifying samples per taxon.
+
+    Returns:
+        tuple: {taxon: [qualifying samples]} and the sample header of the tables.
+
+    Raises:
+        ValueError: if the two tables do not describe the same taxa and samples.
+    """
+    soi = {}
+    with open_file(coverage_filepath, 'rt') as cov_file, open_file(percentage_filepath, 'rt') as perc_file:
+        header_cov = cov_file.readline().split()
+        header_perc = perc_file.readline().split()
+        cov_file.readline()  # skip the 'TaxId' row
+        perc_file.readline()
+        if header_cov != header_perc:
+            raise ValueError("Coverage file headers do not match!")
+
+        for cov_line, perc_line in zip(cov_file, perc_file):
+            cov = cov_line.split()
+            perc = perc_line.split()
+            taxon = cov.pop(0)
+            if taxon != perc.pop(0):
+                raise ValueError("TaxIDs in the coverage files are not in the same order!")
+            samples = [sample for sample, c, p in zip(header_cov, cov, perc)
+                       if float(c) >= min_depth and float(p) >= min_breadth]
+            if len(samples) >= min_samples:
+                soi[taxon] = samples
+    return soi, header_cov
+
+
+def read_regions(filepath: str) -> List[Tuple[str, int]]:
+    """(reference, length) tuples of a 'ref\\t0\\tlength' BED file (bed_header or a split)."""
+    regions = []
+    with open(filepath) as f:
+        for line in f:
+            ref, _, length = line.rstrip('\n').split('\t')[:3]
+            regions.append((ref, int(length)))
+    return regions
+
+
+def calling_groups(regions: List[Tuple[str, int]],
+                   soi: Dict[str, List[str]]) -> List[Tuple[List[str], List[Tuple[str, int]]]]:
+    """
+    Group the references of qualifying taxa by their qualifying samples.
+
+    metaSNV_Filtering.py looks up the samples of a reference by its genome
+    (see `genome_of`), so the same is done here. References of other taxa
+    are dropped.
+
+    Returns:
+        list: (samples, regions) tuples, in the order the sample sets are first seen.
+    """
+    groups = {}
+    for ref, length in regions:
+        samples = soi.get(genome_of(ref))
+        if samples:
+            groups.setdefault(tuple(samples), []).append((ref, length))
+    return [(list(samples), group_regions) for samples, group_regions in groups.items()]
+
+
+def write_regions(filepath: str, regions: List[Tuple[str, int]]):
+    with open(filepath, 'w') as f:
+        for ref, length in regions:
+            f.write(f"{ref}\t0\t{length}\n")
+
+
+def pad_line(line: str, columns: List[int], n_samples: int) -> str:
+    """
+    Expand the per-sample fields of an SNV line called on a subset of the
+    samples to all ``n_samples`` samples; samples that were not called get
+    a count of 0.
+
+    Args:
+        line (str): snpCall output line.
+        columns (list): column (in all samples) of each called sample.
+        n_samples (int): total number of samples.
+    """
+    def expand(counts):
+        padded = ['0'] * n_samples
+        for column, count in zip(columns, counts):
+            padded[column] = count
+        return '|'.join(padded)
+
+    fields = line.rstrip('\n').split('\t')
+    fields[4] = expand(fields[4].split('|'))
+    alleles = []
+    for allele in fields[5].split(','):
+        parts = allele.split('|')
+        alleles.append('|'.join(parts[:3]) + '|' + expand(parts[3:]))
+    fields[5] = ','.join(alleles)
+    return '\t'.join(fields) + '\n'
+
+
+def pad_calls(src_filepath: str, dst, columns: List[int], n_samples: int):
+    """Append the lines of ``src_filepath`` to the open file ``dst``, padded with `pad_line`."""
+    if not os.path.isfile(src_filepath):
+        return
+    with open(src_filepath) as src:
+        if len(columns) == n_samples:
+            for line in src:
+                dst.write(line)
+        else:
+            for line in src:
+                dst.write(pad_line(line, columns, n_samples))
@@ -0,0 +1,156 @@
+import io
+import os
+
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from metaSNV.fileio import compression_of, open_file, strip_compression
+from metaSNV.positions import Positions, labels_digest, positions_path, write_positions
+from metaSNV.regions import Region
+
+
+def rows_path(freq_path: str) -> str:
+    """Path of the row index of a filtered frequency table (next to the table and its positions)."""
+    path = strip_compression(freq_path)
+    if path.endswith('.freq'):
+        path = path[:-len('.freq')]
+    return path + '.rows.npz'
+
+
+def _stamp(freq_path: str) -> np.ndarray:
+    stat = os.stat(freq_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _scan(freq_path: str):
+    """Byte offset of every row (and of the end of the table) and row labels of a table."""
+    offsets, labels = [], []
+    with open_file(freq_path, 'rb') as f:
+        header = f.readline()
+        offset = len(header)
+        for line in f:
+            offsets.append(offset)
+            labels.append(line[:line.find(b'\t')].decode())
+            offset += len(line)
+    offsets.append(offset)
+    return np.array(offsets, dtype=np.int64), labels
+
+
+class FilteredFrequencies:
+    """
+    Query a filtered frequency table (``<species>.filtered.freq`` of
+    metaSNV_Filtering.py) by region, gene and samples.
+
+    Rows are selected on their encoded positions (contig, gene and
+    position, see `metaSNV.positions.Positions`), and only the selected
+    rows and sample columns of the table are parsed. The byte offset of
+    every row is indexed once in ``<species>.filtered.rows.npz`` and the
+    rows of plain tables are read directly; compressed tables are streamed
+    (only the selected rows are parsed).
+
+    Example:
+        >>> table = FilteredFrequencies('outputs/filtered/pop/refGenome1clus.filtered.freq')
+        >>> rows = table.rows(regions=[('g1', 'refGenome1clus', 1000, 2000)])
+        >>> table.frequencies(rows, samples=['a', 'b']).shape
+        (42, 2)
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open_file(filepath, 'rb') as f:
+            self._header = f.readline()
+        self.samples = self._header.decode().rstrip('\n').split('\t')[1:]
+        self.offsets, self.positions = self._load_index()
+
+    def __repr__(self):
+        return f"FilteredFrequencies('{self.filepath}')"
+
+    def _load_index(self):
+        index_file = rows_path(self.filepath)
+        stamp = _stamp(self.filepath)
+        if os.path.isfile(index_file):
+            with np.load(index_file) as stored:
+                if np.array_equal(stored['stamp'], stamp):
+                    offsets, digest = stored['offsets'], str(stored['labels'])
+                    positions = self._stored_positions(digest)
+                    if positions is not None:
+                        return offsets, positions
+        offsets, labels = _scan(self.filepath)
+        digest = labels_digest(labels)
+        if self._stored_positions(digest) is None:
+            write_positions(self.filepath, labels)
+        np.savez(index_file, offsets=offsets, labels=np.array(digest), stamp=stamp)
+        return offsets, self._stored_positions(digest)
+
+    def _stored_positions(self, digest: str) -> Optional[Positions]:
+        """Positions written next to the table, if they are those of the rows with labels ``digest``."""
+        filepath = positions_path(self.filepath)
+        if not os.path.isfile(filepath):
+            return None
+        with np.load(filepath) as stored:
+            if str(stored['labels']) != digest:
+                return None
+            return Positions(**{field: stored[field] for field in Positions._fields})
+
+    def rows(self, regions: Optional[Sequence[Region]] = None, genes: Optional[Iterable[str]] = None) -> np.ndarray:
+        """
+        Rows (in table order) within any of ``regions`` (1-based, inclusive)
+        and of any of ``genes`` ('-' for intergenic positions). All rows by
+        default.
+        """
+        positions = self.positions
+        selected = np.ones(len(positions.position), dtype=bool)
+        if regions is not None:
+            # rows sorted by contig and position, every region is a range of them
+            keys = positions.contig.astype(np.int64) << 40 | positions.position
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            codes = {contig: code for code, contig in enumerate(positions.contigs)}
+            bounds = np.array([(codes[contig] << 40 | start, codes[contig] << 40 | end)
+                               for _, contig, start, end in regions if contig in codes], dtype=np.int64).reshape(-1, 2)
+            starts = np.zeros(len(keys) + 1, dtype=np.int64)
+            np.add.at(starts, np.searchsorted(keys, bounds[:, 0], 'left'), 1)
+            np.add.at(starts, np.searchsorted(keys, bounds[:, 1], 'right'), -1)
+            within = np.zeros(len(keys), dtype=bool)
+            within[order] = np.cumsum(starts[:-1]) > 0
+            selected &= within
+        if genes is not None:
+            codes = np.flatnonzero(np.isin(positions.genes, list(genes)))
+            selected &= np.isin(positions.gene, codes)
+        return np.flatnonzero(selected)
+
+    def _lines(self, rows: np.ndarray) -> bytes:
+        if compression_of(self.filepath) != 'none':
+            selected = np.zeros(len(self.offsets) - 1, dtype=bool)
+            selected[rows] = True
+            with open_file(self.filepath, 'rb') as f:
+                f.readline()
+                return b''.join(line for line, keep in zip(f, selected) if keep)
+        # contiguous rows are read at once
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        chunks = []
+        with open(self.filepath, 'rb') as f:
+            for run in np.split(rows, breaks):
+                if len(run):
+                    f.seek(self.offsets[run[0]])
+                    chunks.append(f.read(self.offsets[run[-1] + 1] - self.offsets[run[0]]))
+        return b''.join(chunks)
+
+    def frequencies(self, rows: Optional[np.ndarray] = None, samples: Optional[List[str]] = None,
+                    precision: str = 'float64') -> pd.DataFrame:
+        """
+        Frequencies of ``rows`` (see `rows`, all by default) of ``samples``
+        (all by default, in this order), as loaded by metaSNV_DistDiv.py:
+        rows labelled as in the table and NaN below the coverage threshold.
+        """
+        samples = self.samples if samples is None else list(samples)
+        missing = [sample for sample in samples if sample not in self.samples]
+        if missing:
+            raise KeyError(f"Samples {', '.join(missing)} not found in {self}")
+        rows = np.arange(len(self.offsets) - 1) if rows is None else np.sort(np.asarray(rows, dtype=np.int64))
+        columns = [0] + sorted(1 + self.samples.index(sample) for sample in samples)
+        data = pd.read_table(io.BytesIO(self._header + self._lines(rows)), index_col=0, na_values=['-1'],
+                             usecols=columns, dtype={sample: precision for sample in samples})
+        return data[samples]
@@ -0,0 +1,105 @@
+import sys
+import threading
+
+from typing import Dict, IO, List, Optional, Sequence, Tuple, Union
+
+import pysam
+from pysam.libcalignmentfile import AlignmentFile
+
+from metaSNV.kernels import split_read_groups
+
+# one base and quality per read; given twice, --no-output-ins/--no-output-del also drop the +N/-N markers of
+# the insertions and deletions
+COMPACT_PILEUP_ARGS = ['--no-output-ins', '--no-output-ins', '--no-output-del', '--no-output-del',
+                       '--no-output-ends']
+# followed by the read groups of the reads (see `split_pileup`)
+MPILEUP_READ_GROUP_ARGS = ['--output-extra', 'RG'] + COMPACT_PILEUP_ARGS
+
+
+def read_group_samples(filepath: str) -> Dict[str, str]:
+    """Sample (SM tag, or the ID without SM) of every read group in the header of a BAM file, by ID."""
+    save = pysam.set_verbosity(0)
+    bam = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    groups = {group['ID']: group.get('SM', group['ID']) for group in bam.header.to_dict().get('RG', [])}
+    bam.close()
+    return groups
+
+
+def sample_entry(filepaths: Sequence[str], sample: Optional[str] = None) -> str:
+    """
+    Line of a sample in 'all_samples': its BAM file, or for a sample of
+    read groups, its BAM files and name separated by tabs.
+    """
+    if sample is None:
+        return filepaths[0]
+    return '\t'.join(list(filepaths) + [sample])
+
+
+def parse_sample_entry(entry: str) -> Tuple[List[str], Optional[str]]:
+    """BAM files and read group sample (None for a whole BAM file) of a line of 'all_samples'."""
+    fields = entry.rstrip('\n').split('\t')
+    if len(fields) == 1:
+        return fields, None
+    return fields[:-1], fields[-1]
+
+
+def uses_read_groups(entries: Sequence[str]) -> bool:
+    return any(parse_sample_entry(entry)[1] is not None for entry in entries)
+
+
+def pileup_inputs(entries: Sequence[str]) -> Tuple[List[str], List[Union[int, Dict[str, int]]]]:
+    """
+    BAM files to pile up for the samples of 'all_samples' lines, and per
+    file the sample column of its reads: an int for a whole BAM file, the
+    column of each read group for files of read group samples (read groups
+    of other samples are left out).
+    """
+    filepaths = []
+    files = []
+    for column, entry in enumerate(entries):
+        entry_filepaths, sample = parse_sample_entry(entry)
+        for filepath in entry_filepaths:
+            if sample is None:
+                filepaths.append(filepath)
+                files.append(column)
+                continue
+            if filepath not in filepaths:
+                filepaths.append(filepath)
+                files.append({})
+            groups = files[filepaths.index(filepath)]
+            groups.update({group: column for group, group_sample in read_group_samples(filepath).items()
+                           if group_sample == sample})
+    return filepaths, files
+
+
+def split_pileup(src: IO[bytes], dst: IO[bytes], files: List[Union[int, Dict[str, int]]], n_samples: int):
+    """
+    Copy the output of 'samtools mpileup' run with `MPILEUP_READ_GROUP_ARGS`
+    on the files of `pileup_inputs` to ``dst``, with one column per sample.
+    Closes both files.
+    """
+    try:
+        for line in src:
+            dst.write(split_read_groups(line.decode(), files, n_samples).encode())
+    finally:
+        src.close()
+        dst.close()
+
+
+def split_pileup_thread(src: IO[bytes], dst: IO[bytes], files: List[Union[int, Dict[str, int]]],
+                        n_samples: int) -> threading.Thread:
+    """`split_pileup` on a background thread (started)."""
+    thread = threading.Thread(target=split_pileup, args=(src, dst, files, n_samples), daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    """Split a pileup from stdin by the samples of the 'all_samples' lines given as arguments."""
+    filepaths, files = pileup_inputs(sys.argv[1:])
+    split_pileup(sys.stdin.buffer, sys.stdout.buffer, files, len(sys.argv) - 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import tempfile
+
+from typing import Dict, Iterable, Optional
+
+import pysam
+from pysam.libcalignmentfile import AlignmentFile
+
+from metaSNV.fileio import open_file
+
+# alignment files read from an input folder
+ALIGNMENT_SUFFIXES = ('.bam', '.cram')
+# default cache, next to the reference database
+REF_CACHE_DIRNAME = 'ref_cache'
+# layout of the cache as expected by htslib in REF_PATH / REF_CACHE
+CACHE_PATTERN = '%2s/%2s/%s'
+
+_WHITESPACE = b' \t\r\n\v\f'
+
+
+def is_cram(filepath: str) -> bool:
+    return filepath.endswith('.cram')
+
+
+def default_cache_dir(ref_db: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(ref_db)), REF_CACHE_DIRNAME)
+
+
+def cache_path(cache_dir: str, md5: str) -> str:
+    """File of a reference sequence in the cache, by the MD5 of its (upper case) sequence."""
+    return os.path.join(cache_dir, md5[:2], md5[2:4], md5[4:])
+
+
+def _manifest(ref_db: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, os.path.basename(ref_db) + '.md5')
+
+
+def _stamp(ref_db: str) -> str:
+    stat = os.stat(ref_db)
+    return f"#{os.path.abspath(ref_db)}\t{stat.st_size}\t{stat.st_mtime_ns}\n"
+
+
+def populate(ref_db: str, cache_dir: str) -> Dict[str, str]:
+    """
+    Write every sequence of the FASTA file ``ref_db`` into the cache (once),
+    and return the MD5 of the sequences by name.
+
+    Cached sequences are files named by their MD5 (as in the M5 tags of CRAM
+    headers) that htslib memory maps, so that all processes decoding CRAM
+    files share a single copy of the reference. The MD5s of ``ref_db`` are
+    kept next to them, and the FASTA file is only read again when it changes.
+    """
+    manifest = _manifest(ref_db, cache_dir)
+    stamp = _stamp(ref_db)
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            if f.readline() == stamp:
+                return dict(line.rstrip('\n').split('\t') for line in f)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    md5s = {}
+    name, md5, tmp = None, None, None
+
+    def finish():
+        tmp.close()
+        digest = md5.hexdigest()
+        md5s[name] = digest
+        target = cache_path(cache_dir, digest)
+        if os.path.isfile(target):
+            os.remove(tmp.name)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # atomic, for runs populating the same cache at the same time
+        os.replace(tmp.name, target)
+
+    with open_file(ref_db, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    finish()
+                name = line[1:].split()[0].decode()
+                md5 = hashlib.md5()
+                tmp = tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False)
+            elif name is not None:
+                sequence = line.translate(None, _WHITESPACE).upper()
+                md5.update(sequence)
+                tmp.write(sequence)
+    if name is not None:
+        finish()
+
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+        f.write(stamp)
+        f.writelines(f"{name}\t{digest}\n" for name, digest in md5s.items())
+    os.replace(f.name, manifest)
+    return md5s
+
+
+def use_cache(cache_dir: str):
+    """
+    Decode CRAM files of this process and of its subprocesses (pool workers,
+    samtools) against the cache only (no download of missing references).
+    """
+    pattern = os.path.join(os.path.abspath(cache_dir), CACHE_PATTERN)
+    os.environ['REF_PATH'] = pattern
+    os.environ['REF_CACHE'] = pattern
+
+
+def cram_md5s(filepath: str) -> Dict[str, Optional[str]]:
+    """M5 tag (None if missing) of every reference of the header of a CRAM file, by name."""
+    save = pysam.set_verbosity(0)
+    cram = AlignmentFile(filepath, 'r')
+    pysam.set_verbosity(save)
+    md5s = {sq['SN']: sq.get('M5') for sq in cram.header.to_dict().get('SQ', [])}
+    cram.close()
+    return md5s
+
+
+def prepare(filepaths: Iterable[str], ref_db: str, cache_dir: Optional[str] = None):
+    """
+    Populate and use the reference cache for decoding the CRAM files among
+    ``filepaths`` against ``ref_db``.
+
+    Raises:
+        ValueError: if a CRAM file was not encoded against the sequences of ``ref_db``.
+    """
+    crams = [filepath for filepath in filepaths if is_cram(filepath)]
+    if not crams:
+        return
+    cache_dir = cache_dir or default_cache_dir(ref_db)
+    known = set(populate(ref_db, cache_dir).values())
+    for filepath in crams:
+        missing = sorted(ref for ref, md5 in cram_md5s(filepath).items() if md5 not in known)
+        if missing:
+            raise ValueError("{} was not encoded against the sequences of {} (references without a matching M5 "
+                             "tag: {})".format(filepath, ref_db, ', '.join(missing[:5])))
+    use_cache(cache_dir)
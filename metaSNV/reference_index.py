@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import struct
+import tempfile
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from metaSNV.fileio import open_file
+
+# index of the reference database and gene annotation for snpCall (-x), next to the reference database
+INDEX_SUFFIX = '.snpcall_index'
+MAGIC = b'MSNVIX01'
+# magic, number of genomes and genes, offsets of the genome and gene tables and of the names, and length of the
+# stamp that follows the header
+HEADER = struct.Struct('<8s6Q')
+# one entry per annotated contig, sorted by name (bytes). words_offset is 0 for contigs without sequence.
+GENOME_DTYPE = np.dtype([('name_offset', '<u8'), ('name_length', '<u8'), ('length', '<i8'),
+                         ('words_offset', '<u8'), ('first_gene', '<u8'), ('n_genes', '<u8')])
+# genes of a contig are kept in the order of the annotation file: the first gene of overlapping genes annotates
+# their SNVs
+GENE_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('name_offset', '<u8'), ('name_length', '<u4'),
+                       ('strand', 'S1'), ('pad', 'V3')])
+
+# 3 bit codes of the bases, 10 bases per 32 bit word (as the Genome class of snpCall)
+BASES_PER_WORD = 10
+_CODES = np.zeros(256, dtype=np.uint32)
+for _code, _base in enumerate(b'ATCGN'):
+    _CODES[_base] = _code
+_SHIFTS = np.arange(BASES_PER_WORD, dtype=np.uint32) * 3
+
+# snpCall reads lines with fgets into buffers of this size
+_LINE_BUFFER = 10000
+_ATOL = re.compile(rb'\s*([+-]?\d+)')
+
+Gene = Tuple[int, int, bytes, bytes]
+
+
+def index_path(ref_db: str) -> str:
+    return ref_db + INDEX_SUFFIX
+
+
+def _stamp(ref_db: str, db_ann: str) -> bytes:
+    stamp = {}
+    for key, filepath in [('ref_db', ref_db), ('db_ann', db_ann)]:
+        stat = os.stat(filepath)
+        stamp[key] = [os.path.realpath(filepath), stat.st_size, stat.st_mtime_ns]
+    return json.dumps(stamp, sort_keys=True).encode()
+
+
+def _pieces(f) -> Iterator[bytes]:
+    """Lines of a file as read by snpCall: fgets pieces of at most 9999 bytes."""
+    size = _LINE_BUFFER - 1
+    for line in f:
+        while len(line) > size:
+            yield line[:size]
+            line = line[size:]
+        yield line
+
+
+def _atol(token: bytes) -> int:
+    match = _ATOL.match(token)
+    return int(match.group(1)) if match else 0
+
+
+def _tokens(line: bytes, n: int) -> List[bytes]:
+    """The first ``n`` tab separated tokens of a line as split by snpCall (leading spaces removed, '' past the end)."""
+    tokens = [token.lstrip(b' ') for token in line.split(b'\t', n)[:n]]
+    return tokens + [b''] * (n - len(tokens))
+
+
+def read_genes(db_ann: str) -> Dict[bytes, List[Gene]]:
+    """
+    Genes (start, end, name, strand) of every contig of a metaSNV annotation
+    file, 0-based, as loaded by snpCall: genes of a contig are expected to
+    be adjacent and only the last run of lines of a contig is used.
+    """
+    genes = {}
+    run, contig = None, None
+    with open_file(db_ann, 'rb') as f:
+        f.readline()
+        for line in f:
+            _, name, sequence_id, _, _, _, start, end, strand = _tokens(line, 9)
+            if sequence_id != contig:
+                contig = sequence_id
+                run = genes[contig] = []
+            run.append((_atol(start) - 1, _atol(end) - 1, name, strand[:1]))
+    return genes
+
+
+def _read_sequences(ref_db: str, contigs) -> Iterator[Tuple[bytes, bytes]]:
+    """Sequences of the genomes of ``contigs`` in a FASTA file, named and cut as snpCall reads them."""
+    name, sequence = None, []
+
+    with open_file(ref_db, 'rb') as f:
+        for piece in _pieces(f):
+            # snpCall drops the last character of every piece (the newline of complete lines)
+            piece = piece[:-1]
+            if piece.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(sequence)
+                name, sequence = piece[1:], []
+                if name not in contigs:
+                    name = None
+            elif name is not None:
+                sequence.append(piece)
+    if name is not None:
+        yield name, b''.join(sequence)
+
+
+def pack_sequence(sequence: bytes) -> np.ndarray:
+    """Words of the 3 bit codes of a sequence, as in snpCall (other characters than ATCGN are coded as A)."""
+    n_words = len(sequence) // BASES_PER_WORD + 1
+    codes = np.zeros(n_words * BASES_PER_WORD, dtype=np.uint32)
+    codes[:len(sequence)] = _CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    return (codes.reshape(n_words, BASES_PER_WORD) << _SHIFTS).sum(axis=1, dtype=np.uint32)
+
+
+def _align(f, alignment: int = 8):
+    f.write(b'\0' * (-f.tell() % alignment))
+
+
+def write_index(ref_db: str, db_ann: str, filepath: Optional[str] = None) -> str:
+    """
+    Write the binary index of a reference database and its gene annotation
+    that snpCall memory maps (-x) instead of reading both files on startup.
+
+    The index holds the packed sequences of the annotated genomes and their
+    genes, and is stamped with the size and modification time of both files
+    (see `is_current`).
+
+    Returns:
+        str: path of the index (default: next to ``ref_db``).
+    """
+    filepath = filepath or index_path(ref_db)
+    genes = read_genes(db_ann)
+    sequences = {}
+    strings = bytearray()
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+        stamp = _stamp(ref_db, db_ann)
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0, 0, 0))
+        f.write(stamp)
+        for name, sequence in _read_sequences(ref_db, genes):
+            # genomes without bases are not loaded by snpCall; a later sequence of the same name replaces earlier ones
+            if not sequence:
+                continue
+            _align(f)
+            sequences[name] = (len(sequence), f.tell())
+            f.write(pack_sequence(sequence).astype('<u4').tobytes())
+
+        names = sorted(genes)
+        genomes = np.zeros(len(names), dtype=GENOME_DTYPE)
+        n_genes = sum(len(contig_genes) for contig_genes in genes.values())
+        gene_table = np.zeros(n_genes, dtype=GENE_DTYPE)
+        first_gene = 0
+        for k, name in enumerate(names):
+            length, words_offset = sequences.get(name, (0, 0))
+            genomes[k] = (len(strings), len(name), length, words_offset, first_gene, len(genes[name]))
+            strings += name
+            for start, end, gene_name, strand in genes[name]:
+                gene_table[first_gene] = (start, end, len(strings), len(gene_name), strand, b'')
+                strings += gene_name
+                first_gene += 1
+
+        _align(f)
+        genomes_offset = f.tell()
+        f.write(genomes.tobytes())
+        genes_offset = f.tell()
+        f.write(gene_table.tobytes())
+        strings_offset = f.tell()
+        f.write(strings)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(genomes), n_genes, genomes_offset, genes_offset, strings_offset, len(stamp)))
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(f.name, 0o666 & ~umask)
+    os.replace(f.name, filepath)
+    return filepath
+
+
+def is_current(ref_db: str, db_ann: str, filepath: Optional[str] = None) -> bool:
+    """Whether the index of ``ref_db`` exists and was written from the current ``ref_db`` and ``db_ann``."""
+    filepath = filepath or index_path(ref_db)
+    if not os.path.isfile(filepath):
+        return False
+    with open(filepath, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, *_, stamp_length = HEADER.unpack(header)
+        return magic == MAGIC and f.read(stamp_length) == _stamp(ref_db, db_ann)
@@ -0,0 +1,87 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from metaSNV.fileio import open_file
+
+# (name, contig, start, end), 1-based and inclusive like the annotation
+Region = Tuple[str, str, int, int]
+
+
+def read_gene_regions(filepath: str) -> List[Region]:
+    """
+    Genes of a metaSNV annotation file (--db_ann, see gff2metaSNV_annotation.py).
+
+    The gene names are those snpCall writes in the SNV calls.
+    """
+    regions = []
+    with open_file(filepath) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            # skip the header written by gff2metaSNV_annotation.py
+            if len(fields) < 8 or not fields[6].isdigit():
+                continue
+            regions.append((fields[1], fields[2], int(fields[6]), int(fields[7])))
+    return regions
+
+
+def read_bed_regions(filepath: str) -> List[Region]:
+    """
+    Regions of a BED file (0-based, half-open), named 'contig:start-end'
+    (1-based, inclusive like the annotation).
+    """
+    regions = []
+    with open_file(filepath) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3 or line.startswith(('#', 'track', 'browser')):
+                continue
+            contig, start, end = fields[0], int(fields[1]) + 1, int(fields[2])
+            regions.append((f"{contig}:{start}-{end}", contig, start, end))
+    return regions
+
+
+def window_regions(contigs: Sequence[Tuple[str, int]], size: int, step: int) -> List[Region]:
+    """
+    Windows of ``size`` bases every ``step`` bases along the contigs,
+    named 'contig:start-end'. The last window of a contig ends at the end
+    of the contig.
+
+    Args:
+        contigs (list): (contig, length) tuples, e.g. from the bed_header.
+    """
+    regions = []
+    for contig, length in contigs:
+        for start in range(1, length + 1, step):
+            end = min(start + size - 1, length)
+            regions.append((f"{contig}:{start}-{end}", contig, start, end))
+            if end == length:
+                break
+    return regions
+
+
+def region_bounds(contigs: np.ndarray, positions: np.ndarray,
+                  regions: Sequence[Region]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Range of the positions within every region.
+
+    Args:
+        contigs (np.ndarray): contig of every position, positions of a contig adjacent.
+        positions (np.ndarray): positions, sorted within each contig.
+        regions (list): regions (see `Region`).
+
+    Returns:
+        tuple: for every region, the index of its first position and one past its last position.
+    """
+    starts = np.flatnonzero(np.r_[True, contigs[1:] != contigs[:-1]]) if len(contigs) else np.zeros(0, dtype=int)
+    ends = np.r_[starts[1:], len(contigs)]
+    blocks = {contigs[start]: (start, end) for start, end in zip(starts, ends)}
+
+    lo = np.zeros(len(regions), dtype=np.intp)
+    hi = np.zeros(len(regions), dtype=np.intp)
+    for k, (_, contig, start, end) in enumerate(regions):
+        if contig in blocks:
+            first, last = blocks[contig]
+            lo[k] = first + np.searchsorted(positions[first:last], start, 'left')
+            hi[k] = first + np.searchsorted(positions[first:last], end, 'right')
+    return lo, hi
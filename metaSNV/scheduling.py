@@ -0,0 +1,142 @@
+import multiprocessing
+import os
+import signal
+import sys
+
+from collections import deque
+from multiprocessing.connection import wait
+from typing import Callable, List, Optional, Sequence, Set, Tuple
+
+from metaSNV.profiling import task_name
+
+# tasks of earlier runs that were killed unless run alone, written next to the outputs of a stage
+ISOLATED_FILENAME = 'isolated_tasks.tsv'
+
+
+def _run(func: Callable, item, conn):
+    """Body of a task process: send (True, result) or (False, exception) to the parent."""
+    try:
+        message = (True, func(item))
+    except BaseException as e:
+        message = (False, e)
+    try:
+        conn.send(message)
+    except Exception as e:
+        # unpicklable result or exception
+        conn.send((False, RuntimeError(f"{task_name(func)}({item!r}): {e!r}")))
+    conn.close()
+
+
+def read_isolated(record: Optional[str]) -> Set[Tuple[str, str]]:
+    """(task, item) pairs listed in an isolation record."""
+    if not record or not os.path.isfile(record):
+        return set()
+    with open(record) as f:
+        return {tuple(line.rstrip('\n').split('\t')[:2]) for line in f if not line.startswith('#')}
+
+
+def _record_isolated(record: Optional[str], name: str, item: str, exitcode: int, footprint: float):
+    if not record:
+        return
+    new = not os.path.isfile(record)
+    with open(record, 'a') as f:
+        if new:
+            f.write('#task\titem\texit_code\testimated_memory\n')
+        f.write(f"{name}\t{item}\t{exitcode}\t{int(footprint)}\n")
+
+
+def _exit_reason(exitcode: int) -> str:
+    if exitcode is not None and exitcode < 0:
+        try:
+            return signal.Signals(-exitcode).name
+        except ValueError:
+            pass
+    return f"exit code {exitcode}"
+
+
+def run_admitted(func: Callable, items: Sequence, workers: int, footprints: Sequence[float], budget: float,
+                 record: Optional[str] = None) -> List:
+    """
+    ``[func(item) for item in items]`` in at most ``workers`` processes,
+    starting a task only while the estimated memory (``footprints``, bytes
+    per task) of the running tasks stays within ``budget`` bytes.
+
+    Tasks are started in order; a task that does not fit lets later, smaller
+    tasks start first. A task that does not fit into the budget on its own
+    runs alone. A task whose process is killed (e.g. by the out-of-memory
+    killer) is run again alone, and recorded in ``record`` so that later runs
+    start it alone right away. Exceptions of tasks are raised as by
+    `multiprocessing.Pool.map`.
+    """
+    context = multiprocessing.get_context()
+    name = task_name(func)
+    isolated = {item for task, item in read_isolated(record) if task == name}
+    alone = [str(item) in isolated for item in items]
+    retried = [False] * len(items)
+    results = [None] * len(items)
+    pending = deque(range(len(items)))
+    running = {}
+
+    def start(k):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run, args=(func, items[k], sender), daemon=True)
+        process.start()
+        sender.close()
+        running[receiver] = (k, process)
+
+    def admit():
+        used = sum(footprints[k] for k, _ in running.values())
+        if any(alone[k] for k, _ in running.values()):
+            return
+        for k in list(pending):
+            if running and (alone[k] or len(running) >= max(1, workers) or used + footprints[k] > budget):
+                continue
+            pending.remove(k)
+            start(k)
+            used += footprints[k]
+            if alone[k]:
+                return
+
+    try:
+        while pending or running:
+            admit()
+            for receiver in wait(list(running)):
+                k, process = running.pop(receiver)
+                try:
+                    ok, value = receiver.recv()
+                except EOFError:
+                    ok, value = None, None
+                receiver.close()
+                process.join()
+                if ok:
+                    results[k] = value
+                elif ok is not None:
+                    raise value
+                elif retried[k]:
+                    raise RuntimeError(f"{name}({items[k]!r}) was killed ({_exit_reason(process.exitcode)}) "
+                                       f"although it ran alone")
+                else:
+                    print(f"{name}({items[k]!r}) was killed ({_exit_reason(process.exitcode)}), "
+                          f"running it again alone", file=sys.stderr)
+                    _record_isolated(record, name, str(items[k]), process.exitcode, footprints[k])
+                    alone[k] = retried[k] = True
+                    pending.appendleft(k)
+    finally:
+        for _, process in running.values():
+            process.terminate()
+            process.join()
+    return results
+
+
+def map_tasks(func: Callable, items: Sequence, workers: int, footprint: Optional[Callable] = None,
+              budget: Optional[float] = None, record: Optional[str] = None) -> List:
+    """
+    ``Pool(workers).map(func, items)``, or `run_admitted` with the memory
+    ``footprint(item)`` of every task if a memory ``budget`` (bytes) is given.
+    """
+    items = list(items)
+    if not budget:
+        with multiprocessing.Pool(processes=workers) as p:
+            return p.map(func, items)
+    footprints = [footprint(item) if footprint is not None else 0. for item in items]
+    return run_admitted(func, items, workers, footprints, budget, record)
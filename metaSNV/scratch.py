@@ -0,0 +1,305 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+# index files of alignment files, staged with them
+INDEX_SUFFIXES = ('.bai', '.csi', '.crai')
+# share of the free space of the scratch directory staged inputs may use by default
+DEFAULT_LIMIT_FRACTION = 0.8
+
+
+def alignment_indexes(filepath: str) -> List[str]:
+    """Existing index files of a BAM or CRAM file (``a.bam.bai`` or ``a.bai``)."""
+    stem = os.path.splitext(filepath)[0]
+    candidates = [filepath + suffix for suffix in INDEX_SUFFIXES] + [stem + suffix for suffix in INDEX_SUFFIXES]
+    return [candidate for candidate in candidates if os.path.isfile(candidate)]
+
+
+def default_limit(directory: str) -> int:
+    return int(shutil.disk_usage(directory).free * DEFAULT_LIMIT_FRACTION)
+
+
+def move_back(local: str, target: str):
+    """
+    Move a finished file from scratch to ``target`` atomically: readers of
+    ``target`` see the previous file or the whole new one, never a partial
+    copy (the file is copied next to ``target`` first if it is on another
+    file system).
+    """
+    directory = os.path.dirname(os.path.abspath(target))
+    os.makedirs(directory, exist_ok=True)
+    try:
+        os.replace(local, target)
+        return
+    except OSError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(target) + '.')
+    os.close(fd)
+    try:
+        shutil.copy2(local, tmp)
+        os.replace(tmp, target)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.remove(local)
+
+
+def move_all_back(local_dir: str, target_dir: str):
+    """`move_back` every file of a scratch directory into ``target_dir``."""
+    for filename in sorted(os.listdir(local_dir)):
+        if os.path.isfile(os.path.join(local_dir, filename)):
+            move_back(os.path.join(local_dir, filename), os.path.join(target_dir, filename))
+
+
+@contextmanager
+def staged_output(filepath: str, scratch_dir: Optional[str]) -> Iterator[str]:
+    """
+    Path on scratch to write ``filepath`` to, moved to ``filepath`` when the
+    block completes without error (``filepath`` itself without scratch).
+    """
+    if scratch_dir is None:
+        yield filepath
+        return
+    local_dir = tempfile.mkdtemp(dir=scratch_dir)
+    try:
+        local = os.path.join(local_dir, os.path.basename(filepath))
+        yield local
+        if os.path.isfile(local):
+            move_back(local, filepath)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+
+def stage_file(filepath: str, directory: str, companions: Iterable[str] = ()) -> str:
+    """
+    Copy a file and its ``companions`` (e.g. its index) into ``directory``,
+    and return the path of the copy. Modification times are kept, so
+    indexes stay newer than their file and stamps of the file still match.
+    """
+    for source in [filepath] + list(companions):
+        target = os.path.join(directory, os.path.basename(source))
+        shutil.copy2(source, target + '.part')
+        os.replace(target + '.part', target)
+    return os.path.join(directory, os.path.basename(filepath))
+
+
+class StagedTask:
+    """
+    Run a task writing into ``outdir`` (keyword argument of ``func``) in a
+    directory of its own on scratch, and move its files to ``outdir`` once
+    the task has finished. With ``stage_item``, the item of the task is a
+    file that is copied to scratch first, with ``companions(item)``.
+
+    Instances can be pickled for worker processes, so every worker stages
+    its own task while the others compute.
+    """
+
+    def __init__(self, func: Callable, outdir: str, scratch_dir: str, stage_item: bool = False,
+                 companions: Optional[Callable[[str], List[str]]] = None):
+        self.func = func
+        self.__wrapped__ = func
+        self.outdir = outdir
+        self.scratch_dir = scratch_dir
+        self.stage_item = stage_item
+        self.companions = companions
+
+    def __call__(self, item):
+        local_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+        try:
+            if self.stage_item:
+                item = stage_file(item, local_dir, self.companions(item) if self.companions is not None else [])
+            local_outdir = os.path.join(local_dir, 'out')
+            os.mkdir(local_outdir)
+            result = self.func(item, outdir=local_outdir)
+            move_all_back(local_outdir, self.outdir)
+            return result
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+
+class Scratch:
+    """
+    Node-local staging of the inputs and outputs of a run.
+
+    `prefetch` copies input files (with their companion files, e.g. BAM
+    indexes) to scratch on a background thread, in the order they will be
+    used, while the computations run. Staged inputs together never exceed
+    ``limit`` bytes. `local` waits for a file to be staged and returns the
+    path to read it from.
+
+    With ``release=True``, the consumer calls `release` once it is done with
+    a file. Its copy is then removed as soon as the space is needed, and
+    prefetching waits for released space instead of reading later files in
+    place, with at most ``lookahead`` staged files not released yet. Files
+    prefetched without ``release`` (e.g. the BAM files of a joint pileup,
+    which are all read at once) are kept until `close`, and files that do
+    not fit are read from their original location.
+
+    Outputs are written to scratch with `output` and moved back when done.
+
+    Example:
+        >>> with Scratch('/tmp/scratch', limit=50 * 2 ** 30, lookahead=8) as scratch:
+        ...     scratch.prefetch(bam_filepaths, alignment_indexes, release=True)
+        ...     for filepath, depth in zip(bam_filepaths, pool.imap(func, scratch.fetched(bam_filepaths))):
+        ...         scratch.release(filepath)
+    """
+
+    def __init__(self, directory: str, limit: Optional[int] = None, lookahead: Optional[int] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.limit = default_limit(directory) if limit is None else limit
+        self.lookahead = lookahead
+        self.directory = tempfile.mkdtemp(prefix='metaSNV.', dir=directory)
+        self.used = 0
+        self._local: Dict[str, str] = {}
+        self._sources: Dict[str, str] = {}
+        self._sizes: Dict[str, int] = {}
+        # staged files in use, and released files in the order they were released (removed first)
+        self._held = set()
+        self._released: Dict[str, None] = {}
+        self._handled = set()
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._error = None
+        self._stop = False
+        self._threads = []
+        self._owner = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f"Scratch('{self.directory}')"
+
+    def __getstate__(self):
+        # copies in worker processes see the files staged so far, and neither prefetch nor remove files
+        with self._condition:
+            return dict(self.__dict__, _queued=set(self._handled), _condition=None, _error=None, _threads=[],
+                        _owner=False)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._condition = threading.Condition()
+
+    def _evict(self):
+        """Remove the copy released first (called with the condition held)."""
+        filepath = next(iter(self._released))
+        del self._released[filepath]
+        shutil.rmtree(os.path.dirname(self._local.pop(filepath)), ignore_errors=True)
+        self.used -= self._sizes.pop(filepath)
+        self._handled.discard(filepath)
+        self._queued.discard(filepath)
+
+    def _reserve(self, filepath: str, size: int, release: bool) -> bool:
+        """Account for ``size`` bytes of a new copy, evicting released copies or waiting for releases as needed."""
+        with self._condition:
+            while not self._stop:
+                while self._released and self.used + size > self.limit:
+                    self._evict()
+                ahead = release and self.lookahead is not None and len(self._held) >= self.lookahead
+                if self.used + size <= self.limit and not ahead:
+                    self.used += size
+                    self._sizes[filepath] = size
+                    self._held.add(filepath)
+                    return True
+                if not (release and self._held):
+                    # nothing will be released
+                    return False
+                self._condition.wait()
+            return False
+
+    def _stage(self, filepath: str, companions: List[str], release: bool) -> Optional[str]:
+        size = sum(os.path.getsize(f) for f in [filepath] + companions)
+        if size > self.limit or not self._reserve(filepath, size, release):
+            return None
+        return stage_file(filepath, tempfile.mkdtemp(dir=self.directory), companions)
+
+    def _fetch(self, filepaths: List[str], companions: Optional[Callable[[str], List[str]]], release: bool):
+        try:
+            for filepath in filepaths:
+                if self._stop:
+                    break
+                local = self._stage(filepath, companions(filepath) if companions is not None else [], release)
+                with self._condition:
+                    if local is not None:
+                        self._local[filepath] = local
+                        self._sources[local] = filepath
+                    self._handled.add(filepath)
+                    self._condition.notify_all()
+        except BaseException as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def prefetch(self, filepaths: Iterable[str], companions: Optional[Callable[[str], List[str]]] = None,
+                 release: bool = False):
+        """
+        Start staging ``filepaths`` (and the files ``companions(filepath)`` of
+        each) in the background. With ``release``, every file is passed to
+        `release` once it has been read.
+        """
+        with self._condition:
+            filepaths = list(dict.fromkeys(filepaths))
+            for filepath in filepaths:
+                if filepath in self._released:
+                    # still on scratch from an earlier use
+                    del self._released[filepath]
+                    self._held.add(filepath)
+            filepaths = [filepath for filepath in filepaths if filepath not in self._queued]
+            self._queued.update(filepaths)
+        thread = threading.Thread(target=self._fetch, args=(filepaths, companions, release), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def release(self, filepath: str):
+        """Mark the copy of a prefetched file as no longer used: it is removed when its space is needed."""
+        with self._condition:
+            if filepath in self._held:
+                self._held.discard(filepath)
+                if filepath in self._local:
+                    self._released[filepath] = None
+                self._condition.notify_all()
+
+    def local(self, filepath: str) -> str:
+        """
+        Path to read ``filepath`` from: its copy on scratch once staged, or
+        ``filepath`` itself if it was not prefetched or did not fit.
+
+        Raises:
+            Exception: the error of the background copies, if they failed.
+        """
+        with self._condition:
+            while filepath in self._queued and filepath not in self._handled and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            return self._local.get(filepath, filepath)
+
+    def fetched(self, filepaths: Iterable[str]) -> Iterator[str]:
+        """`local` paths of ``filepaths``, each as soon as it is staged (e.g. for Pool.imap)."""
+        for filepath in filepaths:
+            yield self.local(filepath)
+
+    def original(self, filepath: str) -> str:
+        """Path of the file a local copy was staged from (``filepath`` itself for other files)."""
+        return self._sources.get(filepath, filepath)
+
+    def output(self, filepath: str):
+        """Context manager of the path on scratch to write ``filepath`` to (see `staged_output`)."""
+        return staged_output(filepath, self.directory)
+
+    def close(self):
+        """Stop prefetching and remove all staged files."""
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._owner:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,278 @@
+import json
+import os
+import queue
+import runpy
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+# default socket and job logs of the service of a project, in the project directory
+SOCKET_FILENAME = 'metaSNV.sock'
+LOG_DIRNAME = 'service'
+
+
+class Job:
+    """A job of the service: a handler (``kind``) run with command line arguments."""
+
+    def __init__(self, job_id: int, kind: str, argv: List[str], log: str):
+        self.id = job_id
+        self.kind = kind
+        self.argv = argv
+        self.log = log
+        self.state = 'queued'
+        self.returncode = None
+
+    def to_dict(self) -> Dict:
+        return {'id': self.id, 'kind': self.kind, 'argv': self.argv, 'log': self.log, 'state': self.state,
+                'returncode': self.returncode}
+
+
+def run_forked(handler: Callable[[List[str]], None], argv: List[str], log: str) -> int:
+    """
+    Run ``handler(argv)`` in a child process forked from this one, with its
+    output written to ``log``. The child starts with everything this process
+    has imported and loaded, and exits with the status of the handler
+    (``sys.exit`` of command line scripts included).
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # line buffered, to keep the order of the output of subprocesses writing to the same file
+            sys.stdout = sys.stderr = open(log, 'w', buffering=1)
+            os.dup2(sys.stdout.fileno(), 1)
+            os.dup2(sys.stdout.fileno(), 2)
+            handler(argv)
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+class Launcher:
+    """
+    Process forking the jobs of a service, itself forked before the service
+    starts any thread: forking a process with running threads may deadlock
+    the child on locks held by the other threads (e.g. of logging or of
+    multiprocessing pools started by the jobs).
+
+    The launcher loads the state of the project (``refresh``) before the
+    first job and again after jobs of the kinds in ``refresh_after``, so that
+    jobs start with the current state.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable[[List[str]], None]], refresh: Optional[Callable[[], None]] = None,
+                 refresh_after: Iterable[str] = ()):
+        self.handlers = handlers
+        self.refresh = refresh
+        self.refresh_after = set(refresh_after)
+        self.pid = None
+        self._requests = None
+        self._results = None
+
+    def start(self):
+        requests_read, requests_write = os.pipe()
+        results_read, results_write = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(requests_write)
+                os.close(results_read)
+                with open(requests_read) as requests, open(results_write, 'w', buffering=1) as results:
+                    self._serve(requests, results)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(requests_read)
+        os.close(results_write)
+        self.pid = pid
+        self._requests = open(requests_write, 'w', buffering=1)
+        self._results = open(results_read)
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            traceback.print_exc()
+
+    def _serve(self, requests, results):
+        if self.refresh is not None:
+            self._refresh()
+        for line in requests:
+            kind, argv, log = json.loads(line)
+            try:
+                returncode = run_forked(self.handlers[kind], argv, log)
+            except OSError:
+                returncode = -1
+            if self.refresh is not None and kind in self.refresh_after:
+                self._refresh()
+            results.write(json.dumps(returncode) + '\n')
+
+    def run(self, job: Job) -> int:
+        """Run a job in a process forked from the launcher and return its exit status."""
+        try:
+            self._requests.write(json.dumps([job.kind, job.argv, job.log]) + '\n')
+            line = self._results.readline()
+        except OSError:
+            return -1
+        # the launcher died
+        return json.loads(line) if line else -1
+
+    def close(self):
+        self._requests.close()
+        self._results.close()
+        os.waitpid(self.pid, 0)
+
+
+def run_script(filepath: str) -> Callable[[List[str]], None]:
+    """Handler running a command line script (as ``__main__``) with the arguments of the job."""
+
+    def handler(argv: List[str]):
+        sys.argv = [filepath] + argv
+        runpy.run_path(filepath, run_name='__main__')
+
+    return handler
+
+
+class Service:
+    """
+    Run jobs submitted over a local Unix socket one after the other, each in
+    a process forked from the launcher of the service (see Launcher).
+
+    The service imports the modules of the pipeline and loads the state of the
+    project once (``refresh``, called again after jobs of the kinds in
+    ``refresh_after``), so that jobs only pay for their computation.
+    ``handlers`` maps job kinds to functions of the command line arguments of
+    a job.
+
+    Requests and responses are JSON objects, one per line:
+
+    - ``{"submit": kind, "argv": [...]}``: queue a job, returns the job,
+    - ``{"wait": id}``: wait until the job is finished, returns the job,
+    - ``{"jobs": null}``: all jobs,
+    - ``{"shutdown": null}``: stop once the queued jobs are finished.
+
+    Example:
+        >>> service = Service('outputs', {'echo': print})
+        >>> service.serve_forever()  # doctest: +SKIP
+    """
+
+    def __init__(self, project_dir: str, handlers: Dict[str, Callable[[List[str]], None]],
+                 socket_path: Optional[str] = None, refresh: Optional[Callable[[], None]] = None,
+                 refresh_after: Iterable[str] = ()):
+        self.project_dir = project_dir
+        self.handlers = handlers
+        self.socket_path = socket_path or os.path.join(project_dir, SOCKET_FILENAME)
+        self.launcher = Launcher(handlers, refresh, refresh_after)
+        self.log_dir = os.path.join(project_dir, LOG_DIRNAME)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.jobs = []
+        self.queue = queue.Queue()
+        self.finished = threading.Condition()
+        self.server = None
+
+    def submit(self, kind: str, argv: List[str]) -> Job:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job '{kind}', expected one of: {', '.join(self.handlers)}")
+        with self.finished:
+            job = Job(len(self.jobs), kind, list(argv), os.path.join(self.log_dir, f"job{len(self.jobs)}.log"))
+            self.jobs.append(job)
+        self.queue.put(job)
+        return job
+
+    def wait(self, job_id: int) -> Job:
+        with self.finished:
+            job = self.jobs[job_id]
+            self.finished.wait_for(lambda: job.state in ('done', 'failed'))
+        return job
+
+    def work(self):
+        """Run the queued jobs until shutdown."""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            with self.finished:
+                job.state = 'running'
+            returncode = self.launcher.run(job)
+            with self.finished:
+                job.returncode = returncode
+                job.state = 'done' if returncode == 0 else 'failed'
+                self.finished.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+
+    def handle(self, message: Dict) -> Dict:
+        try:
+            if 'submit' in message:
+                return self.submit(message['submit'], message.get('argv', [])).to_dict()
+            if 'wait' in message:
+                return self.wait(int(message['wait'])).to_dict()
+            if 'jobs' in message:
+                with self.finished:
+                    return {'jobs': [job.to_dict() for job in self.jobs]}
+            if 'shutdown' in message:
+                self.queue.put(None)
+                return {'shutdown': True}
+            return {'error': f"Unknown request {message}"}
+        except (ValueError, IndexError, KeyError) as e:
+            return {'error': str(e)}
+
+    def serve_forever(self):
+        """Start the launcher, then serve requests on the socket until shutdown."""
+        self.launcher.start()
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write((json.dumps(service.handle(json.loads(line))) + '\n').encode())
+                    self.wfile.flush()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, Handler) as server:
+            server.daemon_threads = True
+            self.server = server
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(self.socket_path)
+        # e.g. interrupted: finish the queued jobs
+        self.queue.put(None)
+        worker.join()
+        self.launcher.close()
+
+
+def request(socket_path: str, message: Dict) -> Dict:
+    """Send a request to a running service and return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(message) + '\n').encode())
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
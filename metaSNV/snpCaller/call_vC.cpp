@@ -2,6 +2,10 @@
 #include <iostream>
 #include <sstream>
 #include <unistd.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 //getopt
 //#include <ctype.h>
 //#include <unistd.h>
@@ -66,6 +70,7 @@ static int print_usage()
     fprintf(stderr, "Options: \n");
     fprintf(stderr, "     -f,     faidx indexed reference metagenome \n ");
     fprintf(stderr, "    -g,     gene annotation file [NULL].\n");
+    fprintf(stderr, "     -x,     index of the reference and gene annotation, instead of -g [NULL].\n");
     fprintf(stderr, "     -i,     individual SNPs output file [NULL].\n\n");
     fprintf(stderr, "SNP definition: \n");
     fprintf(stderr, "     -c,     minimum coverage (mapped reads) per position [4]\n ");
@@ -82,6 +87,73 @@ std::map<std::string, filePosition> mapGenes;
 //Here's where we save the genes
 split_interval_map<long,GeneDef> geneIntervals;
 
+/*===================================
+  Binary index of the genomes and genes (written by "metaSNV.py index"), memory mapped.
+  Little endian: header, stamp, packed genome sequences, genome table (sorted by name), gene table, names.
+  ===================================*/
+struct IndexHeader {
+  char magic[8];
+  uint64_t nrGenomes, nrGenes, genomesOffset, genesOffset, stringsOffset, stampLength;
+};
+
+struct IndexGenome {
+  uint64_t nameOffset, nameLength;
+  int64_t length;
+  uint64_t wordsOffset;//0 if the genome has no sequence
+  uint64_t firstGene, nrGenes;
+};
+
+struct IndexGene {
+  int64_t start, end;
+  uint64_t nameOffset;
+  uint32_t nameLength;
+  char strand;
+  char pad[3];
+};
+
+const char* indexData = NULL;
+const IndexHeader* indexHeader = NULL;
+
+/**
+ * @brief Memory map the index, shared by all snpCall processes of the same reference.
+ */
+bool mapIndex(const char* fileName) {
+    int fd = open(fileName, O_RDONLY);
+    if (fd < 0) {
+        return false;
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || st.st_size < (off_t) sizeof(IndexHeader)) {
+        close(fd);
+        return false;
+    }
+    void* data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) {
+        return false;
+    }
+    indexData = (const char*) data;
+    indexHeader = (const IndexHeader*) data;
+    return memcmp(indexHeader->magic, "MSNVIX01", 8) == 0;
+}
+
+/**
+ * @brief Binary search of a genome in the index. NULL if it has no genes.
+ */
+const IndexGenome* findIndexGenome(const std::string& gName) {
+    const IndexGenome* first = (const IndexGenome*) (indexData + indexHeader->genomesOffset);
+    const IndexGenome* last = first + indexHeader->nrGenomes;
+    const char* strings = indexData + indexHeader->stringsOffset;
+    const IndexGenome* it = std::lower_bound(first, last, gName,
+        [strings](const IndexGenome& g, const std::string& n) {
+            return n.compare(0, n.length(), strings + g.nameOffset, g.nameLength) > 0;
+        });
+    if (it == last || gName.compare(0, gName.length(), strings + it->nameOffset, it->nameLength) != 0) {
+        return NULL;
+    }
+    return it;
+}
+
 /**
  * @brief Fast thread-safe string tokenizer.
  *
@@ -198,6 +270,41 @@ bool indexGenomeAndGenes(FILE* refGenome, FILE* refGenes) {
     return true;
 }
 
+/**
+ * @brief Genes of a genome from the index, as loadGenome reads them from the annotation file.
+ */
+bool loadIndexGenome(const std::string& gName, bool* hasGenes) {
+    const IndexGenome* genome = findIndexGenome(gName);
+    if (genome == NULL) {//We don't have genes in this genome?
+        *hasGenes = false;
+        return true;
+    }
+    *hasGenes = true;
+
+    if (mapGenomes.find(gName) == mapGenomes.end()) {
+        if (genome->wordsOffset == 0) {
+            fprintf(stderr,"Weird...%s\n",gName.c_str());
+        } else {
+            mapGenomes[gName] = new Genome((const unsigned int*) (indexData + genome->wordsOffset), genome->length);
+        }
+    }
+
+    const IndexGene* genes = (const IndexGene*) (indexData + indexHeader->genesOffset) + genome->firstGene;
+    const char* strings = indexData + indexHeader->stringsOffset;
+    for (uint64_t i = 0; i < genome->nrGenes; ++i) {
+        const IndexGene& gene = genes[i];
+        Gene g(gene.start, gene.end, std::string(strings + gene.nameOffset, gene.nameLength), gene.strand);
+        if (gene.start > gene.end) {//goes around!
+            fprintf(stderr,"This gene goes around :(.\nPretending we didn't see it.\n");
+        } else {
+            discrete_interval<long> gene_interval = construct<discrete_interval<long> >(gene.start,gene.end,interval_bounds::closed());
+            GeneDef gD(g);
+            geneIntervals += make_pair(gene_interval,gD);
+        }
+    }
+    return true;
+}
+
 /**
  *  @brief Load and encode the genomes to save some space. Probably overkill.
  */
@@ -206,6 +313,10 @@ bool loadGenome(std::string gName, FILE* refGenes, bool* hasGenes) {
     //Drop old one
     geneIntervals.clear();
 
+    if (indexData != NULL) {
+        return loadIndexGenome(gName, hasGenes);
+    }
+
     if (mapGenes.find(gName) == mapGenes.end()) {//We don't have genes in this genome?
         *hasGenes = false;
         //And, just return
@@ -343,7 +454,7 @@ int main(int argc, char** argv) {
     base_count_map_t bpCounts;
     SNPCallOptions options;
 
-    while ((c = getopt (argc, argv, "hdab:f:g:i:c:p:t:")) != -1)
+    while ((c = getopt (argc, argv, "hdab:f:g:i:x:c:p:t:")) != -1)
         switch (c)
         {
             case 'h':		// help message
@@ -364,6 +475,12 @@ int main(int argc, char** argv) {
                     return -1;
                 }
                 break;
+            case 'x':		//index of the reference and gene annotation [optional], replaces -g
+                if (!mapIndex(optarg)) {
+                    fprintf(stderr,"Cannot load index %s\n",optarg);
+                    return -1;
+                }
+                break;
             case 'i':		// output filename [required]
                 individualFile = fopen(optarg, "w");
                 if (individualFile == NULL) {
@@ -382,7 +499,7 @@ int main(int argc, char** argv) {
                 options.calling_threshold = atol(optarg);
                 break;
             case '?':
-                if (( optopt == 'f') || ( optopt == 'g') || ( optopt == 'i') ){
+                if (( optopt == 'f') || ( optopt == 'g') || ( optopt == 'i') || ( optopt == 'x') ){
                     if ( optopt == 'f'){
                         fprintf (stderr, "Option -%c requires a reference file.\n", optopt);
                     }
@@ -392,6 +509,9 @@ int main(int argc, char** argv) {
                     if ( optopt == 'i'){
                         fprintf (stderr, "Option -%c requires an output filename.\n", optopt);
                     }
+                    if ( optopt == 'x'){
+                        fprintf (stderr, "Option -%c requires an index file.\n", optopt);
+                    }
                 } else if (isprint (optopt)){
                     fprintf (stderr, "Unknown option `-%c'.\n", optopt);
                 } else {
@@ -432,7 +552,12 @@ int main(int argc, char** argv) {
 
 
     //Now read and index genomes and genes if reference genome and annotationfile are given
-    if ( (genomes != NULL) && (genes != NULL) ) {
+    if (indexData != NULL) {
+        fprintf(stderr,"Found index of reference genomes and annotation file.\n");
+        if (genomes != NULL) {
+            fclose(genomes);
+        }
+    } else if ( (genomes != NULL) && (genes != NULL) ) {
         fprintf(stderr,"Found reference genomes and annotation file.\nLoading Genomes...\n");
         indexGenomeAndGenes(genomes,genes);
         fclose(genomes);
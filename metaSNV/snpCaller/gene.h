@@ -69,9 +69,17 @@ public:
     if (pos!=0) {//Add the end too
       sequence[insertPosition] = repr;
     }
+    words = sequence.data();
     //And done!
   }
 
+  /**
+     @brief Genome over already packed words (e.g. of a memory mapped index), not copied
+   */
+  Genome(const unsigned int* packed, long len)
+    :length(len)
+    ,words(packed) { }
+
   /**
      @brief Return sequence between coordinates, including end
    */
@@ -86,7 +94,7 @@ public:
     std::string res = "";
     //Now, actually get what the user wants
     for (long i=start; i<=end; ++i) {
-      res += intToBase[(sequence[i/10] >> 3*(i%10)) & 7];
+      res += intToBase[(words[i/10] >> 3*(i%10)) & 7];
     }
     return res;
   };
@@ -99,6 +107,7 @@ private:
 
   long length;
   std::vector<unsigned int> sequence;
+  const unsigned int* words;
 };
 
 //==========================================================================
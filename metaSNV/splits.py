@@ -0,0 +1,138 @@
+import os
+import glob
+import shutil
+
+from typing import Dict, List, Tuple
+
+from metaSNV.bam_preprocessing import BAMInfo
+from metaSNV.fileio import compression_of, find_file, with_compression
+
+SPLIT_PREFIX = "best_split_"
+
+
+def genome_of(ref_name: str) -> str:
+    """Genome (species) identifier of a reference sequence: everything before the first '.'"""
+    return ref_name.split('.')[0]
+
+
+def plan_splits(data: Dict[str, BAMInfo], n_splits: int) -> List[List[Tuple[str, int]]]:
+    """
+    Greedily assign genomes to splits of similar calling cost.
+
+    The cost of a genome is approximated by its length times its summed
+    average depth over all samples, i.e. roughly the number of bases
+    mpileup has to process. All contigs of a genome go to the same split.
+
+    Args:
+        data (dict): dictionary of BAMInfo objects.
+        n_splits (int): number of splits.
+
+    Returns:
+        list: per split, a list of (reference, length) tuples.
+    """
+    genome_refs = {}
+    genome_weight = {}
+    for bam_info in data.values():
+        for ref, bam_ref in bam_info.references.items():
+            genome = genome_of(ref)
+            refs = genome_refs.setdefault(genome, {})
+            refs[ref] = bam_ref.length
+            depth = bam_ref.coverage_depth('mean') if bam_ref.pos2cov else 0
+            genome_weight[genome] = genome_weight.get(genome, 0) + depth * bam_ref.length
+
+    splits = [[] for _ in range(n_splits)]
+    weight = [0.0] * n_splits
+    for genome in sorted(genome_refs, key=lambda g: (-genome_weight[g], g)):
+        pos = weight.index(min(weight))
+        # genomes without coverage still cost a pass over the reference
+        weight[pos] += max(genome_weight[genome], 1)
+        splits[pos].extend(sorted(genome_refs[genome].items()))
+    return [split for split in splits if split]
+
+
+def split_filepath(project_dir: str, split: int) -> str:
+    return os.path.join(project_dir, 'bestsplits', f"{SPLIT_PREFIX}{split}")
+
+
+def write_splits(project_dir: str, splits: List[List[Tuple[str, int]]]):
+    """
+    Write one BED region file per split into <project_dir>/bestsplits,
+    replacing the files of any previous plan. The SNV files and done
+    markers of the splits of a previous plan are removed, so that
+    `merge_splits` only merges splits called with this plan.
+    """
+    stale = [split_filepath(project_dir, '*'), done_marker(project_dir, '*')]
+    stale += [part + '*' for part in split_outputs(project_dir, '*')]
+    for old in sorted({filepath for pattern in stale for filepath in glob.glob(pattern)}):
+        os.remove(old)
+    for i, split in enumerate(splits):
+        with open(split_filepath(project_dir, i), 'w') as f:
+            for ref, length in split:
+                f.write(f"{ref}\t0\t{length}\n")
+
+
+def planned_splits(project_dir: str) -> List[int]:
+    """Indices of the splits written by `write_splits`, in ascending order."""
+    prefix = split_filepath(project_dir, '')
+    return sorted(int(f[len(prefix):]) for f in glob.glob(prefix + '*')
+                  if f[len(prefix):].isdigit())
+
+
+def split_outputs(project_dir: str, split: int, compression: str = 'none') -> Tuple[str, str]:
+    """Paths of the (called, individually called) SNV files of a split."""
+    out_dir = os.path.join(project_dir, 'snpCaller')
+    return (with_compression(os.path.join(out_dir, f"called_SNPs.{SPLIT_PREFIX}{split}"), compression),
+            with_compression(os.path.join(out_dir, f"indiv_called.{SPLIT_PREFIX}{split}"), compression))
+
+
+def done_marker(project_dir: str, split: int) -> str:
+    return os.path.join(project_dir, 'snpCaller', f".{SPLIT_PREFIX}{split}.done")
+
+
+def mark_done(project_dir: str, split: int):
+    with open(done_marker(project_dir, split), 'w'):
+        pass
+
+
+def merge_splits(project_dir: str) -> List[int]:
+    """
+    Concatenate the per-split SNV files into snpCaller/called_SNPs and
+    snpCaller/indiv_called and remove the split files. Compressed parts
+    are concatenated as they are (gzip members and zstd frames can be
+    chained) into a file with the same compression.
+
+    Raises:
+        ValueError: if no splits were planned, a split has not completed
+            or the splits were written with different compressions.
+    """
+    splits = planned_splits(project_dir)
+    if not splits:
+        raise ValueError(f"No splits found in '{os.path.join(project_dir, 'bestsplits')}'. "
+                         "Run 'metaSNV.py plan' first.")
+    missing = [i for i in splits if not os.path.isfile(done_marker(project_dir, i))]
+    if missing:
+        raise ValueError("Splits not completed: {}".format(", ".join(map(str, missing))))
+
+    parts = [[find_file(part) for part in split_outputs(project_dir, i)] for i in splits]
+    compressions = {compression_of(part) for split_parts in parts for part in split_parts if part}
+    if len(compressions) > 1:
+        raise ValueError("Splits were written with different compressions: {}".format(
+            ", ".join(sorted(compressions))))
+    compression = compressions.pop() if compressions else 'none'
+
+    out_dir = os.path.join(project_dir, 'snpCaller')
+    for k, merged in enumerate(["called_SNPs", "indiv_called"]):
+        merged = with_compression(os.path.join(out_dir, merged), compression)
+        with open(merged + '.tmp', 'wb') as out:
+            for split_parts in parts:
+                if split_parts[k]:
+                    with open(split_parts[k], 'rb') as f:
+                        shutil.copyfileobj(f, out)
+        os.replace(merged + '.tmp', merged)
+
+    for i, split_parts in zip(splits, parts):
+        for part in split_parts:
+            if part:
+                os.remove(part)
+        os.remove(done_marker(project_dir, i))
+    return splits
@@ -1,27 +1,97 @@
 import sys
+import glob
+import os.path
+import argparse
+from multiprocessing import Pool
 
-inf = open(sys.argv[1],'r') # .pos file
-outFile = open(sys.argv[1]+".freq",'w')
-minDepth = int(sys.argv[2]) # was hard coded as 5
-
-for line in inf:
-    c = line.rstrip().split('\t')
-    Id = c[0] + ':' +c[1]+':'+ c[2] # ref seq ID : - : position
-    cov = c[4].split('|') # this is the first set of "|"-delimited numbers
-    # which are the overall depth of coverage per position
-    for snp in c[5].split(','): # for each variant allele 
-        s = snp.split('|')
-        base = s[1] # variant allele
-        line = Id + ':' + base
-        for i in range(3,len(s)): # samples' data start at position 3
-            freq = -5
-            if int(cov[i-3]) < minDepth: # if vertical coverage at this position is less than x in this sample, set the SNV freq to -1
-                freq = -1
-            else:
-                freq = float(s[i])/int(cov[i-3]) * 100
-            line += '\t' + str(freq)
-        outFile.write(line+"\n")
-#        print(line, file=outFile)
-#        print(line)
-inf.close()
-outFile.close()
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert .pos files into SNV allele frequency tables (.pos.freq)')
+    parser.add_argument('inputs', nargs='+',
+                        help='.pos files and/or directories containing .pos files')
+    parser.add_argument('--min_depth', default=5, type=int,
+                        help='samples with a lower vertical coverage at a position get a frequency of -1')
+    parser.add_argument('--n_threads', default=1, type=int,
+                        help='number of .pos files to convert simultaneously')
+    args = parser.parse_args()
+
+    # legacy invocation: convertSNVtoAlleleFreq.py <posFile> <minDepth>
+    if len(args.inputs) == 2 and args.inputs[1].isdigit() and not os.path.exists(args.inputs[1]):
+        args.min_depth = int(args.inputs.pop())
+    return args
+
+
+def collect_pos_files(inputs):
+    posFiles = []
+    for path in inputs:
+        if os.path.isdir(path):
+            posFiles.extend(sorted(glob.glob(os.path.join(path, '*.pos'))))
+        else:
+            posFiles.append(path)
+    return posFiles
+
+
+def convert(posFile, minDepth=5):
+    '''Writes <posFile>.freq; returns the number of SNVs written'''
+    ids = []
+    counts = []
+    covs = []
+    with open(posFile, 'r') as inf:
+        for line in inf:
+            c = line.rstrip().split('\t')
+            Id = c[0] + ':' +c[1]+':'+ c[2] # ref seq ID : - : position
+            cov = c[4] # this is the first set of "|"-delimited numbers
+            # which are the overall depth of coverage per position
+            for snp in c[5].split(','): # for each variant allele
+                s = snp.split('|', 3) # samples' data start at position 3
+                ids.append(Id + ':' + s[1]) # variant allele
+                counts.append(s[3])
+                covs.append(cov)
+
+    with open(posFile + ".freq", 'w') as outFile:
+        if not ids:
+            return 0
+        nSamples = covs[0].count('|') + 1
+        count = np.array('|'.join(counts).split('|'), dtype=np.float64).reshape(-1, nSamples)
+        cov = np.array('|'.join(covs).split('|'), dtype=np.int64).reshape(-1, nSamples)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            freq = (count / cov * 100).astype(str)
+        # if vertical coverage at this position is less than x in this sample, set the SNV freq to -1
+        # (also without coverage at all, e.g. with a minimum depth of 0)
+        freq[(cov < minDepth) | (cov == 0)] = '-1'
+
+        for Id, row in zip(ids, freq.tolist()):
+            outFile.write(Id + '\t' + '\t'.join(row) + '\n')
+    return len(ids)
+
+
+def _convert(posFile, minDepth):
+    if os.path.getsize(posFile) <= 1:
+        sys.stderr.write("File is empty: {}\n".format(posFile))
+        return posFile, None
+    return posFile, convert(posFile, minDepth)
+
+
+def main():
+    args = parse_args()
+    posFiles = collect_pos_files(args.inputs)
+    if len(posFiles) < 1:
+        sys.exit("Error: no .pos files found in: " + " ".join(args.inputs))
+
+    tasks = [(f, args.min_depth) for f in posFiles]
+    if args.n_threads > 1 and len(posFiles) > 1:
+        with Pool(min(args.n_threads, len(posFiles))) as p:
+            results = p.starmap(_convert, tasks)
+    else:
+        results = [_convert(*t) for t in tasks]
+
+    failed = [f for f, n in results if n is None]
+    if failed:
+        sys.exit("Error: {} of {} .pos files were empty".format(len(failed), len(posFiles)))
+
+
+if __name__ == '__main__':
+    main()
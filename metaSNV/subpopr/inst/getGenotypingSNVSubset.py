@@ -1,54 +1,221 @@
+import io
 import sys
 import glob
+import gzip
 import os.path
+import argparse
+from bisect import bisect_right
+from collections import defaultdict
+from multiprocessing import Pool
 
-hapDir = sys.argv[1] # '../costea2017_data/extra/'  *hap_positions.tab
-metaSNVdir = sys.argv[2] # '../../SNP_calling/SNPs_best_split_?'
+# every INDEX_STEP-th line of a called_SNPs file (and the first line of
+# every reference) is recorded in its position index
+INDEX_STEP = 256
 
-print("Getting subspecies genotyping info from: "+hapDir+'/*hap_positions.tab')
-print("Getting SNV for all data from raw SNV calls: "+metaSNVdir+'/snpCaller/called_SNPs*')
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-fileDictionary = dict()
-positionDictionary = dict()
 
-if(len(glob.glob(hapDir+'/*hap_positions.tab')) < 1):
-  sys.exit("Error: no *hap_positions.tab files")
-if(len(glob.glob(metaSNVdir+'/snpCaller/called_SNPs*')) < 1):
-  sys.exit("Error: no /snpCaller/called_SNPs* files in metaSNV output directory")
+def is_compressed(snvFile):
+    return snvFile.endswith('.gz') or snvFile.endswith('.zst')
 
-for f in glob.glob(hapDir+'/*hap_positions.tab'):
-    spec = os.path.basename(f).replace('_hap_positions.tab','')
-    #spec = '_'.join(os.path.basename(f).split('_')[0:2]) # fails if species name has '_' in it
-    #print(spec)
-    if spec+'.pos' not in fileDictionary:
-        fileDictionary[spec+'.pos'] = open(hapDir+"/"+spec+'.pos','w')
-    inf = open(f)
-    inf.readline()
-    for line in inf:
-        l = line.rstrip().split('\t')
-        c = l[1].split(':')
-        #code = c[0]+':'+c[1]+':'+c[3]
-        code = c[0]+':'+c[2] # ref seq ID : position
-        if code not in positionDictionary:
-            positionDictionary[code] = []
-        if fileDictionary[spec+'.pos'] not in positionDictionary[code]:
-            positionDictionary[code].append(fileDictionary[spec+'.pos'])
 
-if len(positionDictionary) == 0:
-  sys.exit("Error: no parse-able data in "+hapDir+"/*hap_positions.tab files")
+def open_compressed(snvFile):
+    if snvFile.endswith('.gz'):
+        return gzip.open(snvFile, 'rb')
+    if zstandard is None:
+        sys.exit("Error: the 'zstandard' package is necessary to read " + snvFile)
+    return zstandard.ZstdDecompressor().stream_reader(open(snvFile, 'rb'), read_across_frames=True, closefd=True)
 
-#Now go through all of the SNPs and get these lines out
-for a in glob.glob(metaSNVdir+'/snpCaller/called_SNPs*'):
-#    print(a)
-    for line in open(a):
-        l = line.split('\t')
-        code = l[0]+':'+l[2] # reference seq ID : postion 
-        if code in positionDictionary:
-            for ff in positionDictionary[code]:
-                ff.write(line)
 
+def index_path(snvFile):
+    '''Hidden file next to the SNV file, so that it does not match called_SNPs* globs'''
+    return os.path.join(os.path.dirname(snvFile), '.' + os.path.basename(snvFile) + '.idx')
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Extract genotyping SNVs from raw metaSNV SNV calls')
+    parser.add_argument('hapDir', help='directory with *hap_positions.tab files; *.pos files are written here')
+    parser.add_argument('metaSNVdir', help='metaSNV output directory')
+    parser.add_argument('--n_threads', default=1, type=int,
+                        help='number of called_SNPs files to process simultaneously')
+    return parser.parse_args()
 
 
+def read_wanted_positions(hapDir):
+    '''Returns {ref seq ID: {position: [species, ...]}} and the list of species'''
+    wanted = defaultdict(lambda: defaultdict(list))
+    species = []
+    for f in glob.glob(hapDir+'/*hap_positions.tab'):
+        spec = os.path.basename(f).replace('_hap_positions.tab','')
+        #spec = '_'.join(os.path.basename(f).split('_')[0:2]) # fails if species name has '_' in it
+        if spec not in species:
+            species.append(spec)
+        with open(f) as inf:
+            inf.readline()
+            for line in inf:
+                l = line.rstrip().split('\t')
+                c = l[1].split(':')
+                # ref seq ID : position
+                specs = wanted[c[0]][int(c[2])]
+                if spec not in specs:
+                    specs.append(spec)
+    return wanted, species
 
+
+def build_index(snvFile):
+    '''Sparse position index: {ref seq ID: ([positions], [byte offsets])}'''
+    index = defaultdict(lambda: ([], []))
+    with open(snvFile, 'rb') as inf:
+        ref = None
+        n = 0
+        offset = 0
+        for line in inf:
+            l = line.split(b'\t', 3)
+            if l[0] != ref or n % INDEX_STEP == 0:
+                ref = l[0]
+                n = 0
+                positions, offsets = index[ref.decode()]
+                positions.append(int(l[2]))
+                offsets.append(offset)
+            n += 1
+            offset += len(line)
+    return dict(index)
+
+
+def write_index(index, indexFile, stat):
+    with open(indexFile, 'w') as out:
+        out.write('#{}\t{}\n'.format(stat.st_size, stat.st_mtime_ns))
+        for ref, (positions, offsets) in index.items():
+            for pos, off in zip(positions, offsets):
+                out.write('{}\t{}\t{}\n'.format(ref, pos, off))
+
+
+def read_index(indexFile, stat):
+    '''Returns the stored index, or None if it is missing or out of date'''
+    if not os.path.isfile(indexFile):
+        return None
+    index = defaultdict(lambda: ([], []))
+    with open(indexFile) as inf:
+        if inf.readline().rstrip('\n') != '#{}\t{}'.format(stat.st_size, stat.st_mtime_ns):
+            return None
+        for line in inf:
+            ref, pos, off = line.rstrip('\n').split('\t')
+            positions, offsets = index[ref]
+            positions.append(int(pos))
+            offsets.append(int(off))
+    return dict(index)
+
+
+def load_index(snvFile):
+    '''Load the position index of a called_SNPs file, building (and caching) it if necessary'''
+    stat = os.stat(snvFile)
+    indexFile = index_path(snvFile)
+    index = read_index(indexFile, stat)
+    if index is None:
+        index = build_index(snvFile)
+        try:
+            write_index(index, indexFile, stat)
+        except OSError:
+            pass  # read-only project directory, keep the index in memory only
+    return index
+
+
+def extract_positions(snvFile, wanted):
+    '''Returns {species: [lines]} for all wanted positions present in snvFile'''
+    index = load_index(snvFile)
+    found = defaultdict(list)
+    with open(snvFile, 'rb') as inf:
+        # references in file order, so lines are written in the order of the SNV file
+        for ref, (positions, offsets) in index.items():
+            if ref not in wanted:
+                continue
+            refWanted = wanted[ref]
+            bref = ref.encode()
+            current = -1  # offset of the next unread line
+            for pos in sorted(refWanted):
+                i = bisect_right(positions, pos) - 1
+                if i < 0:
+                    continue  # before the first SNV of this reference
+                if offsets[i] > current:
+                    inf.seek(offsets[i])
+                    current = offsets[i]
+                else:
+                    inf.seek(current)
+                for line in iter(inf.readline, b''):
+                    l = line.split(b'\t', 3)
+                    if l[0] != bref or int(l[2]) > pos:
+                        break
+                    current += len(line)
+                    if int(l[2]) == pos:
+                        for spec in refWanted[pos]:
+                            found[spec].append(line.decode())
+                        break
+    return dict(found)
+
+
+def scan_positions(snvFile, wanted):
+    '''Like extract_positions, for compressed files that cannot be seeked: reads the whole file'''
+    found = defaultdict(list)
+    with open_compressed(snvFile) as raw:
+        for line in io.BufferedReader(raw):
+            l = line.split(b'\t', 3)
+            refWanted = wanted.get(l[0].decode())
+            if refWanted is None:
+                continue
+            for spec in refWanted.get(int(l[2]), []):
+                found[spec].append(line.decode())
+    return dict(found)
+
+
+def _extract(snvFile):
+    if is_compressed(snvFile):
+        return scan_positions(snvFile, _wanted)
+
+    return extract_positions(snvFile, _wanted)
+
+
+def _init_worker(wanted):
+    global _wanted
+    _wanted = wanted
+
+
+def main():
+    args = parse_args()
+    hapDir = args.hapDir # '../costea2017_data/extra/'  *hap_positions.tab
+    metaSNVdir = args.metaSNVdir # '../../SNP_calling/SNPs_best_split_?'
+
+    print("Getting subspecies genotyping info from: "+hapDir+'/*hap_positions.tab')
+    print("Getting SNV for all data from raw SNV calls: "+metaSNVdir+'/snpCaller/called_SNPs*')
+
+    if(len(glob.glob(hapDir+'/*hap_positions.tab')) < 1):
+      sys.exit("Error: no *hap_positions.tab files")
+    snvFiles = sorted(glob.glob(metaSNVdir+'/snpCaller/called_SNPs*'))
+    if(len(snvFiles) < 1):
+      sys.exit("Error: no /snpCaller/called_SNPs* files in metaSNV output directory")
+
+    wanted, species = read_wanted_positions(hapDir)
+    if len(wanted) == 0:
+      sys.exit("Error: no parse-able data in "+hapDir+"/*hap_positions.tab files")
+    # plain dicts can be sent to the workers
+    wanted = {ref: dict(positions) for ref, positions in wanted.items()}
+
+    #Now seek to the wanted positions in all of the SNV files and get these lines out
+    if args.n_threads > 1 and len(snvFiles) > 1:
+        with Pool(min(args.n_threads, len(snvFiles)), initializer=_init_worker, initargs=(wanted,)) as p:
+            results = p.map(_extract, snvFiles)
+    else:
+        results = [scan_positions(f, wanted) if is_compressed(f) else extract_positions(f, wanted)
+                   for f in snvFiles]
+
+    # only one output file is open at a time
+    for spec in species:
+        with open(hapDir+"/"+spec+'.pos','w') as out:
+            for found in results:
+                out.writelines(found.get(spec, []))
+
+
+if __name__ == '__main__':
+    main()
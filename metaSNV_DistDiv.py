@@ -4,8 +4,12 @@ from __future__ import division
 import os
 import sys
 import argparse
+import atexit
 import glob
-from multiprocessing import Pool
+import hashlib
+import shutil
+import tempfile
+import zlib
 from functools import partial
 from datetime import datetime
 
@@ -21,6 +25,19 @@ except ImportError:
     sys.exit(1)
 
 
+from metaSNV.approx import Approximation, run_rows, subsample
+from metaSNV.kernels import pairwise_distances, cross_distances, pair_diversity, position_diversity
+from metaSNV.pruning import read_regions
+from metaSNV.positions import gene_strata, positions_path, read_positions, site_keys
+from metaSNV.profiling import profiled, summarize
+from metaSNV.estimate import calibrate, freq_size, task_memory
+from metaSNV.scheduling import ISOLATED_FILENAME, map_tasks
+from metaSNV.query import FilteredFrequencies, rows_path
+from metaSNV.scratch import StagedTask
+from metaSNV.regions import read_bed_regions, read_gene_regions, region_bounds, window_regions
+from metaSNV.fileio import COMPRESSION_SUFFIXES, find_file, glob_compressed, open_file, strip_compression, \
+    with_compression
+
 basedir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -50,10 +67,72 @@ def get_arguments():
     parser.add_argument('--div', action='store_true', help="Compute Diversity and FST")
     parser.add_argument('--divNS', action='store_true', help="Computing piN and piS")
     parser.add_argument('--matched', action='store_true', help="Computing on matched positions only")
+    parser.add_argument('--db_ann', metavar=': Gene annotation', default='',
+                        help="Compute diversity, piN/piS and FST of every gene of this annotation (as given to "
+                             "metaSNV.py) for all pairs of samples, in <species>.gene_diversity. "
+                             "Not restricted by --matched.")
+    parser.add_argument('--window', metavar=': Window size', default=0, type=int,
+                        help="Compute diversity, piN/piS and FST of windows of this many bases for all pairs of "
+                             "samples, in <species>.window_diversity. Not restricted by --matched.")
+    parser.add_argument('--window_step', metavar=': Window step', default=0, type=int,
+                        help="Bases between the starts of consecutive windows (default: the window size).")
     parser.add_argument('--n_threads', metavar=': Number of Processes', default=1, type=int,
                         help="Number of jobs to run simmultaneously.")
-
-    return parser.parse_args()
+    parser.add_argument('--max_memory', metavar=': Memory budget [GB]', default=None, type=float,
+                        help="Start a job only while the estimated memory of the running jobs (from the rows "
+                             "and samples of its species) stays below this many GB. Jobs killed (e.g. out of "
+                             "memory) are run again alone and listed in isolated_tasks.tsv of the output "
+                             "directory, to run them alone in later runs.")
+    parser.add_argument('--precision', choices=['float64', 'float32'], default='float64',
+                        help="Precision used to load, store and compute allele frequencies. "
+                             "float32 halves memory use; sums are still accumulated in float64. "
+                             "Distances and diversities then deviate from float64 results by less than "
+                             "1e-6 (relative) and FST by less than 1e-6 (absolute). Allele distances can "
+                             "differ where a frequency difference ties the threshold (e.g. 0.6 vs 0.0).")
+    parser.add_argument('--compression', choices=list(COMPRESSION_SUFFIXES), default='none',
+                        help="Compression of the distance and diversity files.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Reuse the matrices of a previous run and only compute the rows and columns of "
+                             "new samples. Species whose positions or frequencies changed for an existing "
+                             "sample are recomputed from scratch.")
+    parser.add_argument('--approx', action='store_true',
+                        help="Estimate distances and diversities on a stratified (by contig and gene) random "
+                             "subset of positions, doubled until the bootstrap confidence intervals are narrow "
+                             "enough. Bounds are written to <file>.lower and <file>.upper in distances*.approx/.")
+    parser.add_argument('--approx_width', metavar=': Relative width', default=0.1, type=float,
+                        help="Stop adding positions once every confidence interval of the Manhattan distances "
+                             "(--dist) or diversities (--div, --divNS) is at most this fraction of its estimate "
+                             "wide. Allele distances and FST are estimated on the same positions.")
+    parser.add_argument('--approx_level', metavar=': Confidence level', default=0.95, type=float,
+                        help="Confidence level of the intervals.")
+    parser.add_argument('--approx_bootstrap', metavar=': Bootstrap replicates', default=200, type=int,
+                        help="Number of bootstrap replicates.")
+    parser.add_argument('--approx_start', metavar=': Initial positions', default=10000, type=int,
+                        help="Number of positions of the first subset.")
+    parser.add_argument('--seed', default=0, type=int, help="Seed of the position subsampling.")
+    parser.add_argument('--regions', metavar=': Regions', default=None,
+                        help="BED file of the regions (e.g. genes) to compute distances and diversities on. Only "
+                             "the rows of these regions are loaded, and diversities are per base of the regions of "
+                             "each species (which should not overlap). Results are written to distances*.subset/.")
+    parser.add_argument('--samples', metavar=': Samples', default=None,
+                        help="File of the samples (one per line) to compute distances and diversities of. Only "
+                             "their columns are loaded. Results are written to distances*.subset/.")
+    parser.add_argument('--profile', metavar=': Profile directory', default=None,
+                        help="Profile every worker task (cProfile) into this directory and summarise all its "
+                             "profiles (e.g. of all stages of a run) in summary.txt.")
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="With --profile, also record tracemalloc snapshots of every worker task.")
+    parser.add_argument('--scratch', metavar=': Scratch directory', default=None,
+                        help="Node-local directory (e.g. $TMPDIR) every task copies the frequencies of its species "
+                             "to (while the other tasks compute) and writes its results to before moving them "
+                             "into the output directory atomically.")
+
+    args = parser.parse_args()
+    if args.approx and args.incremental:
+        parser.error("--approx cannot be combined with --incremental")
+    if args.scratch and args.incremental:
+        parser.error("--scratch cannot be combined with --incremental")
+    return args
 
 
 ############################################################
@@ -69,6 +148,9 @@ def file_check():
     args.coverage_file = args.projdir+'/'+args.projdir.split('/')[-1]+'.all_cov.tab'
     args.percentage_file = args.projdir+'/'+args.projdir.split('/')[-1]+'.all_perc.tab'
     args.bedfile = args.projdir+'/'+'bed_header'
+    # coverage tables may be compressed
+    args.coverage_file = find_file(args.coverage_file) or args.coverage_file
+    args.percentage_file = find_file(args.percentage_file) or args.percentage_file
 
     print("Checking for necessary input files...")
     if os.path.isfile(args.coverage_file) and os.path.isfile(args.percentage_file) and os.path.isfile(args.bedfile):
@@ -92,162 +174,457 @@ def print_arguments():
         print("Computing diversity and FST : {}".format(args.div))
     if args.divNS:
         print("Computing N and S diversities : {}".format(args.divNS))
+    if args.db_ann:
+        print("Per-gene diversity : {}".format(args.db_ann))
+    if args.window:
+        print("Window diversity : {} bases every {} bases".format(args.window, args.window_step or args.window))
     if args.matched:
         print("Matching positions (present in 90% of the samples) : {}".format(args.matched))
     if args.n_threads:
         print("Number of parallel processes : {}".format(args.n_threads))
+    if args.max_memory:
+        print("Memory budget : {} GB".format(args.max_memory))
+    print("Precision : {}".format(args.precision))
+    if args.incremental:
+        print("Incremental : {}".format(args.incremental))
+    if args.approx:
+        print("Approximation : relative width {}, level {}, {} bootstrap replicates, seed {}".format(
+            args.approx_width, args.approx_level, args.approx_bootstrap, args.seed))
+    if args.regions:
+        print("Regions : {}".format(args.regions))
+    if args.samples:
+        print("Samples : {}".format(args.samples))
+    if args.profile:
+        print("Profiling workers into : {}".format(args.profile))
     print("")
 
 
+def read_freq(filt_file, precision='float64', regions=None, samples=None):
+    ''' Load a filtered frequency table, with the frequencies stored in the requested precision. Only the rows within
+    ``regions`` and the columns of ``samples`` are loaded if given (see `FilteredFrequencies`) '''
+    if regions is not None or samples is not None:
+        table = FilteredFrequencies(filt_file)
+        if samples is not None:
+            # species are filtered on their own samples
+            samples = [sample for sample in samples if sample in table.samples]
+        return table.frequencies(table.rows(regions), samples, precision)
+    with open_file(filt_file) as f:
+        samples = f.readline().rstrip('\n').split('\t')[1:]
+    with open_file(filt_file) as f:
+        return pd.read_table(f, index_col=0, na_values=['-1'],
+                             dtype={sample: precision for sample in samples})
+
+
+def read_sites(filt_file, precision='float64', regions=None, samples=None):
+    ''' Load a filtered frequency table with its rows sorted by position (like their labels sort as strings) and
+    indexed by site number (see `site_keys`), and the encoded positions of the rows '''
+    data = read_freq(filt_file, precision, regions, samples)
+    positions = read_positions(filt_file, data.index)
+    keys = site_keys(positions)
+    order = np.argsort(keys, kind='stable')
+    data = data.iloc[order]
+    data.index = pd.Index(keys[order])
+    return data, positions.take(order)
+
+
+def matched_rows(data):
+    ''' Rows of the sites (rows with the same index) kept by --matched: sites with NaN in at most 10 % of their
+    frequencies, where a single row counts as many frequencies as samples and the two rows of a site with two alleles
+    are always kept '''
+    keys = data.index.to_numpy()
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.intp)
+    runs = np.diff(np.r_[starts, len(keys)])
+    n_nan = np.add.reduceat(np.isnan(data.to_numpy()).sum(axis=1), starts) if len(keys) else runs
+    size = np.where(runs == 1, len(data.columns), runs)
+    drop = (n_nan > size * 0.1) & (runs != 2) & ((runs != 1) | (len(data.columns) != 2))
+    return ~np.repeat(drop, runs)
+
+
+def species_regions(regions, species):
+    ''' Regions on the contigs of a species, or None without regions '''
+    if regions is None:
+        return None
+    return [region for region in regions if region[1].split('.')[0] == species]
+
+
+def read_samples(filepath):
+    ''' Sample names of a file, one per line '''
+    with open(filepath) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_table(table, filepath, compression='none'):
+    ''' Write a matrix as tab-separated file, compressed on background threads if requested '''
+    with open_file(with_compression(filepath, compression), 'wt') as f:
+        table.to_csv(f, sep='\t')
+
+
+def read_matrix(filepath, samples):
+    ''' Load a matrix written by `write_table` (plain or compressed) as float64 array, with rows and columns
+    in the order of ``samples`` (NaN for samples it does not contain) '''
+    with open_file(find_file(filepath)) as f:
+        matrix = pd.read_table(f, index_col=0, dtype=str)
+    return np.array(matrix.astype(np.float64).reindex(index=samples, columns=samples), dtype=np.float64)
+
+
 ############################################################
-# Distances
+# Approximation
+
+def approximation(args):
+    ''' Subsampling settings of --approx, or None for exact computations '''
+    if not args.approx:
+        return None
+    return Approximation(width=args.approx_width, n_bootstrap=args.approx_bootstrap, initial=args.approx_start,
+                         level=args.approx_level, seed=args.seed)
+
+
+def species_rng(approx, species):
+    ''' Random generator of a species, independent of the order species are processed in '''
+    return np.random.default_rng([approx.seed, zlib.crc32(species.encode())])
+
+
+def write_approximation(matrices, filepath, samples, precision='float64', compression='none'):
+    ''' Write an estimated matrix and the bounds of its confidence intervals (<file>.lower, <file>.upper) '''
+    for suffix, matrix in zip(['', '.lower', '.upper'], matrices):
+        table = pd.DataFrame(matrix, index=samples, columns=samples, dtype=precision)
+        write_table(table, filepath + suffix, compression)
+
+
+def distance_stats(values, threshold=.6):
+    ''' Additive statistics of the distances on a subset of positions (columns of ``values``):
+    sum and number of absolute differences, number of differences over ``threshold`` and of positions '''
+    def stats(rows):
+        block = np.ascontiguousarray(values[:, rows])
+        mann, allele = pairwise_distances(block, threshold)
+        valid = (~np.isnan(block)).astype(np.float64)
+        count = valid @ valid.T
+        return np.stack([np.where(count > 0, mann * count, 0.), count,
+                         np.nan_to_num(allele * len(rows)), np.full_like(count, len(rows))])
+    return stats
+
+
+def distance_estimator(stats, fraction):
+    return np.stack([stats[..., 0, :, :] / stats[..., 1, :, :],
+                     stats[..., 2, :, :] / stats[..., 3, :, :]], axis=-3)
+
+
+def diversity_stats(values, runs):
+    ''' Sum of the diversity terms of all pairs of samples (rows of ``values``) over a subset of positions '''
+    def stats(units):
+        block = np.ascontiguousarray(values[:, run_rows(runs, units)])
+        block_runs = np.ascontiguousarray(runs[units])
+        sums = np.empty((len(values), len(values)))
+        for j in range(len(values)):
+            for i in range(j + 1):
+                sums[j, i] = sums[i, j] = pair_diversity(block[i], block[j], block_runs)
+        return sums
+    return stats
+
+
+def approximate_diversity(data, strata, correction_coverage, approx, rng, with_fst=False):
+    ''' Estimated diversity (and FST) between all samples (columns), extrapolated from a subset of positions
+    sampled within the ``strata`` of the rows '''
+    values = np.ascontiguousarray(data.to_numpy().T)
+    runs = position_runs(data.index)
+
+    def estimator(sums, fraction):
+        div = sums / fraction / correction_coverage
+        return np.stack([div, fixation_index(div)] if with_fst else [div], axis=-3)
+
+    estimate, lower, upper, used = subsample(strata[np.cumsum(runs) - runs], diversity_stats(values, runs),
+                                             estimator, approx, rng, checked=1)
+    # lower triangle, like the exact matrices
+    upper_triangle = np.triu_indices(len(data.columns), 1)
+    for matrices in (estimate, lower, upper):
+        for matrix in matrices:
+            matrix[upper_triangle] = np.nan
+    return estimate, lower, upper, used, len(runs)
 
-def l1nonans(d1, d2):
-    return np.abs(d1 - d2).mean()
 
+############################################################
+# Incremental updates
+
+def checksum_path(outdir, species, kind):
+    return os.path.join(outdir, '.{}.{}.checksums'.format(species, kind))
+
+
+def sample_checksums(data, *per_sample, rows=None):
+    ''' Checksum of the positions and frequencies of every sample (column) of ``data``,
+    and of its entries in the sequences ``per_sample``. Positions are identified by the
+    ``rows`` digest if given, by the labels of the rows otherwise '''
+    positions = hashlib.sha1((rows if rows is not None else '\n'.join(map(str, data.index))).encode())
+    checksums = {}
+    for k, sample in enumerate(data.columns):
+        h = positions.copy()
+        h.update(np.ascontiguousarray(data[sample].to_numpy()).tobytes())
+        h.update(repr([values[k] for values in per_sample]).encode())
+        checksums[sample] = h.hexdigest()
+    return checksums
+
+
+def write_checksums(filepath, checksums):
+    with open(filepath, 'w') as f:
+        for sample, checksum in checksums.items():
+            f.write('{}\t{}\n'.format(sample, checksum))
+
+
+def reusable_samples(name, checksums, checksum_file, matrix_files):
+    ''' Samples whose results of a previous run can be reused, or None if everything has to be recomputed '''
+    if not os.path.isfile(checksum_file) or not all(find_file(f) for f in matrix_files):
+        print("{}: no previous results, computing all samples".format(name))
+        return None
+    with open(checksum_file) as f:
+        previous = dict(line.rstrip('\n').split('\t') for line in f)
+    old = [sample for sample in checksums if sample in previous]
+    if any(previous[sample] != checksums[sample] for sample in old):
+        print("{}: positions or frequencies of existing samples changed, computing all samples".format(name))
+        return None
+    if [sample for sample in previous if sample in checksums] != old:
+        print("{}: samples were reordered, computing all samples".format(name))
+        return None
+    print("{}: {} new samples, reusing {}".format(name, len(checksums) - len(old), len(old)))
+    return old
 
-def alleledist(d1, d2, threshold=.6):
-    return (np.abs(d1 - d2) > threshold).mean()
 
+############################################################
+# Distances
 
-def computeDist(filt_file,outdir):
-    ''' Compute distances per species '''
-    species = filt_file.split('/')[-1].replace('.freq', '')
-    data = pd.read_table(filt_file, index_col=0, na_values=['-1']).T
+def computeDist(filt_file, outdir, precision='float64', compression='none', incremental=False, approx=None,
+                regions=None, samples=None):
+    ''' Compute distances per species, on the positions within ``regions`` and between ``samples`` if given '''
+    species = strip_compression(filt_file).split('/')[-1].replace('.freq', '')
+    regions = species_regions(regions, species.split('.')[0])
+    if regions == []:
+        print("{}: no region on this species, skipped".format(species))
+        return
+    data = read_freq(filt_file, precision, regions, samples).T
+    values = np.ascontiguousarray(data.to_numpy())
+    mann_file = outdir + '/' + '%s.mann.dist' % species
+    allele_file = outdir + '/' + '%s.allele.dist' % species
+
+    if approx is not None:
+        strata = gene_strata(read_positions(filt_file, data.columns))
+        estimate, lower, upper, used = subsample(strata, distance_stats(values),
+                                                 distance_estimator, approx, species_rng(approx, species),
+                                                 checked=1)
+        print("{}: distances estimated on {} of {} positions".format(species, used, values.shape[1]))
+        for k, filepath in enumerate([mann_file, allele_file]):
+            write_approximation([estimate[k], lower[k], upper[k]], filepath, data.index, precision, compression)
+        return
+    checksums = sample_checksums(data.T)
+    checksum_file = checksum_path(outdir, species, 'dist')
+
+    old = reusable_samples(species, checksums, checksum_file, [mann_file, allele_file]) if incremental else None
+    if old is None:
+        mann, allele = pairwise_distances(values)
+    else:
+        # distances between existing samples are reused, only rows and columns of new samples are computed
+        old = set(old)
+        new = [k for k, sample in enumerate(data.index) if sample not in old]
+        mann = read_matrix(mann_file, data.index)
+        allele = read_matrix(allele_file, data.index)
+        if new:
+            new_mann, new_allele = cross_distances(values[new], values)
+            mann[new, :] = new_mann
+            mann[:, new] = new_mann.T
+            allele[new, :] = new_allele
+            allele[:, new] = new_allele.T
+
+    dist = pd.DataFrame(mann, index=data.index, columns=data.index, dtype=precision)
+    write_table(dist, mann_file, compression)
+
+    dist = pd.DataFrame(allele, index=data.index, columns=data.index, dtype=precision)
+    write_table(dist, allele_file, compression)
+    write_checksums(checksum_file, checksums)
+
+
+def freq_companions(filt_file):
+    ''' Index files of a filtered frequency table, staged with it '''
+    return [filepath for filepath in [positions_path(filt_file), rows_path(filt_file)] if os.path.isfile(filepath)]
+
+
+def species_task(args, func, outdir):
+    ''' Task of a species (profiled), run on copies of its frequencies and writing to --scratch if given '''
+    if args.scratch:
+        func = StagedTask(func, outdir, args.scratch_dir, stage_item=True, companions=freq_companions)
+    else:
+        func = partial(func, outdir=outdir)
+    return profiled(func, args.profile, args.profile_memory, freq_size)
 
-    dist = [[l1nonans(data.iloc[i], data.iloc[j]) for i in range(len(data))] for j in range(len(data))]
-    dist = pd.DataFrame(dist, index=data.index, columns=data.index)
-    dist.to_csv(outdir + '/' + '%s.mann.dist' % species, sep='\t')
 
-    dist = [[alleledist(data.iloc[i], data.iloc[j]) for i in range(len(data))] for j in range(len(data))]
-    dist = pd.DataFrame(dist, index=data.index, columns=data.index)
-    dist.to_csv(outdir + '/' + '%s.allele.dist' % species, sep='\t')
+def run_species(args, func, allFreq, outdir, stage):
+    ''' Run a task per species on --n_threads processes, within --max_memory if given '''
+    rates = calibrate([args.profile]) if args.profile and os.path.isdir(args.profile) else None
+    map_tasks(func, allFreq, args.n_threads,
+              footprint=lambda filt_file: task_memory(stage, freq_size(filt_file), rates),
+              budget=args.max_memory * 2 ** 30 if args.max_memory else None,
+              record=os.path.join(outdir, ISOLATED_FILENAME))
 
 
 def computeAllDist(args,outdir):
 
     print("Computing distances")
 
-    allFreq = glob.glob(args.filt + '/*.freq')
+    allFreq = glob_compressed(args.filt + '/*.freq')
 
-    p = Pool(processes=args.n_threads)
     partial_Dist = partial(computeDist,
-                           outdir=outdir)
-    p.map(partial_Dist, allFreq)
-    p.close()
-    p.join()
+                           precision=args.precision,
+                           compression=args.compression,
+                           incremental=args.incremental,
+                           approx=approximation(args),
+                           regions=args.query_regions,
+                           samples=args.query_samples)
+    run_species(args, species_task(args, partial_Dist, outdir), allFreq, outdir, 'distances')
 
 
 ############################################################
 # Pairwise Diversity
 
-def compute_diversity(sample1, sample2):
+def position_runs(index):
+    '''Number of rows (alleles) of each position of a sorted index'''
+    labels = index.to_numpy()
+    if not len(labels):
+        return np.zeros(0, dtype=np.intp)
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    return np.diff(np.r_[starts, len(labels)]).astype(np.intp)
+
+
+def pairwise_diversity(data, correction_coverage, new=None, previous=None):
+    '''Pairwise nucleotide diversity between all samples (columns), lower triangle (NaN above).
+    Given the ``previous`` matrix, only the pairs involving ``new`` samples and the diagonal are computed'''
+    values = np.ascontiguousarray(data.to_numpy().T)
+    runs = position_runs(data.index)
+    n = len(data.columns)
+    div = np.full((n, n), np.nan) if previous is None else previous
+    for j in range(n):
+        for i in range(j + 1):
+            if previous is None or new[i] or new[j] or i == j:
+                div[j, i] = pair_diversity(values[i], values[j], runs) / correction_coverage[j][i]
+    return div
+
+
+def coverage_correction(species, samples, horizontal_coverage, vertical_coverage, genome_length,
+                        precision='float64'):
+    '''Number of bases observed by every pair of samples'''
+    # Genome length corrected for horizontal coverage
+    correction_coverage = np.array([[(min(horizontal_coverage.loc[species, i],
+                                          horizontal_coverage.loc[species, j]) * genome_length) / 100
+                                     for i in samples] for j in samples], dtype=precision)
 
-    '''Pairwise nucleotide diversity'''
+    ########
+    # Vertical coverage in pi within : AvgCov / (AvgCov - 1)
+    for i in samples:
+        j = list(samples).index(i)
+        correction_within = vertical_coverage.loc[species, i] / (vertical_coverage.loc[species, i] - 1)
+        correction_coverage[j][j] = correction_coverage[j][j] / correction_within
+    return correction_coverage
 
-    sample1nd = sample1.reset_index().drop_duplicates(subset='index', keep=False).set_index('index')
-    sample2nd = sample2.reset_index().drop_duplicates(subset='index', keep=False).set_index('index')
-    sample2nd = sample2nd.reindex(index=sample1nd.index)
-    s1 = sample1nd.values
-    s2 = sample2nd.values
-    valid = ~(np.isnan(s1) | np.isnan(s2))
-    s1 = s1[valid]
-    s2 = s2[valid]
-    s1 = np.vstack([s1, 1 - s1])
-    s2 = np.vstack([s2, 1 - s2])
-    dist_nd = (s1[0]*s2[1]+s1[1]*s2[0]).sum()
 
-    def position_diversity(x):
-        out = np.outer(x.s1.values, x.s2.values)
-        return np.nansum(out) - np.nansum(out.diagonal())
+def observed_length(species, bedfile_tab, regions=None):
+    '''Bases of a species diversities are computed on: its genome, or its ``regions``'''
+    if regions is None:
+        return bedfile_tab.loc[str(species), 2].sum()
+    return sum(end - start + 1 for _, _, start, end in regions)
 
-    sample1d = sample1.loc[sample1.index[sample1.index.duplicated()]]
-    sample2d = sample2.loc[sample2.index[sample2.index.duplicated()]]
 
-    if not len(sample1d) or not len(sample2d):
-        # No duplicates
-        return dist_nd
+def fixation_index(div):
+    '''FST of all pairs of samples from their diversities (last two axes)'''
+    within = np.diagonal(div, axis1=-2, axis2=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - (within[..., np.newaxis, :] + within[..., :, np.newaxis]) / (2 * div)
 
-    both = pd.DataFrame({'s1': sample1d, 's2': sample2d})
-    both = both.reset_index()
-    both = pd.concat([both, (1. - both.groupby('index').sum()).reset_index()])
-    dist_d = both.groupby('index', group_keys=False).apply(position_diversity).sum()
 
-    return dist_d + dist_nd
+def diversity_state(data, positions, species, horizontal_coverage, vertical_coverage, genome_length):
+    '''Checksums of what the diversities of every sample depend on'''
+    return sample_checksums(data,
+                            [horizontal_coverage.loc[species, i] for i in data.columns],
+                            [vertical_coverage.loc[species, i] for i in data.columns],
+                            [genome_length] * len(data.columns),
+                            rows=positions.digest())
 
 
 ############################################################
 # Per Species Diversity
 
-def computeDiv(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab, matched,outdir):
-    '''Per species computation'''
+def computeDiv(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab, matched, outdir, precision='float64',
+               compression='none', incremental=False, approx=None, regions=None, samples=None):
+    '''Per species computation, on the positions within ``regions`` and of ``samples`` if given'''
 
     species = filt_file.split('/')[-1].split('.')[0]
-    data = pd.read_table(filt_file, index_col=0, na_values=['-1'])
-
-    pre_index = [i.split(':') for i in list(data.index)]
-    # Setting index for each position
-    data = data.set_index(pd.Index([item[0] + ':' + item[1] + ':' + item[2] for item in pre_index]))
-    data = data.sort_index()
+    regions = species_regions(regions, species)
+    if regions == []:
+        print("{}: no region on this species, skipped".format(species))
+        return
+    # rows sorted and indexed by position
+    data, positions = read_sites(filt_file, precision, regions, samples)
 
     ########
     # If matched, filter for 'common' positions :
     if matched:
-        def filt_proportion(x):
-            if len(x) == 2:
-                x = x.iloc[1:1]  # use 1:1 to get a dataframe instead of a series
-            n = np.count_nonzero(np.isnan(x))
-            return n > (len(x)*(0.1))
-
-        index_drop = [index for index in data.index if filt_proportion(data.loc[index])]
-        data = data.drop(index_drop)
+        rows = matched_rows(data)
+        data = data[rows]
+        positions = positions.take(rows)
 
     ########
     # Number of bases observed :
-    genome_length = bedfile_tab.loc[str(species), 2].sum()
-    # Genome length corrected for horizontal coverage
-    correction_coverage = [[(min(horizontal_coverage.loc[species, i],
-                                 horizontal_coverage.loc[species, j]) * genome_length) / 100
-                            for i in data.columns] for j in data.columns]
-
-    ########
-    # Vertical coverage in pi within : AvgCov / (AvgCov - 1)
-    for i in data.columns:
-        j = list(data.columns).index(i)
-        correction_within = vertical_coverage.loc[species, i] / (vertical_coverage.loc[species, i] - 1)
-        correction_coverage[j][j] = correction_coverage[j][j] / correction_within
-
-    div = [[compute_diversity(data.iloc[:, i], data.iloc[:, j]) / correction_coverage[j][i]
-            for i in range(j + 1)] for j in range(len(data.columns))]
-    FST = [[(1-(div[i][i]+div[j][j])/(2*div[j][i]))
-            for i in range(j + 1)] for j in range(len(div))]
+    genome_length = observed_length(species, bedfile_tab, regions)
+    correction_coverage = coverage_correction(species, data.columns, horizontal_coverage, vertical_coverage,
+                                              genome_length, precision)
+
+    div_file = outdir + '/' + '%s.diversity' % species
+    fst_file = outdir + '/' + '%s.FST' % species
+
+    if approx is not None:
+        estimate, lower, upper, used, n_positions = approximate_diversity(
+            data, gene_strata(positions), correction_coverage, approx, species_rng(approx, species), with_fst=True)
+        print("{}: diversity estimated on {} of {} positions".format(species, used, n_positions))
+        for k, filepath in enumerate([div_file, fst_file]):
+            write_approximation([estimate[k], lower[k], upper[k]], filepath, data.columns, precision, compression)
+        return
+
+    checksums = diversity_state(data, positions, species, horizontal_coverage, vertical_coverage, genome_length)
+    checksum_file = checksum_path(outdir, species, 'div')
+    old = reusable_samples(species, checksums, checksum_file, [div_file, fst_file]) if incremental else None
+
+    if old is None:
+        div = pairwise_diversity(data, correction_coverage)
+        FST = fixation_index(div)
+    else:
+        new = ~data.columns.isin(old)
+        div = pairwise_diversity(data, correction_coverage, new, read_matrix(div_file, data.columns))
+        FST = fixation_index(div)
+        # diversities of existing pairs were stored at the output precision, reuse their FST
+        old_pairs = ~(new[:, np.newaxis] | new[np.newaxis, :])
+        FST[old_pairs] = read_matrix(fst_file, data.columns)[old_pairs]
 
-    div = pd.DataFrame(div, index=data.columns, columns=data.columns)
+    div = pd.DataFrame(div, index=data.columns, columns=data.columns, dtype=precision)
 
-    FST = pd.DataFrame(FST, index=data.columns, columns=data.columns)
+    FST = pd.DataFrame(FST, index=data.columns, columns=data.columns, dtype=precision)
 
-    div.to_csv(outdir + '/' + '%s.diversity' % species, sep='\t')
-    FST.to_csv(outdir + '/' + '%s.FST' % species, sep='\t')
+    write_table(div, div_file, compression)
+    write_table(FST, fst_file, compression)
+    write_checksums(checksum_file, checksums)
 
 
 ############################################################
 # Per Species N & S Diversity
 
-def computeDivNS(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab, matched,outdir):
-    '''Per species computation'''
+def computeDivNS(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab, matched, outdir, precision='float64',
+                 compression='none', incremental=False, approx=None, regions=None, samples=None):
+    '''Per species computation, on the positions within ``regions`` and of ``samples`` if given'''
 
     species = filt_file.split('/')[-1].split('.')[0]
-    data = pd.read_table(filt_file, index_col=0, na_values=['-1'])
-
-    pre_index = [i.split(':') for i in list(data.index)]
-    # Setting index for each position
-    index1 = [item[0] + ':' + item[1] + ':' + item[2] for item in pre_index]
-    # Setting index for Non-synonymous vs Synonymous
-    index2 = [item[4].split('[')[0] for item in pre_index]
-    data = data.set_index(pd.MultiIndex.from_arrays([index1, index2], names=['index', 'synonimity']))
-    data = data.sort_index()
-    
-    if 'N' not in data.index.get_level_values("synonimity") or 'S' not in data.index.get_level_values("synonimity"):
+    regions = species_regions(regions, species)
+    if regions == []:
+        print("{}: no region on this species, skipped".format(species))
+        return
+    # rows sorted and indexed by position
+    data, positions = read_sites(filt_file, precision, regions, samples)
+    # Non-synonymous vs Synonymous
+    is_N = positions.synonymity == ord('N')
+    is_S = positions.synonymity == ord('S')
+
+    if not is_N.any() or not is_S.any():
         raise Exception(
         """
         You're asking metaSNV to compute synonymous and non-synonymous diversity but
@@ -257,48 +634,122 @@ def computeDivNS(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab,
         """
         )
 
-    data_N = data.xs('N', level='synonimity')
-    data_S = data.xs('S', level='synonimity')
+    data_N, positions_N = data[is_N], positions.take(is_N)
+    data_S, positions_S = data[is_S], positions.take(is_S)
 
     ########
     # If matched, filter for 'common' positions :
     if matched:
-        def filt_proportion(x):
-            if len(x) == 2:
-                x = x.iloc[1:1]  # use 1:1 to get a dataframe instead of a series
-            n = np.count_nonzero(np.isnan(x))
-            return n > (len(x)*(0.1))
+        rows = matched_rows(data_N)
+        data_N, positions_N = data_N[rows], positions_N.take(rows)
 
-        index_drop = [index for index in data_N.index if filt_proportion(data_N.loc[index])]
-        data_N = data_N.drop(index_drop)
-
-        index_drop = [index for index in data_S.index if filt_proportion(data_S.loc[index])]
-        data_S = data_S.drop(index_drop)
+        rows = matched_rows(data_S)
+        data_S, positions_S = data_S[rows], positions_S.take(rows)
 
     ########
     # Number of bases observed :
-    genome_length = bedfile_tab.loc[str(species), 2].sum()
-    # Genome length corrected for horizontal coverage
-    correction_coverage = [[(min(horizontal_coverage.loc[species, i],
-                                 horizontal_coverage.loc[species, j]) * genome_length) / 100
-                            for i in data.columns] for j in data.columns]
+    genome_length = observed_length(species, bedfile_tab, regions)
+    correction_coverage = coverage_correction(species, data.columns, horizontal_coverage, vertical_coverage,
+                                              genome_length, precision)
+
+    div_N_file = outdir + '/' + '%s.N_diversity' % species
+    div_S_file = outdir + '/' + '%s.S_diversity' % species
+
+    if approx is not None:
+        rng = species_rng(approx, species)
+        for kind, data_kind, positions_kind, filepath in [('N', data_N, positions_N, div_N_file),
+                                                          ('S', data_S, positions_S, div_S_file)]:
+            estimate, lower, upper, used, n_positions = approximate_diversity(
+                data_kind, gene_strata(positions_kind), correction_coverage, approx, rng)
+            print("{}: {} diversity estimated on {} of {} positions".format(species, kind, used, n_positions))
+            write_approximation([estimate[0], lower[0], upper[0]], filepath, data_kind.columns, precision,
+                                compression)
+        return
+
+    checksums = diversity_state(data, positions, species, horizontal_coverage, vertical_coverage, genome_length)
+    checksum_file = checksum_path(outdir, species, 'divNS')
+    old = reusable_samples(species, checksums, checksum_file, [div_N_file, div_S_file]) if incremental else None
+    new = None if old is None else ~data.columns.isin(old)
+
+    div_N = pairwise_diversity(data_N, correction_coverage, new,
+                               None if old is None else read_matrix(div_N_file, data_N.columns))
+    div_N = pd.DataFrame(div_N, index=data_N.columns, columns=data_N.columns, dtype=precision)
+    write_table(div_N, div_N_file, compression)
+
+    div_S = pairwise_diversity(data_S, correction_coverage, new,
+                               None if old is None else read_matrix(div_S_file, data_S.columns))
+    div_S = pd.DataFrame(div_S, index=data_S.columns, columns=data_S.columns, dtype=precision)
+    write_table(div_S, div_S_file, compression)
+    write_checksums(checksum_file, checksums)
 
-    ########
-    # Vertical coverage in pi within : AvgCov / (AvgCov - 1)
-    for i in data.columns:
-        j = list(data.columns).index(i)
-        correction_within = vertical_coverage.loc[species, i] / (vertical_coverage.loc[species, i] - 1)
-        correction_coverage[j][j] = correction_coverage[j][j] / correction_within
 
-    div_N = [[compute_diversity(data_N.iloc[:, i], data_N.iloc[:, j]) / correction_coverage[j][i]
-              for i in range(j + 1)] for j in range(len(data_N.columns))]
-    div_N = pd.DataFrame(div_N, index=data_N.columns, columns=data_N.columns)
-    div_N.to_csv(outdir + '/' + '%s.N_diversity' % species, sep='\t')
+############################################################
+# Per Species Diversity of Genes and Windows
+
+def region_diversity_sums(data, positions, regions):
+    '''Sum of the diversity contributions of every pair of samples (columns) over the positions of every region,
+    shape (regions, samples, samples). Contributions are accumulated once per pair, regions are prefix sum
+    differences'''
+    # contigs in the order of their names
+    rank = np.empty(len(positions.contigs), dtype=np.int32)
+    rank[np.argsort(positions.contigs, kind='stable')] = np.arange(len(positions.contigs), dtype=np.int32)
+    order = np.lexsort((positions.position, rank[positions.contig]))
+    values = np.ascontiguousarray(data.to_numpy()[order].T)
+    contigs = positions.contigs[positions.contig[order]]
+    positions = positions.position[order]
+
+    starts = np.flatnonzero(np.r_[True, (contigs[1:] != contigs[:-1]) | (positions[1:] != positions[:-1])])
+    runs = np.diff(np.r_[starts, len(order)]).astype(np.intp)
+    lo, hi = region_bounds(contigs[starts], positions[starts], regions)
+
+    n = len(data.columns)
+    sums = np.zeros((len(regions), n, n))
+    for j in range(n):
+        for i in range(j + 1):
+            prefix = np.r_[0., np.cumsum(position_diversity(values[i], values[j], runs))]
+            sums[:, j, i] = sums[:, i, j] = prefix[hi] - prefix[lo]
+    return sums
+
+
+def computeRegionDiv(filt_file, horizontal_coverage, vertical_coverage, bedfile_tab, regions, kind, outdir,
+                     precision='float64', compression='none'):
+    '''Per species diversity, piN, piS and FST of every region for all pairs of samples'''
+
+    species = filt_file.split('/')[-1].split('.')[0]
+    regions = species_regions(regions, species)
+    data = read_freq(filt_file, precision)
+    positions = read_positions(filt_file, data.index)
+    is_N = positions.synonymity == ord('N')
+    is_S = positions.synonymity == ord('S')
 
-    div_S = [[compute_diversity(data_S.iloc[:, i], data_S.iloc[:, j]) / correction_coverage[j][i]
-              for i in range(j + 1)] for j in range(len(data_S.columns))]
-    div_S = pd.DataFrame(div_S, index=data_S.columns, columns=data_S.columns)
-    div_S.to_csv(outdir + '/' + '%s.S_diversity' % species, sep='\t')
+    genome_length = bedfile_tab.loc[str(species), 2].sum()
+    correction_coverage = coverage_correction(species, data.columns, horizontal_coverage, vertical_coverage,
+                                              genome_length, precision)
+    # bases observed in every region, assuming the horizontal coverage of the genome
+    lengths = np.array([end - start + 1 for _, _, start, end in regions], dtype=np.float64)
+    correction = correction_coverage[np.newaxis, :, :] / genome_length * lengths[:, np.newaxis, np.newaxis]
+
+    pi = region_diversity_sums(data, positions, regions) / correction
+    pi_N = region_diversity_sums(data[is_N], positions.take(is_N), regions) / correction
+    pi_S = region_diversity_sums(data[is_S], positions.take(is_S), regions) / correction
+    FST = fixation_index(pi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = pi_N / pi_S
+
+    # every pair once, with the diversity within samples
+    j, i = np.tril_indices(len(data.columns))
+    samples = data.columns.to_numpy()
+    table = pd.DataFrame({
+        'region': np.repeat([name for name, _, _, _ in regions], len(i)),
+        'contig': np.repeat([contig for _, contig, _, _ in regions], len(i)),
+        'start': np.repeat([start for _, _, start, _ in regions], len(i)),
+        'end': np.repeat([end for _, _, _, end in regions], len(i)),
+        'sample1': np.tile(samples[i], len(regions)),
+        'sample2': np.tile(samples[j], len(regions)),
+    })
+    for name, values in [('pi', pi), ('piN', pi_N), ('piS', pi_S), ('piN_piS', ratio), ('FST', FST)]:
+        table[name] = values[:, j, i].ravel().astype(precision)
+    write_table(table.set_index('region'), outdir + '/' + '%s.%s_diversity' % (species, kind), compression)
 
 
 ############################################################
@@ -311,39 +762,62 @@ def computeAllDiv(args,outdir):
     print("Computing diversities & FST")
 
     # Load external info : Coverage, genomes size, genes size
-    horizontal_coverage = pd.read_table(args.percentage_file, skiprows=[1], index_col=0)
-    vertical_coverage = pd.read_table(args.coverage_file, skiprows=[1], index_col=0)
+    with open_file(args.percentage_file) as f:
+        horizontal_coverage = pd.read_table(f, skiprows=[1], index_col=0)
+    with open_file(args.coverage_file) as f:
+        vertical_coverage = pd.read_table(f, skiprows=[1], index_col=0)
 
     bedfile_tab = pd.read_table(args.bedfile, index_col=0, header=None)
     bed_index = [i.split('.')[0] for i in list(bedfile_tab.index)]
     bedfile_tab = bedfile_tab.set_index(pd.Index(bed_index))
 
     # All filtered.freq files in input folder
-    allFreq = glob.glob(args.filt + '/*.freq')
+    allFreq = glob_compressed(args.filt + '/*.freq')
 
     if args.div:
-        p = Pool(processes=args.n_threads)
         partial_Div = partial(computeDiv,
                               horizontal_coverage=horizontal_coverage,
                               vertical_coverage=vertical_coverage,
                               bedfile_tab=bedfile_tab,
                               matched=args.matched,
-                              outdir=outdir)
-        p.map(partial_Div, allFreq)
-        p.close()
-        p.join()
+                              precision=args.precision,
+                              compression=args.compression,
+                              incremental=args.incremental,
+                              approx=approximation(args),
+                              regions=args.query_regions,
+                              samples=args.query_samples)
+        run_species(args, species_task(args, partial_Div, outdir), allFreq, outdir, 'diversity')
 
     if args.divNS:
-        p = Pool(processes=args.n_threads)
         partial_DivNS = partial(computeDivNS,
                                 horizontal_coverage=horizontal_coverage,
                                 vertical_coverage=vertical_coverage,
                                 bedfile_tab=bedfile_tab,
                                 matched=args.matched,
-                                outdir=outdir)
-        p.map(partial_DivNS, allFreq)
-        p.close()
-        p.join()
+                                precision=args.precision,
+                                compression=args.compression,
+                                incremental=args.incremental,
+                                approx=approximation(args),
+                                regions=args.query_regions,
+                                samples=args.query_samples)
+        run_species(args, species_task(args, partial_DivNS, outdir), allFreq, outdir, 'diversity')
+
+    region_sets = []
+    if args.db_ann:
+        region_sets.append(('gene', read_gene_regions(args.db_ann)))
+    if args.window:
+        region_sets.append(('window', window_regions(read_regions(args.bedfile), args.window,
+                                                     args.window_step or args.window)))
+    for kind, regions in region_sets:
+        partial_RegionDiv = partial(computeRegionDiv,
+                                    horizontal_coverage=horizontal_coverage,
+                                    vertical_coverage=vertical_coverage,
+                                    bedfile_tab=bedfile_tab,
+                                    regions=regions,
+                                    kind=kind,
+                                    precision=args.precision,
+                                    compression=args.compression)
+        run_species(args, species_task(args, partial_RegionDiv, outdir), allFreq, outdir, 'diversity')
 
 
 ############################################################
@@ -366,9 +840,19 @@ if __name__ == "__main__":
         outdir = args.projdir + '/distances' + args.pars + '.matched_pos/'
     else:
         outdir = args.projdir + '/distances' + args.pars + '/'
+    if args.approx:
+        outdir = outdir.rstrip('/') + '.approx/'
+    args.query_regions = read_bed_regions(args.regions) if args.regions else None
+    args.query_samples = read_samples(args.samples) if args.samples else None
+    if args.regions or args.samples:
+        outdir = outdir.rstrip('/') + '.subset/'
 
     if not os.path.exists(outdir):
         os.makedirs(outdir)
+    if args.scratch:
+        os.makedirs(args.scratch, exist_ok=True)
+        args.scratch_dir = tempfile.mkdtemp(prefix='metaSNV.', dir=args.scratch)
+        atexit.register(shutil.rmtree, args.scratch_dir, ignore_errors=True)
 
     #####################
 
@@ -377,7 +861,9 @@ if __name__ == "__main__":
     if args.dist:
         computeAllDist(args,outdir)
 
-    if args.div or args.divNS:
+    if args.div or args.divNS or args.db_ann or args.window:
         computeAllDiv(args,outdir)
 
     print("Computations complete: ", datetime.now())
+    if args.profile:
+        print("Profile summary: {}".format(summarize(args.profile)))
@@ -4,11 +4,22 @@ from __future__ import division
 import os
 import sys
 import argparse
+import atexit
 import glob
 import shutil
-from multiprocessing import Pool
 from functools import partial
 
+from metaSNV.fileio import COMPRESSION_SUFFIXES, find_file, glob_compressed, open_file, with_compression
+from metaSNV.pruning import samples_of_interest as samples_of_interest_from_tables
+from metaSNV.kernels import parse_snv_line, count_covered, allele_frequencies
+from metaSNV.positions import PositionsEncoder
+from metaSNV.read_groups import parse_sample_entry
+from metaSNV.reference_cache import ALIGNMENT_SUFFIXES
+from metaSNV.profiling import profiled, summarize
+from metaSNV.estimate import calibrate, project_shares, snv_size, task_memory
+from metaSNV.scheduling import ISOLATED_FILENAME, map_tasks
+from metaSNV.scratch import Scratch, StagedTask
+
 basedir = os.path.dirname(os.path.abspath(__file__))
 
 # ======================================================================================================================
@@ -46,6 +57,24 @@ def get_arguments():
     parser.add_argument('--ind', action='store_true', help="Compute individual SNVs")
     parser.add_argument('--n_threads', metavar=': Number of Processes',
                         default=1, type=int, help="Number of jobs to run simultaneously.")
+    parser.add_argument('--max_memory', metavar='GB', default=None, type=float,
+                        help="Start a job only while the estimated memory of the running jobs stays below GB. "
+                             "Jobs killed (e.g. out of memory) are run again alone and listed in "
+                             "Proj/isolated_tasks.tsv, to run them alone in later runs.")
+    parser.add_argument('--compression', choices=list(COMPRESSION_SUFFIXES), default='none',
+                        help="Compression of the filtered frequency files.")
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help="Profile every worker task (cProfile) into DIR and summarise all profiles of DIR "
+                             "(e.g. of all stages of a run) in DIR/summary.txt.")
+    parser.add_argument('--profile_memory', action='store_true',
+                        help="With --profile, also record tracemalloc snapshots of every worker task.")
+    parser.add_argument('--scratch', metavar='DIR', default=None,
+                        help="Node-local directory (e.g. $TMPDIR) to copy the SNV calls to while the taxa of "
+                             "interest are determined, and to write the filtered frequencies to before moving "
+                             "them into Proj/filtered/ atomically.")
+    parser.add_argument('--scratch_limit', metavar='GB', default=None, type=float,
+                        help="Most space the SNV calls copied to --scratch may use; other files are read in place "
+                             "(default: 80%% of the free space of --scratch).")
 
     return parser.parse_args()
 
@@ -54,12 +83,28 @@ def get_arguments():
 # Basic functions
 
 
+def sample_name(path):
+    """Sample name of a BAM/CRAM file path or coverage table column (with or without '.bam'), or of a line of
+    all_samples (see metaSNV.read_groups.sample_entry)"""
+    _, sample = parse_sample_entry(path)
+    if sample is not None:
+        return sample
+    name = path.split('/')[-1]
+    for suffix in ALIGNMENT_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
 def file_check():
     """Check if required files exist (True / False)"""
     args.projdir = args.projdir.rstrip('/')
     args.coverage_file = args.projdir + '/' + args.projdir.split('/')[-1] + '.all_cov.tab'
     args.percentage_file = args.projdir + '/' + args.projdir.split('/')[-1] + '.all_perc.tab'
     args.all_samples = args.projdir + '/' + 'all_samples'
+    # coverage tables may be compressed
+    args.coverage_file = find_file(args.coverage_file) or args.coverage_file
+    args.percentage_file = find_file(args.percentage_file) or args.percentage_file
 
     print("Checking for necessary input files...")
     if os.path.isfile(args.coverage_file) and os.path.isfile(args.percentage_file):
@@ -91,6 +136,10 @@ def print_arguments():
         print("Compute indiv SNVs : {}".format(args.ind))
     if args.n_threads:
         print("Number of parallel processes : {}".format(args.n_threads))
+    if args.max_memory:
+        print("Memory budget : {} GB".format(args.max_memory))
+    if args.profile:
+        print("Profiling workers into : {}".format(args.profile))
     print("")
 
 
@@ -108,42 +157,11 @@ def print_arguments():
 def relevant_taxa(args):
     """function that goes through the coverage files and determines taxa and samples of interest"""
 
-    samples_of_interest = {}
-    with open(args.coverage_file, 'r') as COV, open(args.percentage_file, 'r') as PER:
-        header_cov = COV.readline().split()
-        header_per = PER.readline().split()
-        COV.readline()  # skip second row in COV_FILE
-        PER.readline()  # skip second row in PER_FILE
-
-        # Check if header match:
-        if header_cov != header_per:
-            sys.exit("ERROR: Coverage file headers do not match!")  # Exit with error message
-
-        # Read taxon by taxon (line by line) check coverage conditions (thresholds)
-        for cov, perc in zip(COV, PER):  # Line_cov: TaxID \t cov_valueS1 \t cov_value_S2[...]\n (no white spaces)
-            cstring = cov.split()
-            pstring = perc.split()
-            cov_taxID = cstring.pop(0)
-            perc_taxID = pstring.pop(0)
-            coverage = list(map(float, cstring))  # convert list_of_strings to list_of_floats (TaxID=STR!)
-            percentage = list(map(float, pstring))  # convert list_of_strings to list_of_floats
-            sample_count = 0
-            sample_names = []
-
-            if cov_taxID != perc_taxID:  # check if taxIDs match!
-                sys.exit("ERROR: TaxIDs in the coverage files are not in the same order!")
-
-            for c, p in zip(coverage, percentage):  # two arrays with floats (taxID pop[removed])
-                sample_count += 1
-
-                if c >= args.d and p >= args.b:
-                    sample_names.append(header_cov[sample_count - 1])  # starting at 0 in array
-
-                if sample_count == len(header_cov) and len(sample_names) >= args.m:
-                    samples_of_interest[cov_taxID] = sample_names
-
-    COV.close()
-    PER.close()
+    try:
+        samples_of_interest, header_cov = samples_of_interest_from_tables(
+            args.coverage_file, args.percentage_file, args.b, args.d, args.m)
+    except ValueError as e:
+        sys.exit("ERROR: {}".format(e))  # Exit with error message
 
     return {'SoI': samples_of_interest, 'h': header_cov}  # return dict()
 
@@ -163,12 +181,15 @@ def filter_two(species, args, snp_files, outdir, samples_of_interest):
     # read <all_samples> for snp_file header:
     all_samples = open(args.all_samples, 'r')
     snp_header = all_samples.read().splitlines()
-    snp_header = [i.split('/')[-1] for i in snp_header]  # get name /trim/off/path/to/sample.name.bam
+    snp_header = [sample_name(i) for i in snp_header]  # get name /trim/off/path/to/sample.name.bam
+
+    outpath = with_compression(outdir + '/' + '%s.filtered.freq' % species, args.compression)
+    encoder = PositionsEncoder()  # row labels, encoded next to the output for metaSNV_DistDiv.py
 
     for best_split_x in snp_files:
-        with open(best_split_x, 'r') as file:
+        with open_file(best_split_x, 'rt') as file:
             for snp_line in file:  # position wise loop
-                snp_taxID = snp_line.split()[0].split('.')[0]  # Name of Genome change from . to ]
+                snp_taxID = snp_line.split('\t', 1)[0].split('.')[0]  # Name of Genome change from . to ]
 
                 # Species filter:
                 if snp_taxID != species:  # Check if Genome is of interest
@@ -179,18 +200,12 @@ def filter_two(species, args, snp_files, outdir, samples_of_interest):
                     # !!! Sample order, get indices - INDICES based on ORDER in COV/PERC file !!!
                     sample_indices = []
                     for name in sample_list:
-                        sample_indices.append(snp_header.index(name))
+                        sample_indices.append(snp_header.index(sample_name(name)))
 
                     # Position filter:
                     # Positions with sufficient coverage (c) and proportion (p) in samples of interests (SoIs).
-                    whole_line = snp_line.split()
-                    site_coverage = list(map(int, whole_line[4].split('|')))  # Site coverages as list of ints
-                    nr_good = 0
-                    for index in sample_indices:
-                        if site_coverage[index] < args.c or site_coverage[index] == 0:
-                            continue  # Not enough coverage depth at position in sample, no increment
-                        else:
-                            nr_good += 1
+                    site_coverage, alleles = parse_snv_line(snp_line)  # Site coverages as list of ints
+                    nr_good = count_covered(site_coverage, sample_indices, args.c)
 
                     # Filter: Position incidence with sufficient coverage:
                     if float(nr_good) / len(sample_indices) < args.p:  # if snp_incidence < x % drop SNP
@@ -199,49 +214,54 @@ def filter_two(species, args, snp_files, outdir, samples_of_interest):
                     else:
                         # Calculate SNP allele frequency:
                         # If file do not exist yet, create it:
-                        if not os.path.isfile(outdir + '/' + '%s.filtered.freq' % snp_taxID):
-                            outfile = open(outdir + '/' + '%s.filtered.freq' % snp_taxID, 'w')
-                            print("Generating: {}".format(outdir + '/' + '%s.filtered.freq' % snp_taxID))
+                        if not os.path.isfile(outpath):
+                            outfile = open_file(outpath, 'wt')
+                            print("Generating: {}".format(outpath))
                             outfile.write('\t' + "\t".join(sample_list) + '\n')
 
                         # Loop through alternative alleles [5](comma separated):
-                        line_id = ":".join(whole_line[:4])  # line_id composed of CHROM:REFGENE:POS:REFBASE
-                        reference_base = whole_line[3]
-                        alt_bases_totalcov = []  # total coverage per alt allele
-                        # VCF format
+                        line_id = ":".join(snp_line.split('\t', 4)[:4])  # line_id composed of CHROM:REFGENE:POS:REFBASE
 
                         # Loop Start:
-                        for snp in whole_line[5].split(','):
-
-                            xS = snp.split('|')
-                            snp_coverage = list(map(float, xS[3:]))  # coverage string (unfiltered!)
+                        for alt_base, snp_type, snp_coverage in alleles:
 
                             # Sanity check:
                             if len(site_coverage) != len(snp_coverage):
                                 print("ERROR: SNP FILE {} is corrupted".format(best_split_x))
                                 sys.exit("ERROR: Site coverage and SNP coverage string have uneven length!")
 
-                            # Compute allele frequency tables:
-                            alt_base = snp.split('|')[1]  # alternative base
-
                             # Frequency Computation
-                            total_reads = 0
-                            snp_frq = []  # frequencies for SNPs (pos > cX in at least p% of the SoIs)
-                            for index in sample_indices:
-
-                                # prevent division by zero!
-                                if site_coverage[index] >= args.c and site_coverage[index] != 0:
-                                    snp_frq.append(snp_coverage[index] / site_coverage[index])
-                                else:
-                                    snp_frq.append(-1)
+                            # frequencies for SNPs (pos > cX in at least p% of the SoIs), -1 below cX
+                            snp_frq = allele_frequencies(snp_coverage, site_coverage, sample_indices, args.c)
 
                             # Write Output Allele Frequencies (Default)
-                            outfile.write(
-                                ":".join(snp_line.split()[:4]) + '>' + alt_base + ':' + xS[2] + '\t' + "\t".join(
-                                    str(x) for x in snp_frq) + '\n')
+                            label = line_id + '>' + alt_base + ':' + snp_type
+                            encoder.add(label)
+                            outfile.write(label + '\t' + "\t".join(str(x) for x in snp_frq) + '\n')
     if 'outfile' in locals():
         print("closing: {}".format(species))
         outfile.close()
+        encoder.write(outpath)
+
+
+def filtering_task(args, samples_of_interest, snp_files, outdir, scratch, shares):
+    '''filter_two of a species (profiled), writing to scratch first with --scratch'''
+    func = partial(filter_two, args=args, snp_files=snp_files, samples_of_interest=samples_of_interest)
+    if scratch is None:
+        func = partial(func, outdir=outdir)
+    else:
+        func = StagedTask(func, outdir, scratch.directory)
+    return profiled(func, args.profile, args.profile_memory, partial(snv_size, snp_files, shares=shares))
+
+
+def run_species(args, func, species, snp_files, shares):
+    '''Run a filtering task per species on --n_threads processes, within --max_memory if given. The memory
+    of a task is its share of the SNV calls (see metaSNV.estimate.taxon_shares)'''
+    rates = calibrate([args.profile]) if args.profile and os.path.isdir(args.profile) else None
+    map_tasks(func, species, args.n_threads,
+              footprint=lambda name: task_memory('filtering', snv_size(snp_files, name, shares), rates),
+              budget=args.max_memory * 2 ** 30 if args.max_memory else None,
+              record=os.path.join(args.projdir, ISOLATED_FILENAME))
 
 
 # ======================================================================================================================
@@ -253,6 +273,15 @@ if __name__ == "__main__":
     print_arguments()
     file_check()
 
+    scratch = None
+    pop_files = glob_compressed(args.projdir + '/snpCaller/called*')
+    ind_files = glob_compressed(args.projdir + '/snpCaller/indiv*') if args.ind else []
+    if args.scratch:
+        # SNV calls are copied to scratch while the coverage tables are read
+        scratch = Scratch(args.scratch, int(args.scratch_limit * 2 ** 30) if args.scratch_limit is not None else None)
+        atexit.register(scratch.close)
+        scratch.prefetch(pop_files + ind_files)
+
     # ==========================================
     # Filtering I - Determine Taxa of Interest:
     # ==========================================
@@ -279,25 +308,17 @@ if __name__ == "__main__":
         os.makedirs(filt_folder)
         os.makedirs(filt_folder + '/pop/')
 
-    p = Pool(processes=args.n_threads)
-    partial_Div = partial(filter_two,
-                          args=args,
-                          snp_files=glob.glob(args.projdir + '/snpCaller/called*'),
-                          outdir=filt_folder + '/pop',
-                          samples_of_interest=samples_of_interest)
-    p.map(partial_Div, samples_of_interest.keys())
-    p.close()
-    p.join()
+    snp_files = list(scratch.fetched(pop_files)) if scratch is not None else pop_files
+    shares = project_shares(args.projdir)
+    partial_Div = filtering_task(args, samples_of_interest, snp_files, filt_folder + '/pop', scratch, shares)
+    run_species(args, partial_Div, list(samples_of_interest.keys()), snp_files, shares)
 
     if args.ind:
         if not os.path.exists(filt_folder + '/ind/'):
             os.makedirs(filt_folder + '/ind/')
-        p = Pool(processes=args.n_threads)
-        partial_Div = partial(filter_two,
-                              args=args,
-                              snp_files=glob.glob(args.projdir + '/snpCaller/indiv*'),
-                              outdir=filt_folder + '/ind',
-                              samples_of_interest=samples_of_interest)
-        p.map(partial_Div, samples_of_interest.keys())
-        p.close()
-        p.join()
+        snp_files = list(scratch.fetched(ind_files)) if scratch is not None else ind_files
+        partial_Div = filtering_task(args, samples_of_interest, snp_files, filt_folder + '/ind', scratch, shares)
+        run_species(args, partial_Div, list(samples_of_interest.keys()), snp_files, shares)
+
+    if args.profile:
+        print("Profile summary: {}".format(summarize(args.profile)))
@@ -73,6 +73,14 @@ class build_ext(_build_ext):
         self.target_cpu = _detect_target_cpu(self.plat_name)
         self.target_system = _detect_target_system(self.plat_name)
 
+    def build_extensions(self):
+        # the kernels reproduce numpy's floating-point results exactly,
+        # which contracting a * b + c into fused multiply-adds would break
+        if self.compiler.compiler_type == "unix":
+            for ext in self.extensions:
+                ext.extra_compile_args.append("-ffp-contract=off")
+        _build_ext.build_extensions(self)
+
 
 SRC_DIR = "src"
 PACKAGES = [SRC_DIR]
@@ -81,6 +89,7 @@ install_requires = ["cython", "numpy"]
 setup_requires = ["cython"]
 
 EXTENSIONS = [
+    Extension("metaSNV.kernels._compiled", ["metaSNV/kernels/_compiled.pyx"]),
 ]
 
 main_ns = {}
@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from metaSNV.approx import Approximation, run_rows, strata_of, stratified_order, subsample
+
+
+class TestApprox(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(0)
+
+    def test_strata_of(self):
+        self.assertEqual(strata_of(['sp.c0:g1:19:A>C:S[AAA-ACA]', 'sp.c1:-:7']), ['sp.c0:g1', 'sp.c1:-'])
+
+    def test_stratified_order(self):
+        strata = ['a'] * 600 + ['b'] * 300 + ['c'] * 100
+        order = stratified_order(strata, self.rng)
+        self.assertEqual(sorted(order), list(range(1000)))
+        for prefix in [10, 100, 500]:
+            counts = np.unique(np.asarray(strata)[order[:prefix]], return_counts=True)[1]
+            np.testing.assert_allclose(counts, np.array([0.6, 0.3, 0.1]) * prefix, atol=1)
+
+    def test_run_rows(self):
+        runs = np.array([1, 3, 1, 2])
+        np.testing.assert_array_equal(run_rows(runs, np.array([1, 3])), [1, 2, 3, 5, 6])
+        self.assertEqual(len(run_rows(runs, np.array([], dtype=np.intp))), 0)
+
+    def test_subsample(self):
+        values = self.rng.normal(10, 1, 20000)
+        strata = ['s{}'.format(k % 7) for k in range(len(values))]
+
+        def stats(units):
+            return np.array([values[units].sum(), len(units)])
+
+        def estimator(sums, fraction):
+            return (sums[..., 0] / sums[..., 1])[..., np.newaxis]
+
+        estimate, lower, upper, used = subsample(strata, stats, estimator, Approximation(width=0.01, initial=100),
+                                                 self.rng)
+        self.assertLess(used, len(values))
+        self.assertLessEqual(upper[0] - lower[0], 0.01 * estimate[0])
+        self.assertTrue(lower[0] <= values.mean() <= upper[0])
+
+        # everything is used when the intervals cannot get narrow enough
+        estimate, _, _, used = subsample(strata, stats, estimator, Approximation(width=0., initial=100), self.rng)
+        self.assertEqual(used, len(values))
+        self.assertAlmostEqual(estimate[0], values.mean())
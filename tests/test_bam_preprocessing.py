@@ -1,6 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from metaSNV.bam_preprocessing import BAMInfo, BAMReference
+import pysam
+
+from metaSNV.bam_preprocessing import BAMInfo, BAMReference, depth_tasks, partition_references, region_depth, \
+    legacy_values, read_legacy, write_legacy, write_legacy_columns
 
 class TestBAMReference(unittest.TestCase):
     def setUp(self) -> None:
@@ -45,3 +51,87 @@ class TestBAMInfo(unittest.TestCase):
         self.assertEqual(ref.coverage_depth('median'), 16)
         self.assertEqual(ref.coverage_breadth(1), 0.99938)
 
+    def test_legacy_tables(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            table = os.path.join(tmp_dir, 'all_perc.tab')
+            write_legacy({'test': self.test_bam}, table, 'breadth')
+            columns = read_legacy(table)
+            self.assertEqual(columns, {'test': legacy_values(self.test_bam, 'breadth')})
+            # a sample added to the values of a table, as for a table of both samples
+            other = BAMInfo(self.test_bam.filepath.replace('test', 'other'))
+            other.references = self.test_bam.references
+            columns['other'] = legacy_values(other, 'breadth')
+            write_legacy_columns({sample: columns[sample] for sample in sorted(columns)}, table, 'breadth')
+            with open(table) as f:
+                added = f.read()
+            write_legacy({'other': other, 'test': self.test_bam}, table, 'breadth')
+            with open(table) as f:
+                self.assertEqual(added, f.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+
+class TestRegionDepth(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'test.bam')
+        shutil.copy('tests/data/test.bam', self.filepath)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_partition_references(self):
+        partitions = partition_references([('a', 25), ('b', 5), ('c', 10)], 4)
+        self.assertEqual(partitions, [[('a', 0, 10)], [('a', 10, 20)], [('a', 20, 25), ('b', 0, 5)],
+                                      [('c', 0, 10)]])
+        self.assertEqual(partition_references([('a', 3)], 8), [[('a', 0, 1)], [('a', 1, 2)], [('a', 2, 3)]])
+
+    def test_unindexed(self):
+        self.assertEqual(depth_tasks(self.filepath, 4), [(self.filepath, None)])
+
+    def test_from_depth(self):
+        expected = BAMInfo.from_bam(self.filepath)
+        pysam.index(self.filepath)
+        for n_partitions in [2, 5, 40]:
+            tasks = depth_tasks(self.filepath, n_partitions)
+            self.assertEqual(len(tasks), n_partitions)
+            info = BAMInfo.from_depth(self.filepath, map(region_depth, tasks))
+            self.assertEqual(info.sample, expected.sample)
+            for ref in expected.get_reference_names():
+                self.assertEqual(list(info[ref].pos2cov.items()), list(expected[ref].pos2cov.items()))
+
+
+class TestReadGroups(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'lanes.bam')
+        with pysam.AlignmentFile('tests/data/test.bam', 'rb') as src:
+            header = src.header.to_dict()
+            header['RG'] = [{'ID': 'l1', 'SM': 's1'}, {'ID': 'l2', 'SM': 's2'}, {'ID': 'l3', 'SM': 's1'}]
+            with pysam.AlignmentFile(self.filepath, 'wb', header=header) as dst:
+                for k, read in enumerate(src.fetch(until_eof=True)):
+                    read.set_tag('RG', ['l1', 'l2', 'l3'][k % 3])
+                    dst.write(read)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_from_read_groups(self):
+        expected = BAMInfo.from_bam('tests/data/test.bam')
+        infos = BAMInfo.from_read_groups(self.filepath)
+        self.assertEqual([info.sample for info in infos], ['s1', 's2'])
+        self.assertEqual(infos[0].entry, self.filepath + '\ts1')
+        for ref in expected.get_reference_names():
+            total = [sum(info[ref].pos2cov.get(pos, 0) for info in infos) for pos in expected[ref].positions()]
+            self.assertTrue(total == expected[ref].coverage_depth('raw'))
+
+    def test_merge(self):
+        infos = BAMInfo.from_read_groups(self.filepath)
+        expected = {ref: dict(infos[0][ref].pos2cov) for ref in infos[0].get_reference_names()}
+        merged = BAMInfo.merge([infos[0], BAMInfo.from_read_groups(self.filepath)[0]])
+        self.assertEqual(merged.read_group_files, [self.filepath, self.filepath])
+        for ref, pos2cov in expected.items():
+            self.assertTrue(merged[ref].pos2cov == {pos: 2 * cov for pos, cov in pos2cov.items()})
+            self.assertTrue(infos[0][ref].pos2cov == pos2cov)
@@ -0,0 +1,24 @@
+import io
+import unittest
+
+from metaSNV.batched_pileup import merge_pileups, pileup_batches
+
+
+class TestBatchedPileup(unittest.TestCase):
+    def test_batches(self):
+        self.assertEqual(pileup_batches(['a', 'b', 'c'], [0, {'g': 1}, 2], 2),
+                         [(['a', 'b'], [0, {'g': 1}]), (['c'], [2])])
+
+    def test_merge(self):
+        first = io.BytesIO(b'r1\t5\tA\t1\t.\tI\t0\t*\t*\n'
+                           b'r2\t1\tC\t2\t,G\tIJ\t1\tT\tK\n')
+        second = io.BytesIO(b'r1\t5\tA\t2\t.,\tII\n'
+                            b'r1\t7\tA\t1\tc\tI\n')
+        dst = io.BytesIO()
+        dst.close = lambda: None
+        merge_pileups([first, second], pileup_batches(['a', 'b', 'c'], [0, 1, 2], 2), dst, 3, 3,
+                      {'r1': 0, 'r2': 1})
+        self.assertEqual(dst.getvalue().decode(),
+                         'r1\t5\tA\t1\t.\tI\t0\t*\t*\t2\t.,\tII\n'
+                         'r1\t7\tA\t0\t*\t*\t0\t*\t*\t1\tc\tI\n'
+                         'r2\t1\tC\t2\t,G\tIJ\t1\tT\tK\t0\t*\t*\n')
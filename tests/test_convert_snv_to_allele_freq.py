@@ -0,0 +1,37 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'metaSNV', 'subpopr', 'inst', 'convertSNVtoAlleleFreq.py')
+
+
+class TestConvertSNVtoAlleleFreq(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pos_file = os.path.join(self.tmp_dir, 'sp1.pos')
+        with open(self.pos_file, 'w') as f:
+            f.write('sp1\t-\t10\tA\t8|0|4\t6|C|.|2|0|4,2|G|.|2|0|0\n'
+                    'sp1\t-\t20\tA\t3|5|0\t4|T|.|1|3|0\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, min_depth):
+        subprocess.run([sys.executable, SCRIPT, self.pos_file, '--min_depth', str(min_depth)], check=True)
+        with open(self.pos_file + '.freq') as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def test_min_depth(self):
+        self.assertEqual(self.convert(5), [['sp1:-:10:C', '25.0', '-1', '-1'],
+                                           ['sp1:-:10:G', '25.0', '-1', '-1'],
+                                           ['sp1:-:20:T', '-1', '60.0', '-1']])
+
+    def test_zero_coverage(self):
+        # samples without coverage get -1 even without a minimum depth
+        self.assertEqual(self.convert(0), [['sp1:-:10:C', '25.0', '-1', '100.0'],
+                                           ['sp1:-:10:G', '25.0', '-1', '0.0'],
+                                           ['sp1:-:20:T', '33.33333333333333', '60.0', '-1']])
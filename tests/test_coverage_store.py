@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metaSNV.bam_preprocessing import BAMInfo, BAMReference
+from metaSNV.coverage_store import CoverageStore, CoverageStoreWriter
+
+
+class TestCoverageStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bam(self):
+        writer = CoverageStoreWriter(self.tmp_dir)
+        bam = BAMInfo.from_bam('tests/data/test.bam', store=writer)
+        writer.write_index([bam.sample], {ref: r.length for ref, r in bam.references.items()})
+
+        store = CoverageStore(self.tmp_dir)
+        self.assertEqual(store.samples, ['test'])
+        self.assertEqual(list(store.references), bam.get_reference_names())
+        ref = bam['refGenome1clus']
+        depth = store.depth('test', 'refGenome1clus')
+        self.assertEqual(len(depth), ref.length)
+        self.assertEqual({pos + 1: int(depth[pos]) for pos in np.flatnonzero(depth)},
+                         {pos: cov for pos, cov in ref.pos2cov.items() if cov})
+        self.assertAlmostEqual(store.breadth('refGenome1clus')[0], ref.coverage_breadth(1))
+
+    def test_regions(self):
+        for compression in ['zlib', 'none']:
+            references = {'a': BAMReference('s1', 'a', 25), 'b': BAMReference('s1', 'b', 7)}
+            for pos in range(3, 22):
+                references['a'].add_coverage(pos, pos * 3)
+            writer = CoverageStoreWriter(self.tmp_dir, chunk_size=4, compression=compression)
+            writer.write_sample('s1', references)
+            # a sample without any coverage
+            writer.write_sample('s2', {'a': BAMReference('s2', 'a', 25), 'b': BAMReference('s2', 'b', 7)})
+            writer.write_index(['s1', 's2'], {'a': 25, 'b': 7})
+
+            store = CoverageStore(self.tmp_dir)
+            expected = np.array([(pos + 1) * 3 if 3 <= pos + 1 < 22 else 0 for pos in range(25)])
+            for start, end in [(0, 25), (5, 6), (2, 19), (10, 10), (24, 25)]:
+                np.testing.assert_array_equal(store.region('a', start, end),
+                                              [expected[start:end], np.zeros(end - start)])
+            np.testing.assert_array_equal(store.breadth('a', min_depth=30), [12 / 25, 0])
+            np.testing.assert_array_equal(store.depth('s1', 'b'), np.zeros(7))
+            with self.assertRaises(ValueError):
+                store.depth('s1', 'a', 20, 26)
+            with self.assertRaises(KeyError):
+                store.depth('s3', 'a')
@@ -0,0 +1,121 @@
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from metaSNV.positions import write_positions
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metaSNV_DistDiv.py')
+SPECIES = ['sp1', 'sp2']
+GENOME_LENGTH = 5000
+
+
+def write_project(project_dir, samples, seed=0):
+    """
+    Coverage tables, bed_header and filtered frequencies of a project, as
+    written by metaSNV.py and metaSNV_Filtering.py. The values of a sample
+    do not depend on the other samples.
+    """
+    name = os.path.basename(project_dir)
+    os.makedirs(os.path.join(project_dir, 'filtered', 'pop'), exist_ok=True)
+    with open(os.path.join(project_dir, 'bed_header'), 'w') as f:
+        for species in SPECIES:
+            f.write('{}\t0\t{}\n'.format(species, GENOME_LENGTH))
+    for suffix, kind, values in [('all_cov', 'Average_cov', 20.), ('all_perc', 'Percentage_1', 90.)]:
+        with open(os.path.join(project_dir, '{}.{}.tab'.format(name, suffix)), 'w') as f:
+            f.write('\t' + '\t'.join(samples) + '\n')
+            f.write('TaxId' + '\t{}'.format(kind) * len(samples) + '\n')
+            for k, species in enumerate(SPECIES):
+                f.write(species + ''.join('\t{}'.format(values + k + int(sample[1:])) for sample in samples) + '\n')
+    for k, species in enumerate(SPECIES):
+        labels = ['{}:-:{}:A>{}:.'.format(species, pos, alt) for pos in range(10, GENOME_LENGTH, 7)
+                  for alt in ('C', 'G')[:1 + pos % 2]]
+        columns = {}
+        for sample in samples:
+            rng = np.random.default_rng([seed, k, int(sample[1:])])
+            freq = rng.random(len(labels)).round(3)
+            freq[rng.random(len(labels)) < .1] = -1
+            columns[sample] = freq
+        filepath = os.path.join(project_dir, 'filtered', 'pop', '{}.filtered.freq'.format(species))
+        pd.DataFrame(columns, index=labels).to_csv(filepath, sep='\t')
+        write_positions(filepath, labels)
+
+
+def run_distdiv(project_dir, *options):
+    return subprocess.run([sys.executable, SCRIPT, '--filt', os.path.join(project_dir, 'filtered', 'pop'),
+                           '--dist', '--div'] + list(options),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True).stdout
+
+
+def read_table(filepath):
+    return pd.read_table(filepath, index_col=0)
+
+
+class TestDistDiv(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def outputs(self, project_dir, folder='distances'):
+        return sorted(os.path.basename(f) for f in glob.glob(os.path.join(project_dir, folder, '*')))
+
+    def test_incremental(self):
+        project_dir = os.path.join(self.tmp_dir, 'proj')
+        write_project(project_dir, ['s1', 's2', 's3'])
+        self.assertIn('sp1.filtered: no previous results, computing all samples',
+                      run_distdiv(project_dir, '--incremental'))
+
+        # a sample is added, the samples of the previous run are reused
+        write_project(project_dir, ['s1', 's2', 's3', 's4'])
+        out = run_distdiv(project_dir, '--incremental')
+        for species in SPECIES:
+            self.assertIn('{}.filtered: 1 new samples, reusing 3'.format(species), out)
+            self.assertIn('{}: 1 new samples, reusing 3'.format(species), out)
+
+        full_dir = os.path.join(self.tmp_dir, 'full')
+        write_project(full_dir, ['s1', 's2', 's3', 's4'])
+        run_distdiv(full_dir)
+        self.assertEqual(self.outputs(project_dir), self.outputs(full_dir))
+        for filename in self.outputs(full_dir):
+            incremental = read_table(os.path.join(project_dir, 'distances', filename))
+            full = read_table(os.path.join(full_dir, 'distances', filename))
+            self.assertEqual(list(incremental.index), ['s1', 's2', 's3', 's4'])
+            pd.testing.assert_frame_equal(incremental, full, check_exact=False, rtol=1e-12)
+
+        # changed frequencies of an existing sample are recomputed
+        write_project(project_dir, ['s1', 's2', 's3', 's4'], seed=1)
+        self.assertIn('sp1.filtered: positions or frequencies of existing samples changed, computing all samples',
+                      run_distdiv(project_dir, '--incremental'))
+
+    def test_approx(self):
+        project_dir = os.path.join(self.tmp_dir, 'proj')
+        write_project(project_dir, ['s1', 's2', 's3', 's4'])
+        run_distdiv(project_dir)
+        out = run_distdiv(project_dir, '--approx', '--approx_start', '100', '--approx_width', '0.3',
+                          '--approx_level', '0.999', '--seed', '0')
+        # distances are estimated on a subset of the positions
+        used = re.search(r'sp1.filtered: distances estimated on (\d+) of 1069 positions', out)
+        self.assertLess(int(used.group(1)), 1069)
+
+        exact_files = self.outputs(project_dir)
+        self.assertEqual(self.outputs(project_dir, 'distances.approx'),
+                         sorted(filename + suffix for filename in exact_files for suffix in ['', '.lower', '.upper']))
+        for filename in exact_files:
+            exact = read_table(os.path.join(project_dir, 'distances', filename))
+            estimate, lower, upper = (read_table(os.path.join(project_dir, 'distances.approx', filename + suffix))
+                                      for suffix in ['', '.lower', '.upper'])
+            for table in [estimate, lower, upper]:
+                self.assertEqual(list(table.index), list(exact.index))
+                self.assertEqual(list(table.columns), list(exact.columns))
+            covered = exact.notna().to_numpy()
+            exact, lower, upper = (table.to_numpy()[covered] for table in [exact, lower, upper])
+            self.assertTrue(np.all((lower <= exact) & (exact <= upper)), filename)
@@ -0,0 +1,92 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+from metaSNV.estimate import STAGES, bam_size, calibrate, estimate, makespan, peak_memory, recommend_workers, \
+    snv_size, task_memory, taxon_shares, write_report, WORKER_MEMORY
+from metaSNV.profiling import profiled, read_tasks
+
+
+def computeDiv(filt_file):
+    return filt_file
+
+
+def freq(filt_file):
+    return {'rows': 1000, 'samples': 10}
+
+
+class TestEstimate(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_makespan(self):
+        self.assertEqual(makespan([4, 1, 1, 1, 1], 2), 4)
+        self.assertEqual(makespan([1, 1, 1, 4], 2), 5)
+        self.assertEqual(makespan([], 4), 0)
+
+    def test_recommend_workers(self):
+        footprints = [4 * 2 ** 30, 2 ** 30, 2 ** 30]
+        self.assertEqual(peak_memory(footprints, 2), 5 * 2 ** 30 + 2 * WORKER_MEMORY)
+        self.assertEqual(recommend_workers(footprints, 8, 16 * 2 ** 30), 3)
+        self.assertEqual(recommend_workers(footprints, 8, 5.5 * 2 ** 30), 2)
+        self.assertEqual(recommend_workers(footprints, 8, 2 ** 30), 1)
+
+    def test_calibrate(self):
+        with Pool(2) as p:
+            p.map(profiled(computeDiv, self.tmp_dir, memory=True, measure=freq), ['a', 'b'])
+        tasks = read_tasks(self.tmp_dir)
+        self.assertEqual([size for _, _, _, size in tasks], [{'rows': 1000, 'samples': 10}] * 2)
+        rates = calibrate([self.tmp_dir])
+        wall = sum(task[1] for task in tasks)
+        self.assertAlmostEqual(rates['diversity'][0], wall / (2 * 1000 * 10 ** 2))
+        self.assertEqual(rates['distances'], (STAGES['distances'].seconds, STAGES['distances'].bytes))
+
+    def test_filtering_memory(self):
+        shares = taxon_shares({'t1.c1': 300, 't1.c2': 100, 't2': 600})
+        self.assertEqual(shares, {'t1': .4, 't2': .6})
+        snp_file = os.path.join(self.tmp_dir, 'called_SNPs')
+        with open(snp_file, 'w') as f:
+            f.write('x' * 1000)
+        self.assertEqual(snv_size([snp_file], 't1', shares), {'bytes': 1000, 'taxon_bytes': 400})
+        # memory grows with the share of the taxon, all calls if unknown
+        self.assertLess(task_memory('filtering', snv_size([snp_file], 't1', shares)),
+                        task_memory('filtering', snv_size([snp_file], 't2', shares)))
+        self.assertEqual(task_memory('filtering', snv_size([snp_file])),
+                         task_memory('filtering', {'bytes': 1000}))
+        self.assertGreater(task_memory('filtering', {'bytes': 1000}), WORKER_MEMORY)
+
+    def test_estimate(self):
+        estimates, taxa = estimate(self.tmp_dir, 'tests/data', cores=4, memory=16 * 2 ** 30)
+        self.assertEqual([e.stage for e in estimates], list(STAGES))
+        coverage = estimates[0]
+        # a single, unindexed BAM file
+        self.assertEqual((coverage.tasks, coverage.workers), (1, 1))
+        self.assertEqual(len(taxa), 3)
+        self.assertTrue(all(samples == 1 for _, samples, *_ in taxa))
+        out = io.StringIO()
+        write_report(estimates, taxa, out)
+        self.assertIn('--n_threads 3', out.getvalue())
+        self.assertEqual(bam_size('tests/data/test.bam')['bases'], 300000)
+
+    def test_calling_splits(self):
+        estimates, _ = estimate(self.tmp_dir, 'tests/data', cores=4, memory=16 * 2 ** 30)
+        calling = estimates[1]
+        self.assertEqual((calling.stage, calling.tasks, calling.option), ('calling', 4, 'plan --n_splits 4'))
+        split_memory = task_memory('calling', {'bytes': 0, 'bases': 0, 'files': 1, 'genome': 300000})
+        self.assertEqual(calling.memory, 4 * split_memory)
+        # fewer splits fit into a small memory budget
+        estimates, _ = estimate(self.tmp_dir, 'tests/data', cores=4, memory=2.5 * split_memory)
+        calling = estimates[1]
+        self.assertEqual((calling.tasks, calling.option), (2, 'plan --n_splits 2'))
+        self.assertLessEqual(calling.memory, 2.5 * split_memory)
+        self.assertIn('2 splits fit into memory', calling.note)
+        # every split reads the whole unindexed BAM file, more splits are slowed down by the reads
+        estimates, _ = estimate(self.tmp_dir, 'tests/data', cores=16, memory=16 * 2 ** 30)
+        self.assertLess(estimates[1].tasks, 16)
+        self.assertIn('limited by reading the BAM files', estimates[1].note)
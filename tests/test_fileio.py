@@ -0,0 +1,90 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from metaSNV import fileio
+from metaSNV.fileio import (open_file, find_file, glob_compressed, with_compression,
+                            strip_compression, compression_of, CompressingFifo)
+
+
+class TestFileIO(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.lines = ['ref{}\t-\t{}\tA\t1|2|3\t2|C|.|1|1|0\n'.format(i % 7, i) for i in range(20000)]
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmpdir)
+
+    def roundtrip(self, compression):
+        filepath = with_compression(os.path.join(self.tmpdir, 'called_SNPs'), compression)
+        with open_file(filepath, 'wt') as f:
+            for line in self.lines:
+                f.write(line)
+        with open_file(filepath, 'rt') as f:
+            self.assertEqual(f.readlines(), self.lines)
+        return filepath
+
+    def test_paths(self):
+        self.assertEqual(compression_of('a.freq.gz'), 'gzip')
+        self.assertEqual(compression_of('a.freq.zst'), 'zstd')
+        self.assertEqual(compression_of('a.freq'), 'none')
+        self.assertEqual(strip_compression('a.freq.gz'), 'a.freq')
+        self.assertEqual(strip_compression('a.freq'), 'a.freq')
+
+    def test_plain(self):
+        filepath = self.roundtrip('none')
+        with open(filepath) as f:
+            self.assertEqual(f.readlines(), self.lines)
+
+    def test_gzip(self):
+        # several independently compressed blocks
+        fileio.BLOCK_SIZE, block_size = 64 * 1024, fileio.BLOCK_SIZE
+        try:
+            filepath = self.roundtrip('gzip')
+        finally:
+            fileio.BLOCK_SIZE = block_size
+        with gzip.open(filepath, 'rt') as f:
+            self.assertEqual(f.readlines(), self.lines)
+
+    @unittest.skipIf(isinstance(fileio.zstandard, ImportError), "zstandard not installed")
+    def test_zstd(self):
+        self.roundtrip('zstd')
+
+    def test_find_file(self):
+        base = os.path.join(self.tmpdir, 'called_SNPs')
+        self.assertIsNone(find_file(base))
+        filepath = self.roundtrip('gzip')
+        self.assertEqual(find_file(base), filepath)
+        self.assertEqual(glob_compressed(os.path.join(self.tmpdir, 'called*')), [filepath])
+
+    def test_compressing_fifo(self):
+        filepath = os.path.join(self.tmpdir, 'indiv_called.gz')
+        with CompressingFifo(filepath) as fifo:
+            with open(fifo.path, 'w') as f:
+                f.writelines(self.lines)
+        with gzip.open(filepath, 'rt') as f:
+            self.assertEqual(f.readlines(), self.lines)
+
+        # the writer never opens the pipe
+        with CompressingFifo(filepath):
+            pass
+        with gzip.open(filepath, 'rt') as f:
+            self.assertEqual(f.read(), '')
+        self.assertGreater(os.path.getsize(filepath), 0)
+
+    def test_compressing_fifo_error(self):
+        filepath = os.path.join(self.tmpdir, 'missing', 'indiv_called.gz')
+        with self.assertRaises(FileNotFoundError):
+            with CompressingFifo(filepath) as fifo:
+                # like a subprocess writing to the pipe, which fails once the thread is gone
+                try:
+                    with open(fifo.path, 'w') as f:
+                        f.writelines(self.lines)
+                except BrokenPipeError:
+                    pass
+        # errors of the block are not replaced by those of the thread
+        with self.assertRaises(KeyError):
+            with CompressingFifo(filepath):
+                raise KeyError()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from metaSNV.bam_preprocessing import BAMInfo, read_legacy, write_legacy
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metaSNV_Filtering.py')
+
+
+class TestFiltering(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tmp_dir, 'proj')
+        os.makedirs(os.path.join(self.project_dir, 'snpCaller'))
+        bam_info = BAMInfo.from_bam('tests/data/test.bam')
+        self.perc_file = os.path.join(self.project_dir, 'proj.all_perc.tab')
+        write_legacy({'s1': bam_info, 's2': bam_info}, os.path.join(self.project_dir, 'proj.all_cov.tab'), 'depth')
+        write_legacy({'s1': bam_info, 's2': bam_info}, self.perc_file, 'breadth')
+        # all_samples lists the BAM files, the coverage tables their sample names
+        with open(os.path.join(self.project_dir, 'all_samples'), 'w') as f:
+            f.write('/data/s1.bam\n/data/s2.bam\n')
+        with open(os.path.join(self.project_dir, 'snpCaller', 'called_SNPs'), 'w') as f:
+            f.write('refGenome1clus\t-\t10\tA\t20|10\t8|C|.|6|2\n'
+                    'refGenome1clus\t-\t20\tG\t12|16\t7|T|.|3|4\n'
+                    'refGenome2clus\t-\t30\tC\t9|11\t5|A|.|1|4\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def filtered(self):
+        subprocess.run([sys.executable, SCRIPT, self.project_dir], stdout=subprocess.DEVNULL, check=True)
+        pop_dir = os.path.join(self.project_dir, 'filtered', 'pop')
+        filtered = {}
+        for filename in sorted(os.listdir(pop_dir)):
+            if filename.endswith('.freq'):
+                with open(os.path.join(pop_dir, filename)) as f:
+                    filtered[filename] = f.read()
+        return filtered
+
+    def test_breadth_percentage(self):
+        # breadth is written as a percentage of the reference covered, the unit of -b
+        self.assertEqual(read_legacy(self.perc_file)['s1']['refGenome1clus'], '99.938')
+        self.assertEqual(self.filtered(), {
+            'refGenome1clus.filtered.freq': '\ts1\ts2\nrefGenome1clus:-:10:A>C:.\t0.3\t0.2\n'
+                                            'refGenome1clus:-:20:G>T:.\t0.25\t0.25\n',
+            'refGenome2clus.filtered.freq': '\ts1\ts2\n'
+                                            'refGenome2clus:-:30:C>A:.\t0.1111111111111111\t0.36363636363636365\n'})
+
+    def test_breadth_fraction(self):
+        # tables with the breadth as a fraction (as written before) pass no taxon at the default -b 40
+        with open(self.perc_file) as f:
+            lines = f.read().replace('99.938', '0.99938').replace('99.946', '0.99946').replace('99.98', '0.9998')
+        with open(self.perc_file, 'w') as f:
+            f.write(lines)
+        self.assertEqual(self.filtered(), {})
@@ -0,0 +1,57 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from metaSNV.gff2metaSNV_annotation import read_gff, gff_to_annotation, convert
+
+
+class TestGFFConversion(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gff = 'tests/data/test.gff'
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_gff(self):
+        gff_data = read_gff(self.gff)
+        self.assertEqual(len(gff_data), 4)
+        self.assertEqual(list(gff_data['start']), [10, 5, 400, 200])
+        # read in chunks, the last one empty
+        for chunk_records in [1, 2, 3]:
+            pd.testing.assert_frame_equal(read_gff(self.gff, chunk_records=chunk_records), gff_data)
+        self.assertEqual(len(read_gff(self.gff, feature_type='missing')), 0)
+
+    def test_annotation(self):
+        annotation = gff_to_annotation(read_gff(self.gff))
+        self.assertEqual(list(annotation['sequence_id']),
+                         ['contigA', 'contigA', 'contigB', 'contigB'])
+        self.assertEqual(list(annotation['external_id']),
+                         ['contigA.1', 'contigA.2', 'contigB.1', 'contigB.2'])
+        self.assertEqual(list(annotation['gene_id']), [1, 2, 3, 4])
+        self.assertEqual(list(annotation['length']), [291, 601, 91, 301])
+        self.assertEqual(annotation.loc[2, 'gene_info'], '<annotation ID=cds2>')
+
+    def test_contig_keys(self):
+        annotation = gff_to_annotation(read_gff(self.gff), {'contigA': 'a', 'contigB': 'b'})
+        self.assertEqual(list(annotation['external_id']), ['a.1', 'a.2', 'b.1', 'b.2'])
+        with self.assertRaises(ValueError):
+            gff_to_annotation(read_gff(self.gff), {'contigA': 'a'})
+
+    def test_convert_gzipped(self):
+        gzipped = os.path.join(self.tmpdir, 'test.gff.gz')
+        with open(self.gff, 'rb') as src, gzip.open(gzipped, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        output = os.path.join(self.tmpdir, 'annotation.txt')
+        convert([self.gff, gzipped], output, threads=2)
+        with open(output) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0].split('\t')[:3], ['gene_id', 'external_id', 'sequence_id'])
+        self.assertEqual(len(lines), 9)
+        fields = lines[1].split('\t')
+        self.assertEqual(fields[1:3] + fields[6:9], ['contigA.1', 'contigA', '10', '300', '+'])
+        self.assertEqual(lines[-1].split('\t')[1], 'contigB.4')
@@ -0,0 +1,149 @@
+import unittest
+import warnings
+
+import numpy as np
+
+from metaSNV.bam_preprocessing import BAMReference
+from metaSNV.kernels import python
+
+try:
+    from metaSNV.kernels import _compiled
+except ImportError:
+    _compiled = None
+
+LINE = 'ref1\tgene1\t33\tT\t4|0|6\t7|G|N[ACT-AGT]|3|0|4,2|C|.|0|0|2\n'
+PILEUP_LINE = 'ref1\t33\tT\t3\t.,G\tIJK\tg1,g2,g1\t0\t*\t*\t*\t2\tA.\tFG\t*,*\n'
+PILEUP_FILES = [{'g1': 0, 'g2': 1}, 2, 2]
+SAMPLE_PILEUP = 'ref1\t33\tT\t2\t.G\tIK\t0\t*\t*\t13\t.............\tIIIIIIIIIIIII\n'
+
+
+def random_frequencies(rng, shape, dtype):
+    values = rng.random(shape).astype(dtype)
+    values[rng.random(shape) < 0.2] = np.nan
+    return values
+
+
+class TestPythonKernels(unittest.TestCase):
+    def test_parse_snv_line(self):
+        site_coverage, alleles = python.parse_snv_line(LINE)
+        self.assertEqual(site_coverage, [4, 0, 6])
+        self.assertEqual(alleles, [('G', 'N[ACT-AGT]', [3, 0, 4]), ('C', '.', [0, 0, 2])])
+
+    def test_allele_frequencies(self):
+        site_coverage, alleles = python.parse_snv_line(LINE)
+        self.assertEqual(python.count_covered(site_coverage, [0, 1, 2], 5.0), 1)
+        self.assertEqual(python.allele_frequencies(alleles[0][2], site_coverage, [0, 1, 2], 1.0),
+                         [0.75, -1, 4 / 6])
+
+    def test_accumulate_depth(self):
+        references = {'a': BAMReference('s', 'a', 10), 'b': BAMReference('s', 'b', 10)}
+        python.accumulate_depth('a\t1\t3\na\t2\t0\nb\t1\t12\n', references)
+        self.assertEqual(references['a'].pos2cov, {1: 3, 2: 0})
+        self.assertEqual(references['b'].pos2cov, {1: 12})
+
+    def test_accumulate_pileup(self):
+        totals = {}
+        python.accumulate_pileup(SAMPLE_PILEUP, totals, 3)
+        python.accumulate_pileup(SAMPLE_PILEUP.replace('\t33\t', '\t34\t'), totals, 3)
+        self.assertEqual(totals['ref1'].tolist(), [[4, 0, 26], [2, 0, 2]])
+
+    def test_split_read_groups(self):
+        self.assertEqual(python.split_read_groups(PILEUP_LINE, PILEUP_FILES, 3),
+                         'ref1\t33\tT\t2\t.G\tIK\t1\t,\tJ\t2\tA.\tFG\n')
+        self.assertEqual(python.split_read_groups(PILEUP_LINE, [{'g2': 0}, 1, 1], 2),
+                         'ref1\t33\tT\t1\t,\tJ\t2\tA.\tFG\n')
+
+
+@unittest.skipIf(_compiled is None, "compiled kernels not built")
+class TestCompiledKernels(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(42)
+
+    def test_parse_snv_line(self):
+        self.assertEqual(_compiled.parse_snv_line(LINE), python.parse_snv_line(LINE))
+        with self.assertRaises(ValueError):
+            _compiled.parse_snv_line('ref1\tgene1\t33\n')
+
+    def test_allele_frequencies(self):
+        site_coverage, alleles = python.parse_snv_line(LINE)
+        for min_cov in [0.0, 1.0, 5.0]:
+            self.assertEqual(_compiled.count_covered(site_coverage, [2, 0, 1], min_cov),
+                             python.count_covered(site_coverage, [2, 0, 1], min_cov))
+            self.assertEqual(_compiled.allele_frequencies(alleles[0][2], site_coverage, [2, 0, 1], min_cov),
+                             python.allele_frequencies(alleles[0][2], site_coverage, [2, 0, 1], min_cov))
+
+    def test_accumulate_depth(self):
+        text = 'a\t1\t3\na\t2\t0\nb\t1\t12\nab\t7\t1\n'
+        results = []
+        for kernels in (python, _compiled):
+            references = {ref: BAMReference('s', ref, 10) for ref in ['a', 'b', 'ab']}
+            kernels.accumulate_depth(text, references)
+            results.append({ref: r.pos2cov for ref, r in references.items()})
+        self.assertEqual(results[0], results[1])
+
+    def test_accumulate_pileup(self):
+        results = []
+        for kernels in (python, _compiled):
+            totals = {}
+            for line in [SAMPLE_PILEUP, SAMPLE_PILEUP.replace('ref1', 'ref2'), SAMPLE_PILEUP]:
+                kernels.accumulate_pileup(line, totals, 3)
+            results.append({ref: total.tolist() for ref, total in totals.items()})
+        self.assertEqual(results[0], results[1])
+
+    def test_merge_pileup_lines(self):
+        lines = [PILEUP_LINE, None, 'ref1\t33\tT\t1\tA\tF\tg2\n']
+        batches = [PILEUP_FILES, [0], [{'g2': 2}]]
+        self.assertEqual(_compiled.merge_pileup_lines(lines, batches, 3, 4),
+                         python.merge_pileup_lines(lines, batches, 3, 4))
+
+    def test_split_read_groups(self):
+        self.assertEqual(_compiled.split_read_groups(PILEUP_LINE, PILEUP_FILES, 3),
+                         python.split_read_groups(PILEUP_LINE, PILEUP_FILES, 3))
+        self.assertEqual(_compiled.split_read_groups(PILEUP_LINE, [{'g3': 0}, 1, 1], 2),
+                         python.split_read_groups(PILEUP_LINE, [{'g3': 0}, 1, 1], 2))
+
+    def test_pairwise_distances(self):
+        for dtype in [np.float64, np.float32]:
+            for length in [0, 5, 300, 20000]:
+                values = random_frequencies(self.rng, (4, length), dtype)
+                values[0] = np.nan
+                # pandas hands out read-only arrays
+                values.setflags(write=False)
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    expected = python.pairwise_distances(values)
+                got = _compiled.pairwise_distances(values)
+                for e, g in zip(expected, got):
+                    np.testing.assert_array_equal(e, g)
+
+    def test_cross_distances(self):
+        for dtype in [np.float64, np.float32]:
+            values = random_frequencies(self.rng, (5, 300), dtype)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                expected = python.pairwise_distances(values)
+                got_python = python.cross_distances(values[[1, 4]], values)
+            got = _compiled.cross_distances(values[[1, 4]], values)
+            for e, g_py, g in zip(expected, got_python, got):
+                np.testing.assert_array_equal(e[[1, 4]], g_py)
+                np.testing.assert_array_equal(e[[1, 4]], g)
+                # symmetric, so that new samples can be filled into rows and columns alike
+                np.testing.assert_array_equal(e[:, [1, 4]], g.T)
+
+    def test_pair_diversity(self):
+        for dtype in [np.float64, np.float32]:
+            for n_positions in [1, 50, 3000]:
+                for alleles in [[1], [1, 1, 1, 2, 3]]:
+                    runs = self.rng.choice(alleles, size=n_positions).astype(np.intp)
+                    values = random_frequencies(self.rng, (2, runs.sum()), dtype)
+                    self.assertEqual(_compiled.pair_diversity(values[0], values[1], runs),
+                                     python.pair_diversity(values[0], values[1], runs))
+
+    def test_position_diversity(self):
+        for dtype in [np.float64, np.float32]:
+            runs = self.rng.choice([1, 1, 1, 2, 3], size=500).astype(np.intp)
+            values = random_frequencies(self.rng, (2, runs.sum()), dtype)
+            contributions = _compiled.position_diversity(values[0], values[1], runs)
+            np.testing.assert_array_equal(contributions, python.position_diversity(values[0], values[1], runs))
+            self.assertAlmostEqual(contributions.sum(), _compiled.pair_diversity(values[0], values[1], runs),
+                                   places=4 if dtype == np.float32 else 10)
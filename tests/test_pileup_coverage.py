@@ -0,0 +1,30 @@
+import io
+import unittest
+
+from metaSNV.pileup_coverage import PileupCoverage, relay_pileup
+
+PILEUP = ('a\t1\tT\t2\t.G\tIK\t0\t*\t*\n'
+          'a\t2\tT\t4\t..,,\tIIII\t1\t.\tI\n'
+          'b\t7\tT\t0\t*\t*\t3\t...\tIII\n')
+
+
+class TestPileupCoverage(unittest.TestCase):
+    def test_relay(self):
+        coverage = PileupCoverage(2)
+        dst = io.BytesIO()
+        dst.close = lambda: None
+        relay_pileup(io.BytesIO(PILEUP.encode()), dst, coverage)
+        self.assertEqual(dst.getvalue().decode(), PILEUP)
+        lengths = {'a': 4, 'b': 10, 'c': 5}
+        self.assertEqual(coverage.legacy_values(0, lengths, 'depth'), {'a': '1.5', 'b': '0.0', 'c': '0.0'})
+        self.assertEqual(coverage.legacy_values(1, lengths, 'breadth'), {'a': '25.0', 'b': '10.0', 'c': '0.0'})
+        with self.assertRaises(ValueError):
+            coverage.legacy_values(0, lengths, 'invalid')
+
+    def test_read_groups(self):
+        coverage = PileupCoverage(2)
+        dst = io.BytesIO()
+        dst.close = lambda: None
+        relay_pileup(io.BytesIO(b'a\t1\tT\t3\t.G,\tIJK\tg1,g2,g1\n'), dst, coverage, ([{'g1': 0, 'g2': 1}], 2))
+        self.assertEqual(dst.getvalue().decode(), 'a\t1\tT\t2\t.,\tIK\t1\tG\tJ\n')
+        self.assertEqual(coverage.totals['a'].tolist(), [[2, 1], [1, 1]])
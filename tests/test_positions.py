@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metaSNV.positions import PositionsEncoder, encode_positions, gene_strata, labels_digest, positions_path, \
+    read_positions, site_keys, write_positions
+
+LABELS = ['c1:g1:100:A>C:N[AAA-ACA]', 'c1:g1:20:A>G:S[AAA-AAG]', 'c1:g12:7:T>C:.',
+          'c10:-:5:G>T:.', 'c1:g1:100:A>T:S[AAA-ATA]', 'c1:g1:3:C>A:N[CAA-AAA]']
+
+
+class TestPositions(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_encode_positions(self):
+        positions = encode_positions(LABELS)
+        self.assertEqual(list(positions.contigs[positions.contig]), ['c1', 'c1', 'c1', 'c10', 'c1', 'c1'])
+        self.assertEqual(list(positions.genes[positions.gene]), ['g1', 'g1', 'g12', '-', 'g1', 'g1'])
+        np.testing.assert_array_equal(positions.position, [100, 20, 7, 5, 100, 3])
+        self.assertEqual(bytes(positions.ref).decode(), 'AATGAC')
+        self.assertEqual(bytes(positions.alt).decode(), 'CGCTTA')
+        self.assertEqual(bytes(positions.synonymity).decode(), 'NS..SN')
+
+    def test_site_keys(self):
+        keys = site_keys(encode_positions(LABELS))
+        sites = [':'.join(label.split(':')[:3]) for label in LABELS]
+        # same order as the labels sorted as strings, one key per site
+        self.assertEqual([sites[k] for k in np.argsort(keys, kind='stable')], sorted(sites))
+        self.assertEqual(len(set(keys)), len(set(sites)))
+        self.assertEqual(keys[0], keys[4])
+
+    def test_gene_strata(self):
+        strata = gene_strata(encode_positions(LABELS))
+        names = [':'.join(label.split(':')[:2]) for label in LABELS]
+        self.assertEqual([sorted(set(names))[k] for k in strata], names)
+
+    def test_read_positions(self):
+        freq = os.path.join(self.tmp_dir, 'sp.filtered.freq.gz')
+        self.assertEqual(positions_path(freq), os.path.join(self.tmp_dir, 'sp.filtered.pos.npz'))
+        write_positions(freq, LABELS)
+        expected = encode_positions(LABELS)
+        self.assertEqual(read_positions(freq, LABELS).digest(), expected.digest())
+        # positions are parsed again if the table no longer matches
+        self.assertEqual(read_positions(freq, LABELS[:3]).digest(), encode_positions(LABELS[:3]).digest())
+
+    def test_encoder(self):
+        for labels in [LABELS, LABELS[:1], []]:
+            encoder = PositionsEncoder()
+            for label in labels:
+                encoder.add(label)
+            self.assertEqual(len(encoder), len(labels))
+            expected = encode_positions(labels)
+            positions = encoder.positions()
+            for field in positions._fields:
+                np.testing.assert_array_equal(getattr(positions, field), getattr(expected, field))
+                self.assertEqual(getattr(positions, field).dtype, getattr(expected, field).dtype, field)
+            # same file as write_positions of the labels
+            freq = os.path.join(self.tmp_dir, 'sp.filtered.freq')
+            encoder.write(freq)
+            self.assertEqual(read_positions(freq, labels).digest(), expected.digest())
+            with np.load(positions_path(freq)) as stored:
+                self.assertEqual(str(stored['labels']), labels_digest(labels))
@@ -0,0 +1,40 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from multiprocessing import Pool
+
+from metaSNV.profiling import profiled, summarize, task_name
+
+
+def allocate(n, scale=1):
+    return len([k * scale for k in range(n)])
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        self.assertIs(profiled(allocate, None), allocate)
+
+    def test_task_name(self):
+        self.assertEqual(task_name(partial(partial(allocate, scale=2))), 'allocate')
+
+    def test_profile_workers(self):
+        with Pool(2) as p:
+            results = p.map(profiled(partial(allocate, scale=2), self.tmp_dir, memory=True), [10, 1000, 100000])
+        self.assertEqual(results, [10, 1000, 100000])
+        for suffix in ['prof', 'mem', 'task']:
+            self.assertEqual(len(glob.glob(os.path.join(self.tmp_dir, 'allocate.*.' + suffix))), 3)
+
+        with open(summarize(self.tmp_dir)) as f:
+            summary = f.read()
+        self.assertRegex(summary, r'allocate\s+3 ')
+        self.assertIn('Hottest functions by tottime (3 tasks)', summary)
+        self.assertIn('Largest allocation sites', summary)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from metaSNV.pruning import samples_of_interest, calling_groups, pad_line
+
+SNPCALL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metaSNV', 'snpCaller', 'snpCall')
+
+
+class TestPruning(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cov_file = os.path.join(self.tmp_dir, 'p.all_cov.tab')
+        self.perc_file = os.path.join(self.tmp_dir, 'p.all_perc.tab')
+        with open(self.cov_file, 'w') as f:
+            f.write('\ts1\ts2\ts3\n'
+                    'TaxId\tAverage_cov\tAverage_cov\tAverage_cov\n'
+                    'g1\t10.0\t10.0\t1.0\n'
+                    'g2\t10.0\t0.0\t10.0\n'
+                    'g3\t0.0\t0.0\t10.0\n')
+        with open(self.perc_file, 'w') as f:
+            f.write('\ts1\ts2\ts3\n'
+                    'TaxId\tPercentage_1\tPercentage_1\tPercentage_1\n'
+                    'g1\t90.0\t30.0\t90.0\n'
+                    'g2\t90.0\t0.0\t90.0\n'
+                    'g3\t0.0\t0.0\t90.0\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_samples_of_interest(self):
+        soi, header = samples_of_interest(self.cov_file, self.perc_file, 40.0, 5.0, 1)
+        self.assertEqual(header, ['s1', 's2', 's3'])
+        self.assertEqual(soi, {'g1': ['s1'], 'g2': ['s1', 's3'], 'g3': ['s3']})
+        soi, _ = samples_of_interest(self.cov_file, self.perc_file, 40.0, 5.0, 2)
+        self.assertEqual(soi, {'g2': ['s1', 's3']})
+
+    def test_calling_groups(self):
+        soi = {'g1': ['s1'], 'g2': ['s1', 's3'], 'g3': ['s1']}
+        regions = [('g1.c1', 10), ('g1.c2', 20), ('g2', 30), ('g3', 40), ('g4', 50)]
+        self.assertEqual(calling_groups(regions, soi),
+                         [(['s1'], [('g1.c1', 10), ('g1.c2', 20), ('g3', 40)]),
+                          (['s1', 's3'], [('g2', 30)])])
+
+    def test_pad_line(self):
+        line = 'g2\t-\t33\tT\t4|6\t7|G|.|3|4,2|C|.|0|2\n'
+        self.assertEqual(pad_line(line, [0, 2], 3),
+                         'g2\t-\t33\tT\t4|0|6\t7|G|.|3|0|4,2|C|.|0|0|2\n')
+
+    @unittest.skipUnless(os.path.isfile(SNPCALL), 'snpCall is not built')
+    def test_pruned_calls(self):
+        ref_db = os.path.join(self.tmp_dir, 'ref.fasta')
+        with open(ref_db, 'w') as f:
+            f.write('>c1\n' + 'A' * 100 + '\n')
+        # the SNV at 10 reaches -t 4 only with the reads of s2, the one at 20 with those of s1 alone
+        samples = {10: [('..CC', 'IIII'), ('CCCC', 'IIII')], 20: [('CCCCC', 'IIIII'), ('.', 'I')]}
+
+        def call(columns):
+            # snpCall identifies the samples on the first line
+            lines = ['c1\t5\tA' + '\t4\t....\tIIII' * len(columns)]
+            for pos, pileups in samples.items():
+                lines.append('c1\t{}\tA'.format(pos) + ''.join(
+                    '\t{}\t{}\t{}'.format(len(pileups[k][0]), *pileups[k]) for k in columns))
+            return subprocess.run([SNPCALL, '-f', ref_db, '-c', '4', '-t', '4'], input='\n'.join(lines) + '\n',
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout
+
+        self.assertEqual([line.split('\t')[2] for line in call([0, 1]).splitlines()], ['10', '20'])
+        # calling s1 alone (as --prefilter does if s2 does not qualify) drops the position that depended on s2
+        pruned = [pad_line(line + '\n', [0], 2) for line in call([0]).splitlines()]
+        self.assertEqual(pruned, ['c1\t-\t20\tA\t5|0\t5|C|.|5|0\n'])
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from metaSNV.fileio import open_file
+from metaSNV.positions import positions_path
+from metaSNV.query import FilteredFrequencies, rows_path
+
+LABELS = ['c1:g1:3:C>A:N[CAA-AAA]', 'c1:g1:20:A>G:S[AAA-AAG]', 'c1:g1:100:A>C:N[AAA-ACA]',
+          'c1:g1:100:A>T:S[AAA-ATA]', 'c1:g12:107:T>C:.', 'c10:-:5:G>T:.']
+
+
+class TestFilteredFrequencies(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        values = rng.random((len(LABELS), 3)).round(3)
+        values[1, 2] = -1
+        self.table = pd.DataFrame(values, index=LABELS, columns=['s1', 's2', 's3'])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def write_table(self, filename):
+        filepath = os.path.join(self.tmp_dir, filename)
+        with open_file(filepath, 'wt') as f:
+            self.table.to_csv(f, sep='\t')
+        return filepath
+
+    def expected(self, rows, samples):
+        return self.table.iloc[rows][samples].replace(-1, np.nan)
+
+    def test_query(self):
+        for filename in ['sp.filtered.freq', 'sp.filtered.freq.gz']:
+            table = FilteredFrequencies(self.write_table(filename))
+            self.assertEqual(table.samples, ['s1', 's2', 's3'])
+            np.testing.assert_array_equal(table.rows(regions=[('r', 'c1', 20, 100), ('r', 'c2', 1, 10)]), [1, 2, 3])
+            np.testing.assert_array_equal(table.rows(genes=['g12', '-']), [4, 5])
+            np.testing.assert_array_equal(table.rows(regions=[('r', 'c1', 1, 200)], genes=['g1']), [0, 1, 2, 3])
+
+            rows = table.rows(regions=[('r', 'c1', 1, 20), ('r', 'c10', 5, 5)])
+            data = table.frequencies(rows, samples=['s3', 's1'])
+            pd.testing.assert_frame_equal(data, self.expected([0, 1, 5], ['s3', 's1']))
+            pd.testing.assert_frame_equal(table.frequencies(), self.expected(range(len(LABELS)), table.samples))
+            self.assertEqual(table.frequencies(np.zeros(0, dtype=int)).shape, (0, 3))
+            self.assertEqual(table.frequencies(rows, precision='float32')['s1'].dtype, np.float32)
+            with self.assertRaises(KeyError):
+                table.frequencies(samples=['s4'])
+
+    def test_index(self):
+        filepath = self.write_table('sp.filtered.freq')
+        FilteredFrequencies(filepath)
+        self.assertTrue(os.path.isfile(rows_path(filepath)))
+        self.assertTrue(os.path.isfile(positions_path(filepath)))
+        # a changed table is indexed again
+        self.table = self.table.iloc[2:]
+        self.write_table('sp.filtered.freq')
+        table = FilteredFrequencies(filepath)
+        self.assertEqual(len(table.offsets), len(LABELS) - 1)
+        pd.testing.assert_frame_equal(table.frequencies(table.rows(genes=['g1'])), self.expected([0, 1], table.samples))
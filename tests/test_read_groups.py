@@ -0,0 +1,15 @@
+import unittest
+
+from metaSNV.read_groups import parse_sample_entry, sample_entry, uses_read_groups
+
+
+class TestSampleEntries(unittest.TestCase):
+    def test_whole_file(self):
+        self.assertEqual(sample_entry(['a/s1.bam']), 'a/s1.bam')
+        self.assertEqual(parse_sample_entry('a/s1.bam\n'), (['a/s1.bam'], None))
+
+    def test_read_groups(self):
+        entry = sample_entry(['a/lane1.bam', 'a/lane2.bam'], 's1')
+        self.assertEqual(parse_sample_entry(entry), (['a/lane1.bam', 'a/lane2.bam'], 's1'))
+        self.assertTrue(uses_read_groups(['a/s2.bam', entry]))
+        self.assertFalse(uses_read_groups(['a/s2.bam']))
@@ -0,0 +1,60 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from metaSNV.bam_preprocessing import BAMInfo
+from metaSNV.reference_cache import cache_path, populate, prepare
+
+
+class TestReferenceCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.environ = dict(os.environ)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def write_fasta(self, sequences):
+        filepath = os.path.join(self.tmp_dir, 'ref.fasta')
+        with open(filepath, 'w') as f:
+            for name, sequence in sequences.items():
+                f.write('>{} description\n'.format(name))
+                f.writelines(sequence[k:k + 60] + '\n' for k in range(0, len(sequence), 60))
+        return filepath
+
+    def test_populate(self):
+        fasta = self.write_fasta({'r1': 'acgtN' * 30, 'r2': 'GGC'})
+        md5s = populate(fasta, self.cache_dir)
+        self.assertEqual(md5s['r1'], hashlib.md5(b'ACGTN' * 30).hexdigest())
+        with open(cache_path(self.cache_dir, md5s['r2'])) as f:
+            self.assertEqual(f.read(), 'GGC')
+        # the second call reads the md5s of the cache
+        os.remove(cache_path(self.cache_dir, md5s['r2']))
+        self.assertEqual(populate(fasta, self.cache_dir), md5s)
+
+    def test_cram(self):
+        with pysam.AlignmentFile('tests/data/test.bam', 'rb') as bam:
+            lengths = dict(zip(bam.references, bam.lengths))
+        fasta = self.write_fasta({ref: 'ACGT' * (length // 4) for ref, length in lengths.items()})
+        cram = os.path.join(self.tmp_dir, 'test.cram')
+        pysam.view('-C', '-T', fasta, '-o', cram, 'tests/data/test.bam', catch_stdout=False)
+
+        with self.assertRaises(ValueError):
+            prepare([cram], self.write_fasta({ref: 'T' * length for ref, length in lengths.items()}),
+                    self.cache_dir)
+        fasta = self.write_fasta({ref: 'ACGT' * (length // 4) for ref, length in lengths.items()})
+        prepare([cram], fasta, self.cache_dir)
+        # decoded through the cache alone
+        os.remove(fasta)
+        expected = BAMInfo.from_bam('tests/data/test.bam')
+        info = BAMInfo.from_bam(cram)
+        self.assertEqual(info.sample, 'test')
+        for ref in expected.get_reference_names():
+            self.assertTrue(info[ref].pos2cov == expected[ref].pos2cov)
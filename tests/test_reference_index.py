@@ -0,0 +1,100 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from metaSNV.reference_index import GENE_DTYPE, GENOME_DTYPE, HEADER, is_current, write_index
+
+SNPCALL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metaSNV', 'snpCaller', 'snpCall')
+ANNOTATION_HEADER = 'gene_id\texternal_id\tsequence_id\ttype\tgene_info\tlength\tstart\tend\tstrand\n'
+
+
+class TestReferenceIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(0)
+        # a line longer than the line buffer of snpCall, lower case bases and a genome without genes
+        self.sequences = {'c1': ''.join(rng.choice('ACGTN') for _ in range(25000)),
+                          'c2': ''.join(rng.choice('ACGTacgt') for _ in range(3000)),
+                          'c3': 'ACGT' * 100}
+        self.ref_db = os.path.join(self.tmp_dir, 'ref.fasta')
+        with open(self.ref_db, 'w') as f:
+            for name, sequence in self.sequences.items():
+                f.write('>{}\n'.format(name))
+                if name == 'c1':
+                    f.write(sequence + '\n')
+                else:
+                    f.writelines(sequence[k:k + 60] + '\n' for k in range(0, len(sequence), 60))
+        # overlapping genes, a gene that goes around, and a contig missing from the reference
+        genes = [('c2', 'g1', 101, 1300, '+'), ('c2', 'g2', 1000, 2500, '-'), ('c2', 'g3', 2800, 2700, '+'),
+                 ('ghost', 'g4', 1, 90, '+'), ('c1', 'g5', 1, 24990, '-'), ('c1', 'g6', 9990, 10100, '+')]
+        self.db_ann = os.path.join(self.tmp_dir, 'ann.tab')
+        with open(self.db_ann, 'w') as f:
+            f.write(ANNOTATION_HEADER)
+            for k, (contig, name, start, end, strand) in enumerate(genes):
+                f.write('{}\t{}\t{}\tCDS\t<>\t0\t{}\t{}\t{}\n'.format(k, name, contig, start, end, strand))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index(self):
+        index = write_index(self.ref_db, self.db_ann)
+        self.assertEqual(index, self.ref_db + '.snpcall_index')
+        with open(index, 'rb') as f:
+            data = f.read()
+        _, n_genomes, n_genes, genomes_offset, genes_offset, strings_offset, _ = HEADER.unpack_from(data)
+        genomes = np.frombuffer(data, GENOME_DTYPE, n_genomes, genomes_offset)
+        genes = np.frombuffer(data, GENE_DTYPE, n_genes, genes_offset)
+        strings = data[strings_offset:]
+
+        names = [strings[g['name_offset']:g['name_offset'] + g['name_length']].decode() for g in genomes]
+        self.assertEqual(names, ['c1', 'c2', 'ghost'])
+        self.assertEqual(genomes['words_offset'][2], 0)
+        # snpCall drops the last base of every piece of a line that does not fit its buffer, and codes lower case
+        # bases as A
+        c1 = self.sequences['c1']
+        expected = {'c1': c1[:9998] + c1[9999:19997] + c1[19998:],
+                    'c2': ''.join(base if base.isupper() else 'A' for base in self.sequences['c2'])}
+        for genome, name in zip(genomes[:2], names):
+            words = np.frombuffer(data, '<u4', genome['length'] // 10 + 1, genome['words_offset'])
+            codes = (words[:, None] >> (np.arange(10, dtype=np.uint32) * 3)) & 7
+            decoded = ''.join('ATCGN'[code] for code in codes.ravel()[:genome['length']])
+            self.assertTrue(decoded == expected[name])
+        c2 = genes[genomes['first_gene'][1]:][:genomes['n_genes'][1]]
+        self.assertEqual(c2['start'].tolist(), [100, 999, 2799])
+        self.assertEqual(c2['strand'].tolist(), [b'+', b'-', b'+'])
+
+    def test_is_current(self):
+        self.assertFalse(is_current(self.ref_db, self.db_ann))
+        write_index(self.ref_db, self.db_ann)
+        self.assertTrue(is_current(self.ref_db, self.db_ann))
+        time.sleep(0.01)
+        with open(self.db_ann, 'a') as f:
+            f.write('5\tg7\tc3\tCDS\t<>\t0\t1\t9\t+\n')
+        self.assertFalse(is_current(self.ref_db, self.db_ann))
+
+    @unittest.skipUnless(os.path.isfile(SNPCALL), 'snpCall is not built')
+    def test_snpcall(self):
+        rng = random.Random(1)
+        lines = []
+        for name, sequence in self.sequences.items():
+            for pos in range(1, 24000 if name == 'c1' else len(sequence), 7):
+                columns = [name, str(pos), 'A']
+                for _ in range(2):
+                    bases = ''.join(rng.choice('..,,ACGTacgt') for _ in range(6))
+                    columns += [str(len(bases)), bases, 'I' * len(bases)]
+                lines.append('\t'.join(columns) + '\n')
+        pileup = ''.join(lines).encode()
+
+        def call(args):
+            return subprocess.run([SNPCALL, '-f', self.ref_db] + args, input=pileup, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, check=True).stdout
+
+        legacy = call(['-g', self.db_ann])
+        self.assertIn(b'\tg1\t', legacy)
+        self.assertEqual(call(['-x', write_index(self.ref_db, self.db_ann)]), legacy)
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metaSNV.regions import read_bed_regions, read_gene_regions, region_bounds, window_regions
+
+
+class TestRegions(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_gene_regions(self):
+        filepath = os.path.join(self.tmp_dir, 'anno.txt')
+        with open(filepath, 'w') as f:
+            f.write('gene_id\texternal_id\tsequence_id\ttype\tgene_info\tlength\tstart\tend\tstrand\n'
+                    '1\tc1.1\tc1\tCDS\t<annotation ID=a>\t30\t11\t40\t+\n'
+                    '2\tc1.2\tc1\tCDS\t<annotation ID=b>\t10\t51\t60\t-\n')
+        self.assertEqual(read_gene_regions(filepath), [('c1.1', 'c1', 11, 40), ('c1.2', 'c1', 51, 60)])
+
+    def test_read_bed_regions(self):
+        filepath = os.path.join(self.tmp_dir, 'regions.bed')
+        with open(filepath, 'w') as f:
+            f.write('# genes\nc1\t10\t40\tgene a\nc2\t0\t5\n')
+        self.assertEqual(read_bed_regions(filepath), [('c1:11-40', 'c1', 11, 40), ('c2:1-5', 'c2', 1, 5)])
+
+    def test_window_regions(self):
+        self.assertEqual(window_regions([('c1', 25), ('c2', 5)], 10, 10),
+                         [('c1:1-10', 'c1', 1, 10), ('c1:11-20', 'c1', 11, 20), ('c1:21-25', 'c1', 21, 25),
+                          ('c2:1-5', 'c2', 1, 5)])
+        self.assertEqual([region[2:] for region in window_regions([('c1', 20)], 10, 5)],
+                         [(1, 10), (6, 15), (11, 20)])
+
+    def test_region_bounds(self):
+        contigs = np.array(['c1', 'c1', 'c1', 'c2', 'c2'])
+        positions = np.array([5, 11, 40, 3, 60])
+        lo, hi = region_bounds(contigs, positions, [('a', 'c1', 11, 40), ('b', 'c2', 1, 59), ('c', 'c3', 1, 9),
+                                                    ('d', 'c1', 41, 50)])
+        np.testing.assert_array_equal(lo, [1, 3, 0, 3])
+        np.testing.assert_array_equal(hi, [3, 4, 0, 3])
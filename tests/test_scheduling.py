@@ -0,0 +1,74 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+from functools import partial
+
+from metaSNV.scheduling import map_tasks, read_isolated, run_admitted
+
+
+def concurrent(item, directory):
+    """Number of tasks running at the same time as this one."""
+    marker = os.path.join(directory, str(item))
+    open(marker, 'w').close()
+    time.sleep(0.2)
+    running = len(os.listdir(directory))
+    os.remove(marker)
+    return running
+
+
+def killed_once(item, directory):
+    """Killed the first time it runs for 'big'."""
+    marker = os.path.join(directory, 'killed')
+    if item == 'big' and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    return item.upper()
+
+
+def always_killed(item):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def failing(item):
+    raise ValueError(item)
+
+
+class TestScheduling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.running = os.path.join(self.tmp_dir, 'running')
+        os.makedirs(self.running)
+        self.record = os.path.join(self.tmp_dir, 'isolated_tasks.tsv')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pool(self):
+        self.assertEqual(map_tasks(str.upper, ['a', 'b'], 2), ['A', 'B'])
+
+    def test_budget(self):
+        results = map_tasks(partial(concurrent, directory=self.running), range(6), 6,
+                            footprint=lambda item: 1., budget=2.)
+        self.assertEqual(len(results), 6)
+        self.assertLessEqual(max(results), 2)
+
+    def test_too_large_runs_alone(self):
+        results = run_admitted(partial(concurrent, directory=self.running), range(4), 4, [1., 5., 1., 1.], 3.)
+        self.assertEqual(results[1], 1)
+
+    def test_killed_task_runs_again_alone(self):
+        func = partial(killed_once, directory=self.tmp_dir)
+        results = run_admitted(func, ['small', 'big', 'other'], 3, [1., 1., 1.], 10., self.record)
+        self.assertEqual(results, ['SMALL', 'BIG', 'OTHER'])
+        self.assertEqual(read_isolated(self.record), {('killed_once', 'big')})
+
+    def test_killed_alone(self):
+        with self.assertRaises(RuntimeError):
+            run_admitted(always_killed, ['a'], 1, [1.], 10., self.record)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            run_admitted(failing, ['a', 'b'], 2, [1., 1.], 10.)
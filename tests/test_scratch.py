@@ -0,0 +1,153 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+from functools import partial
+from multiprocessing import Pool
+
+from metaSNV.profiling import task_name
+from metaSNV.scratch import Scratch, StagedTask, alignment_indexes, move_back, staged_output
+
+
+def write(filepath, content):
+    with open(filepath, 'w') as f:
+        f.write(content)
+
+
+def read(filepath):
+    with open(filepath) as f:
+        return f.read()
+
+
+def copy_upper(filepath, outdir, suffix='.upper'):
+    write(os.path.join(outdir, os.path.basename(filepath) + suffix), read(filepath).upper())
+    return filepath
+
+
+class TestScratch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.inputs = os.path.join(self.tmp_dir, 'inputs')
+        self.scratch_dir = os.path.join(self.tmp_dir, 'scratch')
+        os.makedirs(self.inputs)
+        self.filepaths = []
+        for k, size in enumerate([100, 200, 300]):
+            filepath = os.path.join(self.inputs, 's{}.bam'.format(k))
+            write(filepath, 'a' * size)
+            self.filepaths.append(filepath)
+        write(os.path.join(self.inputs, 's0.bam.bai'), 'index')
+        write(os.path.join(self.inputs, 's1.bai'), 'index')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_alignment_indexes(self):
+        self.assertEqual(alignment_indexes(self.filepaths[0]), [self.filepaths[0] + '.bai'])
+        self.assertEqual(alignment_indexes(self.filepaths[1]), [os.path.join(self.inputs, 's1.bai')])
+        self.assertEqual(alignment_indexes(self.filepaths[2]), [])
+
+    def test_prefetch(self):
+        with Scratch(self.scratch_dir, limit=350) as scratch:
+            scratch.prefetch(self.filepaths, alignment_indexes)
+            local = list(scratch.fetched(self.filepaths))
+            # the first two files (with their indexes) fit, the last one is read in place
+            self.assertNotEqual(local[0], self.filepaths[0])
+            self.assertTrue(local[0].startswith(scratch.directory))
+            self.assertTrue(os.path.isfile(local[0] + '.bai'))
+            self.assertTrue(os.path.isfile(os.path.join(os.path.dirname(local[1]), 's1.bai')))
+            self.assertEqual(local[2], self.filepaths[2])
+            self.assertEqual([scratch.original(filepath) for filepath in local], self.filepaths)
+            self.assertEqual(read(local[1]), read(self.filepaths[1]))
+            self.assertEqual(os.path.getmtime(local[1]), os.path.getmtime(self.filepaths[1]))
+            self.assertLessEqual(scratch.used, 350)
+            # not prefetched
+            self.assertEqual(scratch.local(os.path.join(self.inputs, 'other.bam')),
+                             os.path.join(self.inputs, 'other.bam'))
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_release(self):
+        with Scratch(self.scratch_dir, limit=350, lookahead=1) as scratch:
+            scratch.prefetch(self.filepaths, alignment_indexes, release=True)
+            local = scratch.local(self.filepaths[0])
+            # the next file fits, but is only copied once the first one is released
+            time.sleep(0.2)
+            self.assertEqual(len(os.listdir(scratch.directory)), 1)
+            scratch.release(self.filepaths[0])
+            self.assertNotEqual(scratch.local(self.filepaths[1]), self.filepaths[1])
+            # released copies are kept until their space is needed
+            self.assertTrue(os.path.isfile(local))
+            scratch.release(self.filepaths[1])
+            # all files are read from scratch, the first ones are removed to make space for the last
+            self.assertNotEqual(scratch.local(self.filepaths[2]), self.filepaths[2])
+            self.assertFalse(os.path.exists(local))
+            self.assertEqual(scratch.used, 300)
+            self.assertEqual(scratch.original(local), self.filepaths[0])
+
+            # copies that are still there are reused
+            scratch.release(self.filepaths[2])
+            local = scratch.local(self.filepaths[2])
+            scratch.prefetch(self.filepaths, alignment_indexes)
+            # without release, the files that do not fit next to it are read in place
+            self.assertEqual(list(scratch.fetched(self.filepaths)), self.filepaths[:2] + [local])
+            self.assertEqual(scratch.used, 300)
+
+    def test_prefetch_error(self):
+        with Scratch(self.scratch_dir) as scratch:
+            missing = os.path.join(self.inputs, 'missing.bam')
+            scratch.prefetch([missing])
+            with self.assertRaises(FileNotFoundError):
+                scratch.local(missing)
+
+    def test_pickled(self):
+        with Scratch(self.scratch_dir) as scratch:
+            scratch.prefetch(self.filepaths[:1])
+            local = scratch.local(self.filepaths[0])
+            copy = pickle.loads(pickle.dumps(scratch))
+            self.assertEqual(copy.local(self.filepaths[0]), local)
+            copy.close()
+            self.assertTrue(os.path.isfile(local))
+
+    def test_staged_output(self):
+        target = os.path.join(self.tmp_dir, 'out', 'called_SNPs')
+        os.makedirs(self.scratch_dir)
+        with staged_output(target, self.scratch_dir) as local:
+            self.assertTrue(local.startswith(self.scratch_dir))
+            write(local, 'calls')
+            self.assertFalse(os.path.exists(target))
+        self.assertEqual(read(target), 'calls')
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        with self.assertRaises(RuntimeError):
+            with staged_output(target, self.scratch_dir) as local:
+                write(local, 'partial')
+                raise RuntimeError()
+        self.assertEqual(read(target), 'calls')
+
+        with staged_output(target, None) as local:
+            self.assertEqual(local, target)
+
+    def test_move_back_replaces(self):
+        target = os.path.join(self.tmp_dir, 'target')
+        write(target, 'old')
+        local = os.path.join(self.tmp_dir, 'local')
+        write(local, 'new')
+        move_back(local, target)
+        self.assertEqual(read(target), 'new')
+        self.assertFalse(os.path.exists(local))
+
+    def test_staged_task(self):
+        outdir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(self.scratch_dir)
+        func = StagedTask(partial(copy_upper, suffix='.up'), outdir, self.scratch_dir, stage_item=True,
+                          companions=alignment_indexes)
+        self.assertEqual(task_name(func), 'copy_upper')
+        with Pool(2) as p:
+            items = p.map(func, self.filepaths)
+        # tasks ran on copies of their items
+        for filepath, item in zip(self.filepaths, items):
+            self.assertNotEqual(item, filepath)
+            self.assertEqual(os.path.basename(item), os.path.basename(filepath))
+            self.assertEqual(read(os.path.join(outdir, os.path.basename(filepath) + '.up')), read(filepath).upper())
+        self.assertEqual(os.listdir(self.scratch_dir), [])
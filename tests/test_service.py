@@ -0,0 +1,78 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from metaSNV.service import Service, request
+
+
+def write(argv):
+    print(' '.join(argv))
+
+
+def fail(argv):
+    sys.exit(int(argv[0]))
+
+
+# state of the project, loaded in the launcher and inherited by the jobs
+STATE = []
+
+
+def state(argv):
+    print(len(STATE))
+
+
+class TestService(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.refreshed = os.path.join(self.tmp_dir, 'refreshed')
+
+        def refresh():
+            STATE.append(None)
+            with open(self.refreshed, 'a') as f:
+                f.write('refresh\n')
+
+        self.service = Service(self.tmp_dir, {'write': write, 'fail': fail, 'state': state}, refresh=refresh,
+                               refresh_after=['write'])
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.start()
+        while self.service.server is None:
+            time.sleep(0.01)
+
+    def tearDown(self) -> None:
+        request(self.service.socket_path, {'shutdown': None})
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def submit(self, kind, argv):
+        job = request(self.service.socket_path, {'submit': kind, 'argv': argv})
+        return request(self.service.socket_path, {'wait': job['id']})
+
+    def test_jobs(self):
+        job = self.submit('write', ['a', 'b'])
+        self.assertEqual((job['state'], job['returncode']), ('done', 0))
+        with open(job['log']) as f:
+            self.assertEqual(f.read(), 'a b\n')
+
+        job = self.submit('fail', ['3'])
+        self.assertEqual((job['state'], job['returncode']), ('failed', 3))
+        jobs = request(self.service.socket_path, {'jobs': None})['jobs']
+        self.assertEqual([job['kind'] for job in jobs], ['write', 'fail'])
+        # once at start and after the 'write' job only
+        with open(self.refreshed) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_state(self):
+        # jobs are forked from the launcher, with the state of its last refresh
+        for expected in ['2', '3', '4']:
+            self.submit('write', [])
+            with open(self.submit('state', [])['log']) as f:
+                self.assertEqual(f.read().strip(), expected)
+        self.assertEqual(STATE, [])
+
+    def test_unknown_job(self):
+        self.assertIn('error', request(self.service.socket_path, {'submit': 'unknown'}))
+        self.assertIn('error', request(self.service.socket_path, {'wait': 5}))
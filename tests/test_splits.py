@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from metaSNV.bam_preprocessing import BAMInfo
+from metaSNV.splits import (plan_splits, write_splits, planned_splits, split_outputs,
+                            mark_done, merge_splits)
+from metaSNV.utils import create_output_folder
+
+
+class TestSplits(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data = {'test': BAMInfo.from_bam('tests/data/test.bam')}
+        self.project_dir = tempfile.mkdtemp()
+        create_output_folder(self.project_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.project_dir)
+
+    def test_plan_splits(self):
+        splits = plan_splits(self.data, 2)
+        self.assertEqual(len(splits), 2)
+        refs = sorted(ref for split in splits for ref, _ in split)
+        self.assertEqual(refs, ['refGenome1clus', 'refGenome2clus', 'refGenome3clus'])
+        # more splits than genomes
+        self.assertEqual(len(plan_splits(self.data, 5)), 3)
+
+    def test_write_splits(self):
+        write_splits(self.project_dir, plan_splits(self.data, 3))
+        self.assertEqual(planned_splits(self.project_dir), [0, 1, 2])
+        write_splits(self.project_dir, plan_splits(self.data, 1))
+        self.assertEqual(planned_splits(self.project_dir), [0])
+        with open(os.path.join(self.project_dir, 'bestsplits', 'best_split_0')) as f:
+            self.assertEqual(sorted(f.read().splitlines()),
+                             ['refGenome{}clus\t0\t100000'.format(i) for i in [1, 2, 3]])
+
+    def test_replan_removes_split_outputs(self):
+        write_splits(self.project_dir, plan_splits(self.data, 3))
+        for i in [0, 1, 2]:
+            for part in split_outputs(self.project_dir, i, 'gzip' if i == 2 else 'none'):
+                with open(part, 'w') as f:
+                    f.write(f'line{i}\n')
+            mark_done(self.project_dir, i)
+        write_splits(self.project_dir, plan_splits(self.data, 2))
+        self.assertEqual(os.listdir(os.path.join(self.project_dir, 'snpCaller')), [])
+        # the splits of the new plan have not run yet
+        with self.assertRaises(ValueError):
+            merge_splits(self.project_dir)
+
+    def test_merge_splits(self):
+        write_splits(self.project_dir, plan_splits(self.data, 2))
+        for i in [0, 1]:
+            called, indiv = split_outputs(self.project_dir, i)
+            with open(called, 'w') as f:
+                f.write(f'line{i}\n')
+        mark_done(self.project_dir, 0)
+        with self.assertRaises(ValueError):
+            merge_splits(self.project_dir)
+
+        mark_done(self.project_dir, 1)
+        self.assertEqual(merge_splits(self.project_dir), [0, 1])
+        out_dir = os.path.join(self.project_dir, 'snpCaller')
+        self.assertEqual(sorted(os.listdir(out_dir)), ['called_SNPs', 'indiv_called'])
+        with open(os.path.join(out_dir, 'called_SNPs')) as f:
+            self.assertEqual(f.read(), 'line0\nline1\n')